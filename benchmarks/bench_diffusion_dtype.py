@@ -0,0 +1,70 @@
+"""Accuracy versus memory of the `dtype` option of dbmap.diffusion.Diffusor.
+
+Fits the diffusion process on the same kNN graph in double and single precision
+and reports, for each eigensolver, the memory held by the kernel, the diffusion
+operator and the eigenvectors, the fit time, the largest eigenvalue error and the
+smallest absolute cosine between matching leading eigenvectors.
+
+Usage: python benchmarks/bench_diffusion_dtype.py --n_samples 50000 --n_features 50
+       python benchmarks/bench_diffusion_dtype.py --digits
+"""
+import argparse
+import time
+
+import numpy as np
+from sklearn.datasets import load_digits, make_blobs
+
+from dbmap import ann
+from dbmap.diffusion import Diffusor
+
+
+def nbytes(m):
+    return m.data.nbytes + m.indices.nbytes + m.indptr.nbytes
+
+
+def fit(data, knn, nbrs, dtype, eigen_solver, n_neighbors):
+    diff = Diffusor(n_neighbors=n_neighbors, n_jobs=1, eigen_solver=eigen_solver, eigengap=False,
+                    dtype=dtype, verbose=False)
+    start = time.time()
+    diff.fit(data, knn=knn, nbrs=nbrs)
+    diff.transform(data)
+    elapsed = time.time() - start
+    evals = np.asarray(diff.res['EigenValues'])
+    evecs = np.asarray(diff.res['EigenVectors'])
+    memory = (nbytes(diff.K) + nbytes(diff.T) + evecs.nbytes) / 2 ** 20
+    return evals, evecs, memory, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_samples', type=int, default=50000)
+    parser.add_argument('--n_features', type=int, default=50)
+    parser.add_argument('--n_neighbors', type=int, default=15)
+    parser.add_argument('--n_check', type=int, default=10, help='number of leading eigenvectors compared')
+    parser.add_argument('--digits', action='store_true', help='use the sklearn digits data')
+    args = parser.parse_args()
+
+    if args.digits:
+        data = load_digits().data.astype(np.float32)
+    else:
+        data, _ = make_blobs(args.n_samples, args.n_features, centers=20, random_state=0)
+        data = data.astype(np.float32)
+    nbrs = ann.NMSlibTransformer(n_neighbors=args.n_neighbors, metric='euclidean', n_jobs=1,
+                                 verbose=False).fit(data)
+    knn = nbrs.transform(data)
+    print('%d samples, %d features, %d neighbors' % (data.shape[0], data.shape[1], args.n_neighbors))
+    print('%-10s %-8s %10s %8s %12s %10s' % ('solver', 'dtype', 'MiB', 'sec', 'max |dl|', 'min |cos|'))
+    for eigen_solver in ['arpack', 'eigsh', 'lobpcg', 'randomized']:
+        np.random.seed(0)
+        ref_evals, ref_evecs, memory, elapsed = fit(data, knn, nbrs, 'float64', eigen_solver, args.n_neighbors)
+        print('%-10s %-8s %10.1f %8.2f' % (eigen_solver, 'float64', memory, elapsed))
+        np.random.seed(0)
+        evals, evecs, memory, elapsed = fit(data, knn, nbrs, 'float32', eigen_solver, args.n_neighbors)
+        k = min(args.n_check, len(evals), len(ref_evals))
+        err = np.abs(evals[:k] - ref_evals[:k]).max()
+        cos = np.abs(np.sum(evecs[:, :k] * ref_evecs[:, :k], axis=0)).min()
+        print('%-10s %-8s %10.1f %8.2f %12.2e %10.4f' % (eigen_solver, 'float32', memory, elapsed, err, cos))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""Benchmark of the kNN search on multiscaled diffusion components (Diffusor.ind_dist_grad).
+
+Compares, on random data shaped like multiscaled components, the exact blocked
+brute-force search (dbmap.ann.exact_kneighbors) with an HNSW index
+(dbmap.ann.NMSlibTransformer, build and query), reports the recall of HNSW against
+the exact neighbors, and the method picked by dbmap.ann.select_knn_method
+(method='auto') with the time its probe takes.
+
+Usage: python benchmarks/bench_diffusion_knn.py --n_samples 10000 50000 200000 --n_dims 10 50
+"""
+import argparse
+import time
+
+import numpy as np
+
+from dbmap import ann
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_samples', type=int, nargs='+', default=[10000, 50000, 200000])
+    parser.add_argument('--n_dims', type=int, nargs='+', default=[10, 50])
+    parser.add_argument('--n_neighbors', type=int, default=16)
+    parser.add_argument('--metric', default='cosine')
+    parser.add_argument('--n_jobs', type=int, default=1)
+    args = parser.parse_args()
+
+    print('%10s %6s %10s %10s %8s %8s %10s' % ('n_samples', 'dims', 'exact (s)', 'hnsw (s)', 'recall', 'auto',
+                                             'probe (s)'))
+    rng = np.random.RandomState(0)
+    for n_samples in args.n_samples:
+        for n_dims in args.n_dims:
+            # Multiscaled components decay in scale with the component index
+            data = (rng.normal(size=(n_samples, n_dims)) / np.arange(1, n_dims + 1)).astype(np.float32)
+
+            start = time.time()
+            exact_ind, _ = ann.exact_kneighbors(data, args.n_neighbors, metric=args.metric)
+            exact_time = time.time() - start
+
+            start = time.time()
+            nbrs = ann.NMSlibTransformer(n_neighbors=args.n_neighbors, metric=args.metric, n_jobs=args.n_jobs,
+                                         dense=True).fit(data)
+            hnsw_ind, _ = nbrs.kneighbors(data, n_neighbors=args.n_neighbors)
+            hnsw_time = time.time() - start
+            recall = np.mean([len(np.intersect1d(a, b)) for a, b in zip(exact_ind, hnsw_ind)]) / args.n_neighbors
+
+            start = time.time()
+            method = ann.select_knn_method(data, args.n_neighbors, metric=args.metric, n_jobs=args.n_jobs)
+            probe_time = time.time() - start
+            print('%10d %6d %10.2f %10.2f %8.4f %8s %10.2f' % (n_samples, n_dims, exact_time, hnsw_time, recall,
+                                                             method, probe_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+"""Compares the eigensolver backends of dbmap.diffusion.Diffusor.
+
+For each graph size, a Diffusor is fitted on synthetic clustered data and the leading
+eigenpairs of the diffusion operator are computed with every backend. Reports wall time
+and the maximum relative eigenvalue error against a tightly converged reference.
+
+Usage: python benchmarks/bench_eigensolvers.py --sizes 100000 300000 1000000 --n_components 50
+"""
+import argparse
+import time
+
+import numpy as np
+from scipy.sparse.linalg import eigsh
+from sklearn.datasets import make_blobs
+
+from dbmap.diffusion import Diffusor
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100000, 300000, 1000000])
+    parser.add_argument('--n_components', type=int, default=50)
+    parser.add_argument('--n_neighbors', type=int, default=10)
+    parser.add_argument('--solvers', nargs='+', default=['arpack', 'eigsh', 'lobpcg', 'randomized'])
+    args = parser.parse_args()
+
+    print('%10s %12s %10s %14s' % ('n_samples', 'solver', 'time (s)', 'max rel. error'))
+    for n in args.sizes:
+        X, _ = make_blobs(n_samples=n, n_features=20, centers=20, random_state=0)
+        diff = Diffusor(n_neighbors=args.n_neighbors, ann_dist='euclidean', verbose=False).fit(X.astype(np.float32))
+        A, _ = diff._symmetric_operator()
+        ref = np.sort(eigsh(A, args.n_components, which='LA', tol=1e-10)[0])[::-1]
+        for solver in args.solvers:
+            diff.eigen_solver = solver
+            start = time.time()
+            D, V = diff._decompose(args.n_components)
+            elapsed = time.time() - start
+            err = np.max(np.abs(D - ref) / np.abs(ref))
+            print('%10d %12s %10.2f %14.2e' % (n, solver, elapsed, err))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""Benchmark of the numba ForceAtlas2 engine of dbmap.forceatlas2.
+
+Lays out the kNN graph of clustered data and reports the time per iteration and the ratio of the mean distance of
+nodes to their cluster centre over the mean distance between cluster centres (lower is better separated). If the
+`fa2` package is installed, it is run on the same graph and initial positions for reference.
+
+Usage: python benchmarks/bench_forceatlas2.py --n_samples 100000 --iterations 100
+"""
+import argparse
+import time
+
+import numpy as np
+from sklearn.datasets import make_blobs
+from sklearn.neighbors import kneighbors_graph
+
+from dbmap.forceatlas2 import forceatlas2
+
+
+def separation(pos, labels):
+    centers = np.array([pos[labels == k].mean(axis=0) for k in np.unique(labels)])
+    intra = np.mean([np.linalg.norm(pos[labels == k] - centers[k], axis=1).mean() for k in np.unique(labels)])
+    inter = np.mean([np.linalg.norm(centers[i] - centers[j]) for i in range(len(centers)) for j in range(i)])
+    return intra / inter
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_samples', type=int, default=100000)
+    parser.add_argument('--n_features', type=int, default=10)
+    parser.add_argument('--n_neighbors', type=int, default=10)
+    parser.add_argument('--iterations', type=int, default=100)
+    parser.add_argument('--lin_log', action='store_true')
+    parser.add_argument('--no_fa2', action='store_true', help='skip the fa2 reference')
+    args = parser.parse_args()
+
+    data, labels = make_blobs(args.n_samples, args.n_features, centers=10, cluster_std=3.0, random_state=0)
+    graph = kneighbors_graph(data, args.n_neighbors, mode='connectivity', n_jobs=-1)
+    graph = graph.maximum(graph.T).tocsr()
+    init = np.random.RandomState(0).random_sample((args.n_samples, 2))
+    print('%d nodes, %d edges, %d iterations' % (args.n_samples, graph.nnz // 2, args.iterations))
+    print('%-14s %12s %12s' % ('engine', 'sec / iter', 'separation'))
+
+    # Compile outside of the timings
+    forceatlas2(graph[:100, :100], pos=init[:100], iterations=2, lin_log=args.lin_log)
+    for parallel in (False, True):
+        start = time.time()
+        pos = forceatlas2(graph, pos=init, iterations=args.iterations, lin_log=args.lin_log, parallel=parallel)
+        elapsed = (time.time() - start) / args.iterations
+        print('%-14s %12.3f %12.4f' % ('dbmap parallel' if parallel else 'dbmap serial', elapsed,
+                                       separation(pos, labels)))
+
+    if args.no_fa2:
+        return
+    try:
+        from fa2 import ForceAtlas2
+    except ImportError:
+        print('fa2 is not installed, skipping the reference')
+        return
+    start = time.time()
+    pos = ForceAtlas2(linLogMode=args.lin_log, barnesHutTheta=1.2, verbose=False).forceatlas2(
+        graph, pos=init.copy(), iterations=args.iterations)
+    elapsed = (time.time() - start) / args.iterations
+    print('%-14s %12.3f %12.4f' % ('fa2', elapsed, separation(np.array(pos), labels)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""Regression benchmark for the numba kernels behind dbmap.graph_utils.fuzzy_simplicial_set_nmslib.
+
+Checks smooth_knn_dist and compute_membership_strengths against their pure Python versions
+on a small kNN graph, then times the compiled kernels on a large one.
+
+Usage: python benchmarks/bench_fuzzy_graph.py --n_samples 1000000 --n_neighbors 30
+"""
+import argparse
+import time
+
+import numpy as np
+
+from dbmap.graph_utils import smooth_knn_dist, compute_membership_strengths
+
+
+def random_knn(n_samples, n_neighbors, seed=0):
+    rng = np.random.RandomState(seed)
+    knn_dists = np.sort(rng.exponential(size=(n_samples, n_neighbors)).astype(np.float32), axis=1)
+    knn_dists[:, 0] = 0.0
+    knn_indices = rng.randint(0, n_samples, size=(n_samples, n_neighbors)).astype(np.int32)
+    knn_indices[:, 0] = np.arange(n_samples)
+    return knn_indices, knn_dists
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_samples', type=int, default=1000000)
+    parser.add_argument('--n_neighbors', type=int, default=30)
+    parser.add_argument('--n_check', type=int, default=2000)
+    args = parser.parse_args()
+
+    knn_indices, knn_dists = random_knn(args.n_check, args.n_neighbors)
+    start = time.time()
+    sigmas, rhos = smooth_knn_dist(knn_dists, float(args.n_neighbors))
+    rows, cols, vals = compute_membership_strengths(knn_indices, knn_dists, sigmas, rhos)
+    print('first call (compilation included): %.2f s' % (time.time() - start))
+    start = time.time()
+    ref_sigmas, ref_rhos = smooth_knn_dist.py_func(knn_dists, float(args.n_neighbors))
+    ref_rows, ref_cols, ref_vals = compute_membership_strengths.py_func(knn_indices, knn_dists, ref_sigmas, ref_rhos)
+    py_time = time.time() - start
+    assert np.allclose(sigmas, ref_sigmas, rtol=1e-3) and np.allclose(rhos, ref_rhos)
+    assert np.array_equal(rows, ref_rows) and np.array_equal(cols, ref_cols)
+    assert np.allclose(vals, ref_vals, rtol=1e-3, atol=1e-6)
+    print('n_samples=%d: pure Python %.2f s, results match' % (args.n_check, py_time))
+
+    knn_indices, knn_dists = random_knn(args.n_samples, args.n_neighbors)
+    start = time.time()
+    sigmas, rhos = smooth_knn_dist(knn_dists, float(args.n_neighbors))
+    mid = time.time()
+    compute_membership_strengths(knn_indices, knn_dists, sigmas, rhos)
+    end = time.time()
+    print('n_samples=%d: smooth_knn_dist %.2f s, compute_membership_strengths %.2f s'
+          % (args.n_samples, mid - start, end - mid))
+    print('estimated pure Python time: %.1f s' % (py_time * args.n_samples / args.n_check))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""Benchmark of dbmap.graph_utils.get_igraph_from_adjacency on a large symmetric kNN graph.
+
+Compares the previous conversion (fancy indexing of the matrix and a list of edge tuples) with the CSR-based one,
+keeping all stored edges or only the upper triangle, and checks that they build the same graph.
+
+Usage: python benchmarks/bench_igraph_conversion.py --n_samples 200000 --n_neighbors 15
+"""
+import argparse
+import time
+
+import igraph as ig
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from dbmap.graph_utils import get_igraph_from_adjacency
+
+
+def previous_igraph_from_adjacency(adjacency, directed=None):
+    sources, targets = adjacency.nonzero()
+    weights = adjacency[sources, targets]
+    if isinstance(weights, np.matrix):
+        weights = weights.A1
+    g = ig.Graph(directed=directed)
+    g.add_vertices(adjacency.shape[0])
+    g.add_edges(list(zip(sources, targets)))
+    g.es['weight'] = weights
+    return g
+
+
+def random_symmetric_knn(n_samples, n_neighbors, seed=0):
+    rng = np.random.RandomState(seed)
+    rows = np.repeat(np.arange(n_samples), n_neighbors)
+    cols = rng.randint(0, n_samples, n_samples * n_neighbors)
+    graph = csr_matrix((rng.uniform(size=rows.shape[0]), (rows, cols)), shape=(n_samples, n_samples))
+    graph.setdiag(0)
+    graph.eliminate_zeros()
+    return graph.maximum(graph.T).tocsr()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_samples', type=int, default=200000)
+    parser.add_argument('--n_neighbors', type=int, default=15)
+    args = parser.parse_args()
+
+    graph = random_symmetric_knn(args.n_samples, args.n_neighbors)
+    print('%d vertices, %d stored edges' % (graph.shape[0], graph.nnz))
+
+    start = time.time()
+    previous = previous_igraph_from_adjacency(graph)
+    print('%-22s %8.2f s  %d edges' % ('previous', time.time() - start, previous.ecount()))
+    start = time.time()
+    full = get_igraph_from_adjacency(graph)
+    print('%-22s %8.2f s  %d edges' % ('csr', time.time() - start, full.ecount()))
+    start = time.time()
+    upper = get_igraph_from_adjacency(graph, upper=True)
+    print('%-22s %8.2f s  %d edges' % ('csr, upper triangle', time.time() - start, upper.ecount()))
+
+    assert previous.get_edgelist() == full.get_edgelist()
+    assert np.array_equal(previous.es['weight'], full.es['weight'])
+    assert upper.ecount() == graph.nnz // 2
+    print('graphs match')
+
+
+if __name__ == '__main__':
+    main()
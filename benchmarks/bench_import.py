@@ -0,0 +1,58 @@
+"""Import-time benchmark for dbmap.
+
+Times, in fresh interpreter processes, importing dbmap and its submodules, and
+lists which heavy dependencies each import loads. `import dbmap` should not load
+any of them: submodules and their dependencies load on first use.
+
+Usage: python benchmarks/bench_import.py --repeats 5
+"""
+import argparse
+import ast
+import subprocess
+import sys
+
+STATEMENTS = [
+    'import numpy',
+    'import dbmap',
+    'import dbmap.ann',
+    'import dbmap.diffusion',
+    'import dbmap.map',
+    'import dbmap.pacmapper',
+    'import dbmap.plot',
+]
+
+HEAVY = ['numba', 'nmslib', 'matplotlib', 'networkx', 'umap', 'pandas', 'sklearn', 'scipy']
+
+SCRIPT = '''
+import sys, time
+start = time.perf_counter()
+%s
+elapsed = time.perf_counter() - start
+loaded = [name for name in %r if name in sys.modules]
+print(repr((elapsed, ','.join(loaded))))
+'''
+
+
+def time_import(statement):
+    out = subprocess.run([sys.executable, '-c', SCRIPT % (statement, HEAVY)], check=True,
+                         stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True).stdout
+    return ast.literal_eval(out.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    print('%-26s %10s   %s' % ('statement', 'best (s)', 'heavy modules loaded'))
+    for statement in STATEMENTS:
+        try:
+            results = [time_import(statement) for _ in range(args.repeats)]
+        except subprocess.CalledProcessError:
+            print('%-26s %10s' % (statement, 'failed'))
+            continue
+        print('%-26s %10.3f   %s' % (statement, min(t for t, _ in results), results[0][1] or '-'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""Memory benchmark for dbmap.ann.knn_to_csr.
+
+Compares the peak memory (traced with tracemalloc) of assembling a kNN graph
+the way NMSlibTransformer.transform used to do it, from per-row query results
+stacked with np.vstack, with wrapping preallocated int32/float32 kNN arrays
+with knn_to_csr.
+
+Usage: python benchmarks/bench_knn_csr.py --n_samples 1000000 --n_neighbors 30
+"""
+import argparse
+import tracemalloc
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from dbmap.ann import knn_to_csr
+
+
+def legacy_csr(results, n_samples, n_neighbors):
+    indices, distances = zip(*results)
+    indices, distances = np.vstack(indices), np.vstack(distances)
+    indptr = np.arange(0, n_samples * n_neighbors + 1, n_neighbors)
+    return csr_matrix((distances.ravel(), indices.ravel(), indptr), shape=(n_samples, n_samples))
+
+
+def traced(fn, *args):
+    tracemalloc.start()
+    result = fn(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, peak / 2 ** 20
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_samples', type=int, default=1000000)
+    parser.add_argument('--n_neighbors', type=int, default=30)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    indices = rng.randint(0, args.n_samples, size=(args.n_samples, args.n_neighbors)).astype(np.int32)
+    distances = rng.uniform(size=(args.n_samples, args.n_neighbors)).astype(np.float32)
+    print('kNN arrays: %.1f MiB' % ((indices.nbytes + distances.nbytes) / 2 ** 20))
+
+    # Per-row results, as returned by nmslib's knnQueryBatch
+    results = list(zip(indices, distances))
+    legacy, legacy_peak = traced(legacy_csr, results, args.n_samples, args.n_neighbors)
+    graph, peak = traced(knn_to_csr, indices, distances)
+    assert (legacy != graph).nnz == 0
+    assert np.shares_memory(graph.indices, indices) and np.shares_memory(graph.data, distances)
+    print('vstack + csr_matrix: peak %.1f MiB, index dtype %s' % (legacy_peak, legacy.indices.dtype))
+    print('knn_to_csr:          peak %.1f MiB, index dtype %s (indices and data shared with the kNN arrays)'
+          % (peak, graph.indices.dtype))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""Wall-clock and quality benchmark of the `repulsion` engines of dbmap.umap_layouts.optimize_layout_euclidean.
+
+Builds the fuzzy graph of the data once, then lays it out with negative sampling ('sampled') and with
+Barnes-Hut repulsion ('barnes_hut') for a range of epoch counts, and reports the layout time and the
+trustworthiness of each layout (on a subsample of --n_eval points).
+
+Usage: python benchmarks/bench_layout_repulsion.py --n_samples 100000 --epochs 50 100 200
+       python benchmarks/bench_layout_repulsion.py --digits --n_dims 3
+"""
+import argparse
+import time
+
+import numpy as np
+from sklearn.datasets import load_digits, make_blobs
+from sklearn.manifold import trustworthiness
+
+from dbmap import ann
+from dbmap.graph_utils import fuzzy_simplicial_set_nmslib
+from dbmap.map import simplicial_set_embedding
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_samples', type=int, default=100000)
+    parser.add_argument('--n_features', type=int, default=50)
+    parser.add_argument('--n_neighbors', type=int, default=15)
+    parser.add_argument('--n_dims', type=int, default=2)
+    parser.add_argument('--epochs', type=int, nargs='+', default=[50, 100, 200])
+    parser.add_argument('--n_eval', type=int, default=5000, help='points used for trustworthiness')
+    parser.add_argument('--parallel', action='store_true')
+    parser.add_argument('--digits', action='store_true', help='use the sklearn digits data')
+    args = parser.parse_args()
+
+    if args.digits:
+        data = load_digits().data.astype(np.float32)
+    else:
+        data, _ = make_blobs(args.n_samples, args.n_features, centers=20, cluster_std=4.0, random_state=0)
+        data = data.astype(np.float32)
+    nbrs = ann.NMSlibTransformer(n_neighbors=args.n_neighbors, metric='euclidean', n_jobs=1, verbose=False)
+    knn_indices, knn_dists = nbrs.fit(data).kneighbors(data)
+    graph, _, _ = fuzzy_simplicial_set_nmslib(data, args.n_neighbors, knn_indices=knn_indices,
+                                              knn_dists=np.sqrt(knn_dists), verbose=False)
+    sample = np.random.RandomState(0).permutation(data.shape[0])[:args.n_eval]
+
+    # Compile both engines outside of the timings
+    for repulsion in ('sampled', 'barnes_hut'):
+        simplicial_set_embedding(data[:500], graph[:500, :500].tocsr(), n_components=args.n_dims, n_epochs=2,
+                                 init='random', random_state=0, parallel=args.parallel, repulsion=repulsion)
+
+    print('%d samples, %d features, %d dims' % (data.shape[0], data.shape[1], args.n_dims))
+    print('%-12s %8s %10s %16s' % ('repulsion', 'epochs', 'sec', 'trustworthiness'))
+    for n_epochs in args.epochs:
+        for repulsion in ('sampled', 'barnes_hut'):
+            start = time.time()
+            emb, _ = simplicial_set_embedding(data, graph.copy(), n_components=args.n_dims, n_epochs=n_epochs,
+                                              init='random', random_state=0, parallel=args.parallel,
+                                              repulsion=repulsion)
+            elapsed = time.time() - start
+            score = trustworthiness(data[sample], emb[sample], n_neighbors=args.n_neighbors)
+            print('%-12s %8d %10.2f %16.4f' % (repulsion, n_epochs, elapsed, score))
+
+
+if __name__ == '__main__':
+    main()
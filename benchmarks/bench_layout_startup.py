@@ -0,0 +1,66 @@
+"""Startup benchmark for the compiled layout kernels in dbmap.umap_layouts.
+
+Each run starts a fresh worker process (as a job scheduler or multiprocessing
+pool would) and times the first optimize_layout_euclidean call on a small
+random graph. 'jit' compiles the epoch kernel inside the call the way the
+layout used to; 'cached' uses the module-level kernels, which after the first
+worker are loaded from numba's on-disk cache.
+
+Usage: python benchmarks/bench_layout_startup.py --workers 5 --parallel
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+WORKER = '''
+import sys
+import time
+import numba
+import numpy as np
+from dbmap import umap_layouts
+
+mode, parallel = sys.argv[1], sys.argv[2] == '1'
+rng = np.random.RandomState(0)
+n, n_edges = 1000, 15000
+embedding = rng.normal(size=(n, 2)).astype(np.float32)
+head = rng.randint(0, n, n_edges).astype(np.int32)
+tail = rng.randint(0, n, n_edges).astype(np.int32)
+epochs_per_sample = rng.uniform(1, 10, n_edges)
+rng_state = rng.randint(np.iinfo(np.int32).min + 1, np.iinfo(np.int32).max - 1, 3).astype(np.int64)
+if mode == 'jit':
+    kernel = numba.njit(umap_layouts._optimize_layout_euclidean_single_epoch, fastmath=True, parallel=parallel)
+    if parallel:
+        umap_layouts._optimize_layout_euclidean_single_epoch_parallel = kernel
+    else:
+        umap_layouts._optimize_layout_euclidean_single_epoch_serial = kernel
+start = time.time()
+umap_layouts.optimize_layout_euclidean(embedding, embedding, head, tail, 1, n, epochs_per_sample,
+                                       1.577, 0.895, rng_state, parallel=parallel)
+print(time.time() - start)
+'''
+
+
+def run_worker(mode, parallel, env):
+    out = subprocess.run([sys.executable, '-c', WORKER, mode, '1' if parallel else '0'],
+                         env=env, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return float(out.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=5)
+    parser.add_argument('--parallel', action='store_true')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        env = dict(os.environ, NUMBA_CACHE_DIR=cache_dir)
+        for mode in ('jit', 'cached'):
+            times = [run_worker(mode, args.parallel, env) for _ in range(args.workers)]
+            print('%-6s first worker %.2f s, later workers %s' %
+                  (mode, times[0], ' '.join('%.2f' % t for t in times[1:])))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""Thread-scaling benchmark for dbmap.pacmapper.pacmap_grad_parallel.
+
+Checks the parallel gradient against the serial pacmap_grad on random pairs,
+then times it with 1..N numba threads.
+
+Usage: python benchmarks/bench_pacmap_grad.py --n_samples 500000 --repeats 5
+"""
+import argparse
+import time
+
+import numba
+import numpy as np
+
+from dbmap.pacmapper import pacmap_grad, pacmap_grad_parallel
+
+
+def random_pairs(n_samples, n_pairs, rng):
+    return rng.randint(0, n_samples, size=(n_samples * n_pairs, 2)).astype(np.int32)
+
+
+def thread_buffers(Y, n_threads):
+    n, dim = Y.shape
+    return np.empty((n_threads, n, dim), dtype=np.float32), np.empty((n_threads, 3), dtype=np.float32)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_samples', type=int, default=500000)
+    parser.add_argument('--n_dims', type=int, default=2)
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    Y = rng.normal(size=(args.n_samples, args.n_dims)).astype(np.float32)
+    pair_neighbors = random_pairs(args.n_samples, 10, rng)
+    pair_MN = random_pairs(args.n_samples, 5, rng)
+    pair_FP = random_pairs(args.n_samples, 20, rng)
+    weights = (np.float32(2.0), np.float32(3.0), np.float32(1.0))
+
+    reference = pacmap_grad(Y, pair_neighbors, pair_MN, pair_FP, *weights)
+    grad = np.empty_like(reference)
+    pacmap_grad_parallel(Y, pair_neighbors, pair_MN, pair_FP, *weights, *thread_buffers(Y, numba.get_num_threads()),
+                         grad)
+    assert np.allclose(grad, reference, rtol=1e-3, atol=1e-3)
+
+    start = time.time()
+    for _ in range(args.repeats):
+        pacmap_grad(Y, pair_neighbors, pair_MN, pair_FP, *weights)
+    serial = (time.time() - start) / args.repeats
+    print('pacmap_grad (serial): %.3f s' % serial)
+
+    for n_threads in range(1, numba.config.NUMBA_NUM_THREADS + 1):
+        numba.set_num_threads(n_threads)
+        buffers = thread_buffers(Y, n_threads)
+        start = time.time()
+        for _ in range(args.repeats):
+            pacmap_grad_parallel(Y, pair_neighbors, pair_MN, pair_FP, *weights, *buffers, grad)
+        elapsed = (time.time() - start) / args.repeats
+        print('pacmap_grad_parallel, %2d threads: %.3f s (%.1fx)' % (n_threads, elapsed, serial / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,20 @@
-from . import diffusion
-from . import multiscale
-from . import utils
-from . import ann
-from . import graph_utils
-from . import plot
-from . import spectral
-from . import layout
-from . import pacmapper
-from . import umap_layouts
-from . import map
+import importlib
+
 from .version import __version__
+
+# Submodules are imported on first access (e.g. `dbmap.diffusion`), so that `import dbmap` does not load
+# numba, nmslib and the other heavy dependencies.
+_submodules = ['diffusion', 'multiscale', 'utils', 'ann', 'graph_utils', 'plot', 'spectral', 'layout', 'pacmapper',
+               'umap_layouts', 'barnes_hut', 'forceatlas2', 'map', 'cache', 'distances']
+
+__all__ = _submodules + ['__version__']
+
+
+def __getattr__(name):
+    if name in _submodules:
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def __dir__():
+    return __all__
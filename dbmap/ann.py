@@ -6,21 +6,245 @@
 # contact: davisidarta@gmail.com
 ######################################
 
+import os
+import json
+import hashlib
 import time
-import sys
 import numpy as np
 from sklearn.base import TransformerMixin, BaseEstimator
 from scipy.sparse import csr_matrix, find, issparse
 from sklearn.neighbors import NearestNeighbors
+from sklearn.metrics import pairwise_distances
 from sklearn.model_selection import train_test_split
 
-try:
-    import nmslib
-except ImportError:
-    print("The package 'nmslib' is required. Please install it 'with pip3 install nmslib'.")
-    sys.exit()
 
-print(__doc__)
+
+def _import_nmslib():
+    # nmslib is imported on first use, so that importing dbmap stays fast
+    try:
+        import nmslib
+    except ImportError:
+        raise ImportError("The package 'nmslib' is required. Please install it with 'pip3 install nmslib'.")
+    return nmslib
+
+
+def data_fingerprint(data):
+    """
+    Computes a fingerprint (SHA1 hex digest) of the input data, used to check whether
+    stored indices and results were computed on the same data.
+    Parameters
+    ----------
+    data: np.ndarray, pandas DataFrame or scipy sparse matrix.
+
+    """
+    h = hashlib.sha1()
+    h.update(str(data.shape).encode())
+    if issparse(data):
+        data = data.tocsr()
+        arrays = (data.indptr, data.indices, data.data)
+    else:
+        if hasattr(data, 'values'):
+            data = data.values
+        arrays = (np.asarray(data),)
+    for a in arrays:
+        a = np.ascontiguousarray(a)
+        h.update(str(a.dtype).encode())
+        h.update(memoryview(a).cast('B'))
+    return h.hexdigest()
+
+
+def knn_to_csr(indices, distances, n_samples_fit=None):
+    """
+    Wraps rectangular kNN arrays as a CSR matrix without copying them. Contiguous int32 indices
+    and float32 distances (as returned by `NMSlibTransformer.kneighbors`) are used as the `indices`
+    and `data` arrays of the matrix; only the `indptr` array is allocated. Missing neighbors
+    (indices of -1) are left out, which requires a copy.
+    Parameters
+    ----------
+    indices: array of shape (n_samples, n_neighbors) with the neighbors of each sample.
+    distances: array of shape (n_samples, n_neighbors) with the matching distances or weights.
+    n_samples_fit: number of columns of the matrix, i.e. of indexed samples. Defaults to n_samples.
+
+    Returns
+    ----------
+    kNN graph as a scipy.sparse.csr_matrix of shape (n_samples, n_samples_fit).
+
+    """
+    n_samples, n_neighbors = indices.shape
+    if n_samples_fit is None:
+        n_samples_fit = n_samples
+    index_dtype = np.int32 if max(n_samples * n_neighbors, n_samples_fit) < np.iinfo(np.int32).max else np.int64
+    indices = np.ascontiguousarray(indices, dtype=index_dtype)
+    distances = np.ascontiguousarray(distances)
+    if indices.size == 0 or indices.min() >= 0:
+        indptr = np.arange(0, n_samples * n_neighbors + 1, n_neighbors, dtype=index_dtype)
+        return csr_matrix((distances.reshape(-1), indices.reshape(-1), indptr),
+                          shape=(n_samples, n_samples_fit), copy=False)
+    found = indices >= 0
+    indptr = np.zeros(n_samples + 1, dtype=index_dtype)
+    np.cumsum(found.sum(axis=1), out=indptr[1:])
+    return csr_matrix((distances[found], indices[found], indptr), shape=(n_samples, n_samples_fit), copy=False)
+
+
+def exact_kneighbors(data, n_neighbors, metric='cosine', query=None, batch_size=None, max_block=2 ** 25):
+    """
+    Exact k-nearest-neighbors by blocked brute-force search, for dense and low-dimensional data (such as
+    multiscaled diffusion components), where it can be cheaper than building an index and is deterministic.
+    Distances of query blocks to all samples are computed with matrix products when possible, and only the
+    k nearest neighbors of each block are kept. Distances follow the conventions of `NMSlibTransformer`
+    for the same metric (e.g. 'euclidean' distances are squared, as in NMSlib's 'l2' space), so that
+    results can be used interchangeably.
+    Parameters
+    ----------
+    data: dense array of shape (n_samples, n_features) to search in.
+    n_neighbors: number of neighbors to return, including each sample itself.
+    metric: one of 'euclidean', 'sqeuclidean', 'cosine', 'l1' and 'linf'.
+    query: optional array of samples to query. Defaults to `data`.
+    batch_size: number of samples queried at once. Defaults to as many as fit in `max_block` distances.
+    max_block: maximum number of distances held in memory at once.
+
+    Returns
+    ----------
+    indices (int32) and distances (float32) arrays of shape (n_queries, n_neighbors), nearest first.
+
+    """
+    if metric not in ['euclidean', 'sqeuclidean', 'cosine', 'l1', 'linf']:
+        raise Exception('Exact search is available for the \'euclidean\', \'sqeuclidean\', \'cosine\', '
+                        '\'l1\' and \'linf\' metrics only.')
+    data = np.asarray(data, dtype=np.float32)
+    self_query = query is None
+    query = data if self_query else np.asarray(query, dtype=np.float32)
+    n_samples = data.shape[0]
+    n_neighbors = min(n_neighbors, n_samples)
+    if batch_size is None:
+        batch_size = max(1, max_block // n_samples)
+    if metric == 'cosine':
+        data_norm = data / np.maximum(np.linalg.norm(data, axis=1), 1e-12)[:, None]
+    elif metric in ['euclidean', 'sqeuclidean']:
+        data_sq = np.einsum('ij,ij->i', data, data)
+    indices = np.empty((query.shape[0], n_neighbors), dtype=np.int32)
+    distances = np.empty((query.shape[0], n_neighbors), dtype=np.float32)
+    for start in range(0, query.shape[0], batch_size):
+        stop = min(start + batch_size, query.shape[0])
+        block = query[start:stop]
+        if metric == 'cosine':
+            block = block / np.maximum(np.linalg.norm(block, axis=1), 1e-12)[:, None]
+            dist = block @ data_norm.T
+            np.subtract(1, dist, out=dist)
+        elif metric in ['euclidean', 'sqeuclidean']:
+            dist = block @ data.T
+            dist *= -2
+            dist += data_sq
+            dist += np.einsum('ij,ij->i', block, block)[:, None]
+            np.maximum(dist, 0, out=dist)
+            if metric == 'sqeuclidean':
+                dist **= 2
+        else:
+            dist = pairwise_distances(block, data, metric={'l1': 'manhattan', 'linf': 'chebyshev'}[metric])
+        if self_query:
+            # Rounding leaves small distances of samples to themselves
+            dist[np.arange(stop - start), np.arange(start, stop)] = 0
+        ind = np.argpartition(dist, n_neighbors - 1, axis=1)[:, :n_neighbors]
+        d = np.take_along_axis(dist, ind, axis=1)
+        order = np.argsort(d, axis=1, kind='stable')
+        indices[start:stop] = np.take_along_axis(ind, order, axis=1)
+        distances[start:stop] = np.take_along_axis(d, order, axis=1)
+    return indices, distances
+
+
+def knn_gradient(kneighbors_graph, metric):
+    """
+    Distance gradient along the edges of a kNN graph, as returned by `NMSlibTransformer.ind_dist_grad`.
+    Parameters
+    ----------
+    kneighbors_graph: kNN distance graph (scipy csr matrix).
+    metric: metric of the distances.
+
+    Returns
+    ----------
+    Array with one value per nonzero edge of the graph, or an empty list for metrics without a gradient.
+
+    """
+    x, y, dists = find(kneighbors_graph)
+
+    # Define gradients
+    grad = []
+    if metric not in ['sqeuclidean', 'euclidean', 'cosine', 'linf']:
+        print('Gradient undefined for metric \'' + metric + '\'. Returning empty array.')
+
+    if metric == 'cosine':
+        norm_x = 0.0
+        norm_y = 0.0
+        for i in range(x.shape[0]):
+            norm_x += x[i] ** 2
+            norm_y += y[i] ** 2
+        if norm_x == 0.0 and norm_y == 0.0:
+            grad = np.zeros(x.shape)
+        elif norm_x == 0.0 or norm_y == 0.0:
+            grad = np.zeros(x.shape)
+        else:
+            grad = -(x * dists - y * norm_x) / np.sqrt(norm_x ** 3 * norm_y)
+
+    if metric == 'euclidean':
+        grad = x - y / (1e-6 + np.sqrt(dists))
+
+    if metric == 'sqeuclidean':
+        grad = x - y / (1e-6 + dists)
+
+    if metric == 'linf':
+        result = 0.0
+        max_i = 0
+        for i in range(x.shape[0]):
+            v = np.abs(x[i] - y[i])
+            if v > result:
+                result = dists
+                max_i = i
+        grad = np.zeros(x.shape)
+        grad[max_i] = np.sign(x[max_i] - y[max_i])
+    return grad
+
+
+def select_knn_method(data, n_neighbors, metric='cosine', n_jobs=1, M=30, efC=100, efS=100, n_probe=2048,
+                      verbose=False):
+    """
+    Chooses between exact search (`exact_kneighbors`) and an HNSW index (`NMSlibTransformer`) to find the
+    kNN of every sample of `data`, by timing both on a probe of `n_probe` samples and extrapolating to the
+    whole data: exact search scales quadratically with the number of samples, and HNSW as n * log(n).
+    Data with at most `n_probe` samples always use exact search.
+    Parameters
+    ----------
+    data: dense array of shape (n_samples, n_features).
+    n_neighbors: number of neighbors to find.
+    metric: distance metric. Metrics without an exact search always select 'hnsw'.
+    n_jobs, M, efC, efS: HNSW parameters (see `NMSlibTransformer`).
+    n_probe: number of samples to time each method on.
+
+    Returns
+    ----------
+    'exact' or 'hnsw'.
+
+    """
+    if metric not in ['euclidean', 'sqeuclidean', 'cosine', 'l1', 'linf']:
+        return 'hnsw'
+    data = np.asarray(data, dtype=np.float32)
+    n_samples = data.shape[0]
+    if n_samples <= n_probe:
+        return 'exact'
+    probe = data[np.random.RandomState(0).choice(n_samples, n_probe, replace=False)]
+    # Exact search: queries of the probe against all samples
+    start = time.time()
+    exact_kneighbors(data, n_neighbors, metric=metric, query=probe)
+    exact_time = (time.time() - start) * n_samples / n_probe
+    # HNSW: index and query the probe only
+    start = time.time()
+    nbrs = NMSlibTransformer(n_neighbors=n_neighbors, metric=metric, n_jobs=n_jobs, M=M, efC=efC, efS=efS,
+                             dense=True).fit(probe)
+    nbrs.kneighbors(probe, n_neighbors=min(n_neighbors, n_probe))
+    hnsw_time = (time.time() - start) * n_samples / n_probe * np.log(max(n_samples, 2)) / np.log(max(n_probe, 2))
+    method = 'exact' if exact_time <= hnsw_time else 'hnsw'
+    if verbose:
+        print('Estimated kNN time: exact=%f (sec), hnsw=%f (sec). Using \'%s\'.' % (exact_time, hnsw_time, method))
+    return method
 
 
 class NMSlibTransformer(TransformerMixin, BaseEstimator):
@@ -81,6 +305,13 @@ class NMSlibTransformer(TransformerMixin, BaseEstimator):
         expense of longer retrieval time. A reasonable range for this parameter is 100-2000.
     dense: bool (optional, default False)
         Whether to force the algorithm to use dense data, such as np.ndarrays and pandas DataFrames.
+    index_path: str (optional, default None)
+        Path to store the constructed index at. If an index built on the same data and with the same
+        parameters is already stored at this path, it is loaded instead of being rebuilt. Indices
+        can also be handled manually with `save_index` and `load_index`.
+    batch_size: int (optional, default 10000)
+        Number of samples queried at once. Query results are written batch by batch into int32/float32
+        output arrays, so that peak memory scales with the batch size rather than with the number of samples.
     Returns
     ---------
     Class for really fast approximate-nearest-neighbors search.
@@ -107,6 +338,10 @@ class NMSlibTransformer(TransformerMixin, BaseEstimator):
     #
     # Test for recall efficiency during approximate nearest neighbors search
     test = nn.test_efficiency(data)
+    #
+    # Store the index and reuse it in a later run
+    nn.save_index('digits.hnsw')
+    nn = NMSlibTransformer().load_index('digits.hnsw')
     """
 
     def __init__(self,
@@ -119,6 +354,8 @@ class NMSlibTransformer(TransformerMixin, BaseEstimator):
                  efC=100,
                  efS=100,
                  dense=False,
+                 index_path=None,
+                 batch_size=10000,
                  verbose=False
                  ):
 
@@ -133,6 +370,8 @@ class NMSlibTransformer(TransformerMixin, BaseEstimator):
         self.space = self.metric
 
         self.dense = dense
+        self.index_path = index_path
+        self.batch_size = batch_size
         self.verbose = verbose
 
     def fit(self, data):
@@ -141,12 +380,10 @@ class NMSlibTransformer(TransformerMixin, BaseEstimator):
         if self.metric == 'lp' and self.p < 1:
             print('Fractional L norms are slower to compute. Computations are faster for fractions'
                   ' of the form \'1/2ek\', where k is a small integer (i.g. 0.5, 0.25) ')
-        if self.dense:
-            self.nmslib_ = nmslib.init(method=self.method,
-                                       space=self.space,
-                                       data_type=nmslib.DataType.DENSE_VECTOR)
-
-        else:
+        self.fingerprint_ = data_fingerprint(data) if self.index_path is not None else None
+        self.n_samples_fit_ = data.shape[0]
+        space_params = None
+        if not self.dense:
             if issparse(data) == True:
                 if self.verbose:
                     print('Sparse input. Proceding without converting...')
@@ -174,20 +411,12 @@ class NMSlibTransformer(TransformerMixin, BaseEstimator):
                     'negdotprod_sparse': 'negdotprod_sparse_fast',
                 }[self.metric]
                 if self.metric == 'lp':
-                    self.nmslib_ = nmslib.init(method=self.method,
-                                               space=self.space,
-                                               space_params={'p': self.p},
-                                               data_type=nmslib.DataType.SPARSE_VECTOR)
-                else:
-                    self.nmslib_ = nmslib.init(method=self.method,
-                                               space=self.space,
-                                               data_type=nmslib.DataType.SPARSE_VECTOR)
+                    space_params = {'p': self.p}
+                data_type = 'SPARSE_VECTOR'
             else:
                 print('Metric ' + self.metric + 'available for string data only. Trying to compute distances...')
                 data = data.toarray()
-                self.nmslib_ = nmslib.init(method=self.method,
-                                           space=self.space,
-                                           data_type=nmslib.DataType.OBJECT_AS_STRING)
+                data_type = 'OBJECT_AS_STRING'
         else:
             self.space = {
                 'sqeuclidean': 'l2',
@@ -204,15 +433,24 @@ class NMSlibTransformer(TransformerMixin, BaseEstimator):
                 'jansen-shan': 'jsmetrfastapprox'
             }[self.metric]
             if self.metric == 'lp':
-                self.nmslib_ = nmslib.init(method=self.method,
-                                           space=self.space,
-                                           space_params={'p': self.p},
-                                           data_type=nmslib.DataType.DENSE_VECTOR)
-            else:
-                self.nmslib_ = nmslib.init(method=self.method,
-                                           space=self.space,
-                                           data_type=nmslib.DataType.DENSE_VECTOR)
+                space_params = {'p': self.p}
+            data_type = 'DENSE_VECTOR'
+        self.data_type_ = data_type
+        self.segments_ = []
+
+        # Reuse a previously saved index if it was built on the same data with the same parameters
+        if self.index_path is not None and os.path.exists(self.index_path + '.json'):
+            with open(self.index_path + '.json') as f:
+                meta = json.load(f)
+            if meta == self._index_metadata():
+                if self.verbose:
+                    print('Loading stored index from ' + self.index_path)
+                return self.load_index(self.index_path)
+            if self.verbose:
+                print('Stored index at ' + self.index_path + ' does not match the input data or parameters. '
+                      'Rebuilding...')
 
+        self.nmslib_ = self._init_index(space_params)
         self.nmslib_.addDataPointBatch(data)
         start = time.time()
         self.nmslib_.createIndex(index_time_params)
@@ -222,36 +460,101 @@ class NMSlibTransformer(TransformerMixin, BaseEstimator):
                   'post:0')
             print('Indexing time = %f (sec)' % (end - start))
 
+        if self.index_path is not None:
+            self.save_index(self.index_path)
+
+        return self
+
+    def _init_index(self, space_params=None):
+        nmslib = _import_nmslib()
+        if space_params is None:
+            return nmslib.init(method=self.method,
+                               space=self.space,
+                               data_type=getattr(nmslib.DataType, self.data_type_))
+        return nmslib.init(method=self.method,
+                           space=self.space,
+                           space_params=space_params,
+                           data_type=getattr(nmslib.DataType, self.data_type_))
+
+    def _index_metadata(self):
+        return {'metric': self.metric,
+                'space': self.space,
+                'method': self.method,
+                'p': self.p,
+                'M': self.M,
+                'efC': self.efC,
+                'data_type': self.data_type_,
+                'n_samples': int(self.n_samples_fit_),
+                'segments': len(self.segments_),
+                'fingerprint': self.fingerprint_}
+
+    def save_index(self, path):
+        """
+        Saves the fitted index (and the indexed data) to disk, so that it can be reloaded with
+        `load_index` instead of being rebuilt. Index parameters and a fingerprint of the indexed
+        data are stored alongside it, at `path + '.json'`.
+        Parameters
+        -----------
+        path: Path to the index file.
+
+        """
+        self.nmslib_.saveIndex(path, save_data=True)
+        for i, segment in enumerate(self.segments_):
+            segment.saveIndex(path + '.segment%d' % i, save_data=True)
+        with open(path + '.json', 'w') as f:
+            json.dump(self._index_metadata(), f)
+        self.index_path = path
+        return self
+
+    def load_index(self, path):
+        """
+        Loads an index previously stored with `save_index`, restoring the space, method and
+        construction parameters it was built with. The index can be queried right away.
+        Parameters
+        -----------
+        path: Path to the index file.
+
+        """
+        with open(path + '.json') as f:
+            meta = json.load(f)
+        self.metric = meta['metric']
+        self.space = meta['space']
+        self.method = meta['method']
+        self.p = meta['p']
+        self.M = meta['M']
+        self.efC = meta['efC']
+        self.data_type_ = meta['data_type']
+        self.n_samples_fit_ = meta['n_samples']
+        self.fingerprint_ = meta['fingerprint']
+        space_params = {'p': self.p} if self.metric == 'lp' else None
+        start = time.time()
+        self.nmslib_ = self._init_index(space_params)
+        self.nmslib_.loadIndex(path, load_data=True)
+        self.segments_ = []
+        for i in range(meta.get('segments', 0)):
+            segment = self._init_index(space_params)
+            segment.loadIndex(path + '.segment%d' % i, load_data=True)
+            self.segments_.append(segment)
+        end = time.time()
+        if self.verbose:
+            print('Index loading time = %f (sec)' % (end - start))
+        self.index_path = path
         return self
 
     def transform(self, data):
         start = time.time()
-        n_samples_transform = data.shape[0]
-        query_time_params = {'efSearch': self.efS}
         if self.verbose:
             print('Query-time parameter efSearch:', self.efS)
-        self.nmslib_.setQueryTimeParams(query_time_params)
 
         # For compatibility reasons, as each sample is considered as its own
         # neighbor, one extra neighbor will be computed.
         self.n_neighbors = self.n_neighbors + 1
 
-        results = self.nmslib_.knnQueryBatch(data, k=self.n_neighbors,
-                                             num_threads=self.n_jobs)
-
-        indices, distances = zip(*results)
-        indices, distances = np.vstack(indices), np.vstack(distances)
+        indices, distances = self.kneighbors(data)
 
         query_qty = data.shape[0]
 
-        if self.metric == 'sqeuclidean':
-            distances **= 2
-
-        indptr = np.arange(0, n_samples_transform * self.n_neighbors + 1,
-                           self.n_neighbors)
-        kneighbors_graph = csr_matrix((distances.ravel(), indices.ravel(),
-                                       indptr), shape=(n_samples_transform,
-                                                       n_samples_transform))
+        kneighbors_graph = knn_to_csr(indices, distances, self.n_samples_fit_)
         end = time.time()
         if self.verbose:
             print('kNN time total=%f (sec), per query=%f (sec), per query adjusted for thread number=%f (sec)' %
@@ -259,69 +562,188 @@ class NMSlibTransformer(TransformerMixin, BaseEstimator):
 
         return kneighbors_graph
 
+    def iter_kneighbors(self, data, n_neighbors=None, batch_size=None, indices=None, distances=None):
+        """
+        Queries the fitted index batch by batch, writing each batch of results into the output arrays.
+        Parameters
+        -----------
+        data: query data, of the same type as the indexed data.
+        n_neighbors: number of neighbors to look for. Defaults to `n_neighbors`.
+        batch_size: number of samples per batch. Defaults to `batch_size`.
+        indices, distances: optional preallocated (e.g. memory-mapped) output arrays of shape
+        (n_queries, n_neighbors). Allocated as int32 and float32 arrays if not given. Neighbors that
+        could not be found are set to -1, at an infinite distance.
+
+        Yields
+        -----------
+        (start, stop, indices[start:stop], distances[start:stop]) for each batch, once it is written.
+
+        """
+        if n_neighbors is None:
+            n_neighbors = self.n_neighbors
+        if batch_size is None:
+            batch_size = self.batch_size
+        n_queries = data.shape[0]
+        if indices is None:
+            indices = np.empty((n_queries, n_neighbors), dtype=np.int32)
+        if distances is None:
+            distances = np.empty((n_queries, n_neighbors), dtype=np.float32)
+        for index in [self.nmslib_] + self.segments_:
+            index.setQueryTimeParams({'efSearch': self.efS})
+        for start in range(0, n_queries, batch_size):
+            stop = min(start + batch_size, n_queries)
+            ind, dist = indices[start:stop], distances[start:stop]
+            self._query_batch(self.nmslib_, data[start:stop], ind, dist)
+            if self.segments_:
+                # Merge the neighbors found in each index segment
+                cand_ind, cand_dist = [ind.copy()], [dist.copy()]
+                for segment in self.segments_:
+                    seg_ind = np.empty((stop - start, min(n_neighbors, len(segment))), dtype=np.int32)
+                    seg_dist = np.empty(seg_ind.shape, dtype=np.float32)
+                    self._query_batch(segment, data[start:stop], seg_ind, seg_dist)
+                    cand_ind.append(seg_ind)
+                    cand_dist.append(seg_dist)
+                cand_ind, cand_dist = np.hstack(cand_ind), np.hstack(cand_dist)
+                order = np.argsort(cand_dist, axis=1, kind='stable')[:, :n_neighbors]
+                ind[:] = np.take_along_axis(cand_ind, order, axis=1)
+                dist[:] = np.take_along_axis(cand_dist, order, axis=1)
+            if self.metric == 'sqeuclidean':
+                dist **= 2
+            yield start, stop, ind, dist
+
+    def _query_batch(self, index, data, ind, dist):
+        # Writes the neighbors of each sample of `data` found in `index` into `ind` and `dist`
+        n_neighbors = ind.shape[1]
+        results = index.knnQueryBatch(data, k=n_neighbors, num_threads=self.n_jobs)
+        for row, (row_ind, row_dist) in enumerate(results):
+            found = row_ind.shape[0]
+            ind[row, :found] = row_ind
+            dist[row, :found] = row_dist
+            if found < n_neighbors:
+                ind[row, found:] = -1
+                dist[row, found:] = np.inf
+
+    def partial_fit(self, data):
+        """
+        Adds new samples to the fitted index, numbered after the samples already indexed (i.e. the
+        first new sample gets id `n_samples_fit_`). NMSlib cannot insert points into an HNSW graph
+        once it is built, so new samples are indexed in a separate (small) segment instead of
+        rebuilding the whole index, and queries merge the neighbors found in every segment.
+        Query time grows with the number of segments: fitting again on all the data consolidates them.
+        Parameters
+        -----------
+        data: new samples, of the same type as the indexed data.
+
+        """
+        if self.data_type_ == 'SPARSE_VECTOR':
+            data = csr_matrix(data)
+        space_params = {'p': self.p} if self.metric == 'lp' else None
+        segment = self._init_index(space_params)
+        segment.addDataPointBatch(data, np.arange(self.n_samples_fit_, self.n_samples_fit_ + data.shape[0]))
+        start = time.time()
+        segment.createIndex({'M': self.M, 'indexThreadQty': self.n_jobs, 'efConstruction': self.efC, 'post': 2})
+        end = time.time()
+        if self.verbose:
+            print('Indexed %d new samples in %f (sec)' % (data.shape[0], end - start))
+        self.segments_.append(segment)
+        self.n_samples_fit_ += data.shape[0]
+        self.fingerprint_ = None
+        return self
+
+    def update_kneighbors(self, indices, distances, data):
+        """
+        Extends kNN arrays of the previously indexed samples to samples just added with `partial_fit`.
+        New samples are queried against the whole index. Previous samples are not queried again: the
+        row of a previous sample is only updated with the new samples that list it among their own
+        neighbors and are closer than its farthest neighbor. This is approximate, as the kNN relation
+        is not symmetric. A previous sample can keep a stale row when a new sample is among its true
+        nearest neighbors but does not list it back (e.g. new samples falling in a dense region next
+        to sparser previous samples). Refit the index and query it again when exact neighbors are needed.
+        Parameters
+        -----------
+        indices, distances: kNN arrays of shape (n_previous, n_neighbors) of the previously indexed samples.
+        data: the samples added with the last `partial_fit` call.
+
+        Returns
+        -----------
+        indices and distances arrays of shape (n_previous + n_new, n_neighbors), and the ids of
+        previous samples whose rows changed.
+
+        """
+        n_prev, n_neighbors = indices.shape
+        new_ind, new_dist = self.kneighbors(data, n_neighbors=n_neighbors)
+        ind = np.concatenate([indices, new_ind]).astype(np.int32, copy=False)
+        dist = np.concatenate([distances, new_dist]).astype(np.float32, copy=False)
+        # (previous sample, new sample, distance) candidates
+        found = (new_ind >= 0) & (new_ind < n_prev)
+        js = new_ind[found]
+        xs = np.broadcast_to(np.arange(n_prev, n_prev + new_ind.shape[0])[:, None], new_ind.shape)[found]
+        ds = new_dist[found]
+        closer = ds < distances[js].max(axis=1)
+        js, xs, ds = js[closer], xs[closer], ds[closer]
+        if js.size == 0:
+            return ind, dist, js
+        order = np.lexsort((ds, js))
+        js, xs, ds = js[order], xs[order], ds[order]
+        affected, first, counts = np.unique(js, return_index=True, return_counts=True)
+        row = np.repeat(np.arange(affected.shape[0]), counts)
+        rank = np.arange(js.shape[0]) - np.repeat(first, counts)
+        cand_ind = np.full((affected.shape[0], counts.max()), -1, dtype=np.int32)
+        cand_dist = np.full(cand_ind.shape, np.inf, dtype=np.float32)
+        cand_ind[row, rank] = xs
+        cand_dist[row, rank] = ds
+        cand_ind = np.hstack([ind[affected], cand_ind])
+        cand_dist = np.hstack([dist[affected], cand_dist])
+        order = np.argsort(cand_dist, axis=1, kind='stable')[:, :n_neighbors]
+        ind[affected] = np.take_along_axis(cand_ind, order, axis=1)
+        dist[affected] = np.take_along_axis(cand_dist, order, axis=1)
+        return ind, dist, affected
+
+    def kneighbors(self, data, n_neighbors=None, batch_size=None, memmap_path=None):
+        """
+        Queries the fitted index for the nearest neighbors of each sample in `data`.
+        Parameters
+        -----------
+        data: query data, of the same type as the indexed data.
+        n_neighbors: number of neighbors to look for. Defaults to `n_neighbors`.
+        batch_size: number of samples queried at once. Defaults to `batch_size`.
+        memmap_path: optional path prefix. If given, results are written to memory-mapped
+        `.npy` files at `memmap_path + '_indices.npy'` and `memmap_path + '_distances.npy'`.
+
+        Returns
+        -----------
+        indices (int32) and distances (float32) arrays of shape (n_queries, n_neighbors).
+
+        """
+        if n_neighbors is None:
+            n_neighbors = self.n_neighbors
+        shape = (data.shape[0], n_neighbors)
+        if memmap_path is not None:
+            indices = np.lib.format.open_memmap(memmap_path + '_indices.npy', mode='w+', dtype=np.int32, shape=shape)
+            distances = np.lib.format.open_memmap(memmap_path + '_distances.npy', mode='w+', dtype=np.float32,
+                                                  shape=shape)
+        else:
+            indices = np.empty(shape, dtype=np.int32)
+            distances = np.empty(shape, dtype=np.float32)
+        for _ in self.iter_kneighbors(data, n_neighbors, batch_size, indices, distances):
+            pass
+        return indices, distances
+
     def ind_dist_grad(self, data, return_grad=True, return_graph=True):
 
         start = time.time()
-        n_samples_transform = data.shape[0]
-        query_time_params = {'efSearch': self.efS}
         if self.verbose:
             print('Query-time parameter efSearch:', self.efS)
-        self.nmslib_.setQueryTimeParams(query_time_params)
         # For compatibility reasons, as each sample is considered as its own
         # neighbor, one extra neighbor will be computed.
         self.n_neighbors = self.n_neighbors + 1
-        results = self.nmslib_.knnQueryBatch(data, k=self.n_neighbors,
-                                             num_threads=self.n_jobs)
-        indices, distances = zip(*results)
-        indices, distances = np.vstack(indices), np.vstack(distances)
+        indices, distances = self.kneighbors(data)
 
         query_qty = data.shape[0]
 
-        if self.metric == 'sqeuclidean':
-            distances **= 2
-
-        indptr = np.arange(0, n_samples_transform * self.n_neighbors + 1,
-                           self.n_neighbors)
-        kneighbors_graph = csr_matrix((distances.ravel(), indices.ravel(),
-                                       indptr), shape=(n_samples_transform,
-                                                       n_samples_transform))
+        kneighbors_graph = knn_to_csr(indices, distances, self.n_samples_fit_)
         if return_grad:
-            x, y, dists = find(kneighbors_graph)
-
-            # Define gradients
-            grad = []
-            if self.metric not in ['sqeuclidean', 'euclidean', 'cosine', 'linf']:
-                print('Gradient undefined for metric \'' + self.metric + '\'. Returning empty array.')
-
-            if self.metric == 'cosine':
-                norm_x = 0.0
-                norm_y = 0.0
-                for i in range(x.shape[0]):
-                    norm_x += x[i] ** 2
-                    norm_y += y[i] ** 2
-                if norm_x == 0.0 and norm_y == 0.0:
-                    grad = np.zeros(x.shape)
-                elif norm_x == 0.0 or norm_y == 0.0:
-                    grad = np.zeros(x.shape)
-                else:
-                    grad = -(x * dists - y * norm_x) / np.sqrt(norm_x ** 3 * norm_y)
-
-            if self.metric == 'euclidean':
-                grad = x - y / (1e-6 + np.sqrt(dists))
-
-            if self.metric == 'sqeuclidean':
-                grad = x - y / (1e-6 + dists)
-
-            if self.metric == 'linf':
-                result = 0.0
-                max_i = 0
-                for i in range(x.shape[0]):
-                    v = np.abs(x[i] - y[i])
-                    if v > result:
-                        result = dists
-                        max_i = i
-                grad = np.zeros(x.shape)
-                grad[max_i] = np.sign(x[max_i] - y[max_i])
+            grad = knn_gradient(kneighbors_graph, self.metric)
 
         end = time.time()
 
@@ -0,0 +1,267 @@
+"""Barnes-Hut approximation of the repulsive forces of the euclidean layout optimization.
+
+Instead of sampling random tail vertices, each epoch builds a quadtree (2-D) or octree (3-D) of the tail embedding,
+and repels every head vertex from the centres of mass of the cells that are far enough from it. The repulsion of a
+vertex is the expected value of the negative-sampling updates it would receive in that epoch.
+"""
+import numpy as np
+import numba
+
+from .umap_layouts import clip, _compile_kernel
+
+
+@numba.njit(cache=True)
+def _build_tree(points, weights, max_nodes, max_depth):
+    n_points, dim = points.shape
+    n_children = 1 << dim
+    children = np.full((max_nodes, n_children), -1, dtype=np.int64)
+    centers = np.zeros((max_nodes, dim), dtype=np.float64)
+    half_widths = np.zeros(max_nodes, dtype=np.float64)
+    mass = np.zeros(max_nodes, dtype=np.float64)
+    com = np.zeros((max_nodes, dim), dtype=np.float64)
+    leaf_point = np.full(max_nodes, -1, dtype=np.int64)
+    is_leaf = np.ones(max_nodes, dtype=np.bool_)
+
+    # The root cell is the bounding square (cube) of the points, slightly enlarged to hold the points on its faces
+    width = 0.0
+    for d in range(dim):
+        lo = points[:, d].min()
+        hi = points[:, d].max()
+        centers[0, d] = 0.5 * (lo + hi)
+        width = max(width, 0.5 * (hi - lo))
+    half_widths[0] = width * (1.0 + 1e-5) + 1e-8
+    n_nodes = 1
+
+    for p in range(n_points):
+        node = 0
+        depth = 0
+        while True:
+            if is_leaf[node]:
+                # Empty leaves take the point; leaves at the depth limit (coincident points) hold several
+                if leaf_point[node] == -1 or depth >= max_depth:
+                    if leaf_point[node] == -1:
+                        leaf_point[node] = p
+                    mass[node] += weights[p]
+                    for d in range(dim):
+                        com[node, d] += weights[p] * points[p, d]
+                    break
+                # Split the leaf: its point moves down into a child
+                if n_nodes >= max_nodes:
+                    return -1, children, centers, half_widths, mass, com, is_leaf
+                q = leaf_point[node]
+                c = 0
+                for d in range(dim):
+                    if points[q, d] > centers[node, d]:
+                        c |= 1 << d
+                child = n_nodes
+                n_nodes += 1
+                half_widths[child] = 0.5 * half_widths[node]
+                for d in range(dim):
+                    if c & (1 << d):
+                        centers[child, d] = centers[node, d] + half_widths[child]
+                    else:
+                        centers[child, d] = centers[node, d] - half_widths[child]
+                    com[child, d] = weights[q] * points[q, d]
+                mass[child] = weights[q]
+                leaf_point[child] = q
+                children[node, c] = child
+                leaf_point[node] = -1
+                is_leaf[node] = False
+
+            mass[node] += weights[p]
+            for d in range(dim):
+                com[node, d] += weights[p] * points[p, d]
+            c = 0
+            for d in range(dim):
+                if points[p, d] > centers[node, d]:
+                    c |= 1 << d
+            child = children[node, c]
+            if child == -1:
+                if n_nodes >= max_nodes:
+                    return -1, children, centers, half_widths, mass, com, is_leaf
+                child = n_nodes
+                n_nodes += 1
+                half_widths[child] = 0.5 * half_widths[node]
+                for d in range(dim):
+                    if c & (1 << d):
+                        centers[child, d] = centers[node, d] + half_widths[child]
+                    else:
+                        centers[child, d] = centers[node, d] - half_widths[child]
+                children[node, c] = child
+            node = child
+            depth += 1
+
+    for i in range(n_nodes):
+        if is_leaf[i] and leaf_point[i] >= 0:
+            # Exact position of the point (up to the depth limit), so that a point is at distance 0 of its own leaf
+            for d in range(dim):
+                com[i, d] = points[leaf_point[i], d]
+        elif mass[i] > 0:
+            for d in range(dim):
+                com[i, d] /= mass[i]
+    return n_nodes, children, centers, half_widths, mass, com, is_leaf
+
+
+def _morton_order(points, bits=16):
+    # Sorts points along a Z-order curve, the order in which a depth-first traversal of the tree visits them
+    lo = points.min(axis=0)
+    span = max(float((points.max(axis=0) - lo).max()), 1e-8)
+    grid = ((points - lo) * ((2 ** bits - 1) / span)).astype(np.uint64)
+    codes = np.zeros(points.shape[0], dtype=np.uint64)
+    for bit in range(bits):
+        for d in range(points.shape[1]):
+            codes |= ((grid[:, d] >> np.uint64(bit)) & np.uint64(1)) << np.uint64(bit * points.shape[1] + d)
+    return np.argsort(codes, kind='stable')
+
+
+def build_tree(points, weights=None, max_depth=32):
+    """Build the quadtree (2-D) or octree (3-D) of an embedding.
+    Parameters
+    ----------
+    points: array of shape (n_samples, n_components)
+        The embedding.
+    weights: array of shape (n_samples,) (optional, default None)
+        Positive mass of each point. If None, every point weighs 1.
+    max_depth: int (optional, default 32)
+        Depth beyond which cells are not split. Coincident points share a leaf at this depth.
+    Returns
+    -------
+    children: array of shape (n_nodes, 2 ** n_components)
+        The child cells of each cell, -1 where there is none. The root is cell 0.
+    half_widths: array of shape (n_nodes,)
+        Half the side length of each cell.
+    mass: array of shape (n_nodes,)
+        The total weight of the points in each cell.
+    com: array of shape (n_nodes, n_components)
+        The centre of mass of each cell.
+    is_leaf: array of shape (n_nodes,)
+        Whether each cell is a leaf.
+    """
+    if weights is None:
+        weights = np.ones(points.shape[0], dtype=np.float64)
+    max_nodes = 4 * points.shape[0] + 1
+    while True:
+        n_nodes, children, centers, half_widths, mass, com, is_leaf = _build_tree(points, weights, max_nodes,
+                                                                                  max_depth)
+        if n_nodes >= 0:
+            return (children[:n_nodes], half_widths[:n_nodes], mass[:n_nodes], com[:n_nodes],
+                    is_leaf[:n_nodes])
+        max_nodes *= 2
+
+
+def _repel(
+    head_embedding,
+    order,
+    rates,
+    children,
+    half_widths,
+    mass,
+    com,
+    is_leaf,
+    a,
+    b,
+    gamma,
+    theta,
+    n_vertices,
+    alpha,
+    max_stack,
+):
+    dim = head_embedding.shape[1]
+    n_children = children.shape[1]
+    theta_sq = theta * theta
+
+    for i in numba.prange(order.shape[0]):
+        j = order[i]
+        if rates[j] <= 0.0:
+            continue
+        current = head_embedding[j]
+        force = np.zeros(dim, dtype=np.float64)
+        stack = np.empty(max_stack, dtype=np.int64)
+        stack[0] = 0
+        top = 1
+        while top > 0:
+            top -= 1
+            node = stack[top]
+            if mass[node] == 0:
+                continue
+            dist_squared = 0.0
+            for d in range(dim):
+                diff = current[d] - com[node, d]
+                dist_squared += diff * diff
+            width = 2.0 * half_widths[node]
+            if is_leaf[node] or width * width < theta_sq * dist_squared:
+                # Leaves holding the vertex itself (and coincident vertices) are at distance 0 and skipped
+                if dist_squared > 0.0:
+                    grad_coeff = 2.0 * gamma * b
+                    grad_coeff /= (0.001 + dist_squared) * (a * pow(dist_squared, b) + 1)
+                    for d in range(dim):
+                        force[d] += mass[node] * clip(grad_coeff * (current[d] - com[node, d]))
+            else:
+                for c in range(n_children):
+                    if children[node, c] >= 0:
+                        stack[top] = children[node, c]
+                        top += 1
+
+        # `rates[j]` negative samples drawn uniformly from the tail vertices move the vertex by the mean force each.
+        # Their sum is a single step, clipped like any other gradient step of the layout.
+        for d in range(dim):
+            current[d] += alpha * clip(rates[j] * force[d] / n_vertices)
+
+
+_repel_serial = _compile_kernel(_repel, parallel=False)
+_repel_parallel = _compile_kernel(_repel, parallel=True)
+
+
+def repel(
+    head_embedding,
+    tail_embedding,
+    rates,
+    a,
+    b,
+    gamma,
+    alpha,
+    n_vertices,
+    theta=0.5,
+    max_depth=32,
+    parallel=False,
+):
+    """Apply one epoch of Barnes-Hut repulsion to an embedding, in place.
+    Parameters
+    ----------
+    head_embedding: array of shape (n_samples, n_components)
+        The embedding being optimized.
+    tail_embedding: array of shape (source_samples, n_components)
+        The embedding the head vertices are repelled from.
+    rates: array of shape (n_samples,)
+        The number of negative samples each head vertex would draw in the epoch.
+    a: float
+        Parameter of differentiable approximation of right adjoint functor
+    b: float
+        Parameter of differentiable approximation of right adjoint functor
+    gamma: float
+        Weight to apply to negative samples.
+    alpha: float
+        The learning rate of the epoch.
+    n_vertices: int
+        The number of vertices the negative samples are drawn from.
+    theta: float (optional, default 0.5)
+        Opening angle: cells whose side over distance is below ``theta`` act as a single point. Smaller values
+        are more accurate and slower; 0 computes all pairwise forces.
+    max_depth: int (optional, default 32)
+        Depth beyond which cells are not split.
+    parallel: bool (optional, default False)
+        Whether to compute the forces using numba parallel. Forces are computed from the tree, so that
+        the result is deterministic either way.
+    """
+    # Building the tree from, and visiting, the points in Z-order keeps nearby cells close in memory, and
+    # consecutive points walk through mostly the same cells
+    order = _morton_order(tail_embedding)
+    children, half_widths, mass, com, is_leaf = build_tree(tail_embedding[order], max_depth=max_depth)
+    if head_embedding is not tail_embedding:
+        order = _morton_order(head_embedding)
+    # A depth-first traversal holds at most (2 ** dim - 1) cells per level, plus the one being expanded
+    max_stack = (max_depth + 1) * children.shape[1] + 1
+    repel_fn = _repel_parallel if parallel else _repel_serial
+    repel_fn(head_embedding, order, rates, children, half_widths, mass, com, is_leaf, a, b, gamma, theta,
+             n_vertices, alpha, max_stack)
+    return head_embedding
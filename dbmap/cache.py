@@ -0,0 +1,190 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import numpy as np
+from scipy.sparse import csr_matrix, issparse
+
+
+def artifact_key(parent_key, stage, params):
+    """
+    Content-addressed key of a pipeline stage artifact.
+    Parameters
+    -----------
+    parent_key: fingerprint of the input data (see `ann.data_fingerprint`), or the key of the upstream stage.
+    stage: name of the stage.
+    params: JSON-serializable dictionary with the parameters of the stage.
+
+    Returns
+    -----------
+    A hexadecimal sha1 digest.
+
+    """
+    return hashlib.sha1(json.dumps([parent_key, stage, params], sort_keys=True).encode()).hexdigest()
+
+
+def save_checkpoint(path, **state):
+    """
+    Snapshots the state of an optimization (arrays and scalars) to the `.npz` file `path`. The file is written next
+    to `path` then moved in place, so that an interruption while saving leaves the previous snapshot intact.
+
+    """
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez(f, **state)
+    os.replace(tmp, path)
+
+
+def load_checkpoint(path, **expected):
+    """
+    Loads a snapshot written by `save_checkpoint`.
+    Parameters
+    -----------
+    path: the `.npz` file of the snapshot, or None.
+    expected: values that the snapshot must hold, which identify the optimization (e.g. its number of samples,
+              its number of epochs and the fingerprint of its input, see `ann.data_fingerprint`). An exception is
+              raised if they do not match, rather than resuming a different problem.
+
+    Returns
+    -----------
+    A dictionary of the stored arrays and scalars, or None if `path` is None or does not exist.
+
+    """
+    if path is None or not os.path.exists(path):
+        return None
+    with np.load(path) as f:
+        state = {name: f[name] for name in f.files}
+    for name, value in expected.items():
+        if name not in state or not np.array_equal(state[name], value):
+            raise Exception('The checkpoint %s does not match this optimization (%s differs). Remove it to '
+                            'start over.' % (path, name))
+    return state
+
+
+class ArtifactCache(object):
+    """
+    On-disk store of pipeline artifacts, addressed by `artifact_key`. Each entry is a directory holding
+    one `.npy` file per array (CSR matrices are stored as their `data`, `indices` and `indptr` arrays) and a
+    `meta.json` file describing them. Arrays are loaded memory-mapped, so that reading an entry does not copy it
+    into memory. When the cache grows beyond `max_bytes`, the least recently used entries are evicted.
+
+    Parameters
+    ----------
+    path: directory of the cache. Created if it does not exist.
+
+    max_bytes: maximum size of the cache, in bytes. Defaults to None (unbounded).
+
+    Example
+    -------------
+
+    import numpy as np
+    from dbmap.cache import ArtifactCache, artifact_key
+
+    cache = ArtifactCache('dbmap_cache', max_bytes=2 ** 30)
+    key = artifact_key('data-fingerprint', 'knn', {'n_neighbors': 10})
+    cache.save(key, {'indices': np.zeros((100, 10), dtype=np.int32)})
+    cache.load(key)['indices']
+
+    """
+
+    def __init__(self, path, max_bytes=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(self.path, exist_ok=True)
+
+    def entry_dir(self, key):
+        return os.path.join(self.path, key)
+
+    def __contains__(self, key):
+        return os.path.exists(os.path.join(self.entry_dir(key), 'meta.json'))
+
+    def load(self, key):
+        """
+        Loads an entry, marking it as recently used.
+        Returns a dictionary of memory-mapped arrays, CSR matrices and scalars, or None if the entry is not cached.
+
+        """
+        entry = self.entry_dir(key)
+        try:
+            with open(os.path.join(entry, 'meta.json')) as f:
+                meta = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        artifacts = dict(meta['scalars'])
+        for name in meta['arrays']:
+            artifacts[name] = np.load(os.path.join(entry, name + '.npy'), mmap_mode='r')
+        for name, shape in meta['sparse'].items():
+            data, indices, indptr = [np.load(os.path.join(entry, name + '.' + part + '.npy'), mmap_mode='r')
+                                     for part in ('data', 'indices', 'indptr')]
+            artifacts[name] = csr_matrix((data, indices, indptr), shape=tuple(shape), copy=False)
+        now = time.time()
+        os.utime(entry, (now, now))
+        return artifacts
+
+    def save(self, key, artifacts):
+        """
+        Stores a dictionary of arrays, sparse matrices and scalars under `key`, then evicts the least recently
+        used entries if the cache is over its size bound. Entries are written to a temporary directory first,
+        so concurrent readers never see partial entries.
+
+        """
+        tmp = os.path.join(self.path, '.tmp-%s-%d' % (key, os.getpid()))
+        os.makedirs(tmp, exist_ok=True)
+        meta = {'arrays': [], 'sparse': {}, 'scalars': {}}
+        for name, value in artifacts.items():
+            if value is None:
+                continue
+            if issparse(value):
+                value = csr_matrix(value)
+                for part in ('data', 'indices', 'indptr'):
+                    np.save(os.path.join(tmp, name + '.' + part + '.npy'), getattr(value, part))
+                meta['sparse'][name] = list(value.shape)
+            elif np.ndim(value) == 0:
+                meta['scalars'][name] = value.item() if isinstance(value, np.generic) else value
+            else:
+                np.save(os.path.join(tmp, name + '.npy'), np.asarray(value))
+                meta['arrays'].append(name)
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        entry = self.entry_dir(key)
+        if os.path.exists(entry):
+            shutil.rmtree(entry, ignore_errors=True)
+        try:
+            os.replace(tmp, entry)
+        except OSError:
+            # Written concurrently by another process
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict(keep=key)
+        return entry
+
+    def entry_size(self, key):
+        entry = self.entry_dir(key)
+        return sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+
+    def evict(self, keep=None):
+        """
+        Removes the least recently used entries until the cache fits in `max_bytes`. The entry `keep` is never
+        removed.
+
+        """
+        if self.max_bytes is None:
+            return
+        entries = []
+        for key in os.listdir(self.path):
+            entry = self.entry_dir(key)
+            if key.startswith('.') or not os.path.isdir(entry):
+                continue
+            entries.append((os.path.getmtime(entry), self.entry_size(key), key))
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        for key in os.listdir(self.path):
+            shutil.rmtree(self.entry_dir(key), ignore_errors=True)
@@ -4,20 +4,112 @@
 # contact: davisidarta@fcm.unicamp.com
 # License: GNU GLP-v2
 ######################################
+import os
 import time
+import shutil
+import tempfile
+import weakref
+import numba
 import numpy as np
 import pandas as pd
-from scipy import stats
+from numpy.lib.format import open_memmap
 from scipy.sparse import csr_matrix, find, issparse
-from scipy.sparse.linalg import eigs
+from scipy.sparse.linalg import eigs, eigsh, lobpcg, LinearOperator
 from sklearn.base import TransformerMixin
 from sklearn.neighbors import NearestNeighbors
-from sklearn.preprocessing import normalize
+from sklearn.utils import check_random_state
 from . import ann
 from . import multiscale
 
 
-print(__doc__)
+@numba.njit(parallel=True)
+def _csr_kth_smallest(indptr, data, kth):
+    out = np.zeros(indptr.shape[0] - 1, dtype=data.dtype)
+    for i in numba.prange(indptr.shape[0] - 1):
+        row = np.sort(data[indptr[i]:indptr[i + 1]])
+        if row.shape[0] > 0:
+            k = kth[i]
+            if k < 0:
+                k += row.shape[0]
+            out[i] = row[min(max(k, 0), row.shape[0] - 1)]
+    return out
+
+
+def kth_neighbor_distance(knn, kth):
+    """Returns the distance of each sample to its kth nearest neighbor (0-indexed) on a kNN graph.
+    :param knn: kNN distance graph (scipy csr matrix).
+    :param kth: integer, or array with one integer per sample.
+    :return: array of shape (n_samples,).
+    If every row of `knn` holds the same number of neighbors (as with the NMSlibTransformer output),
+    distances are selected on the rectangular kNN block at once. Ragged graphs are handled row by row
+    with a parallel numba kernel.
+    """
+    n = knn.shape[0]
+    row_nnz = np.diff(knn.indptr)
+    kth = np.asarray(kth)
+    if n > 0 and row_nnz.min() == row_nnz.max() and row_nnz[0] > 0:
+        block = knn.data.reshape(n, row_nnz[0])
+        if kth.ndim == 0:
+            return np.partition(block, int(kth), axis=1)[:, int(kth)]
+        kth = np.clip(np.where(kth < 0, kth + row_nnz[0], kth), 0, row_nnz[0] - 1)
+        return np.take_along_axis(np.sort(block, axis=1), kth[:, None], axis=1).ravel()
+    kth = np.broadcast_to(kth, (n,)).astype(np.int64)
+    return _csr_kth_smallest(knn.indptr, knn.data, kth)
+
+
+def _first_k_neighbors(knn, k):
+    # Keeps the k nearest neighbors of each row of a kNN graph holding the same number of neighbors per row.
+    n = knn.shape[0]
+    width = knn.indptr[1] - knn.indptr[0]
+    dists = knn.data.reshape(n, width)
+    inds = knn.indices.reshape(n, width)
+    order = np.argsort(dists, axis=1, kind='stable')[:, :k]
+    return ann.knn_to_csr(np.take_along_axis(inds, order, axis=1),
+                          np.take_along_axis(dists, order, axis=1), knn.shape[1])
+
+
+def randomized_eigsh(A, k, n_oversamples=None, n_iter=20, X0=None, random_state=None):
+    """Approximates the k largest eigenpairs of a symmetric operator with randomized subspace iteration.
+    The leading eigenpairs converge first. With the defaults, eigenvalues of diffusion operators typically have
+    relative errors below 1e-3, and the trailing ones are the least accurate. Increase `n_iter` or `n_oversamples`
+    for more accuracy.
+    :param A: symmetric sparse matrix or linear operator of shape (n, n).
+    :param k: number of eigenpairs to compute.
+    :param n_oversamples: number of extra vectors in the iterated subspace. Defaults to max(k, 10).
+    :param n_iter: number of power iterations.
+    :param X0: optional array of shape (n, m) used as the first m vectors of the starting subspace.
+    :param random_state: seed or numpy RandomState of the random starting subspace.
+    :return: eigenvalues (k,) and eigenvectors (n, k), in descending order of eigenvalue.
+    """
+    n = A.shape[0]
+    if n_oversamples is None:
+        n_oversamples = max(k, 10)
+    random_state = check_random_state(random_state)
+    Q = random_state.normal(size=(n, min(n, k + n_oversamples))).astype(A.dtype)
+    if X0 is not None:
+        m = min(X0.shape[1], Q.shape[1])
+        Q[:, :m] = X0[:, :m]
+    Q, _ = np.linalg.qr(Q)
+    for _ in range(n_iter):
+        Q, _ = np.linalg.qr(A @ Q)
+    w, U = np.linalg.eigh(Q.T @ (A @ Q))
+    inds = np.argsort(w)[::-1][:k]
+    return w[inds], Q @ U[:, inds]
+
+
+def _write_npy(path, shape, dtype, fill, batch_size=65536):
+    # Writes an array to a .npy file in row blocks, with fill(out, start, stop) writing rows start:stop into out.
+    # The file is written next to `path` then moved in place, so that arrays mapped from a previous version
+    # of the file stay valid. Returns the array memory-mapped read-only.
+    tmp = path + '.tmp'
+    out = open_memmap(tmp, mode='w+', dtype=dtype, shape=shape)
+    for start in range(0, shape[0], batch_size):
+        stop = min(start + batch_size, shape[0])
+        fill(out[start:stop], start, stop)
+    out.flush()
+    del out
+    os.replace(tmp, path)
+    return np.load(path, mmap_mode='r')
 
 
 class Diffusor(TransformerMixin):
@@ -60,6 +152,46 @@ class Diffusor(TransformerMixin):
                 Those, followed by '_adaptive', apply the neighborhood expansion process. The default and recommended is 'decay_adaptive'.
                 The neighborhood expansion can impact runtime, although this is not usually expressive for datasets under 10e6 samples.
 
+    eigengap : Whether to expand the decomposition beyond `n_components` until at least 3 negative eigenvalues are
+               found, doubling the number of components up to `n_components` times the number of samples in units
+               of 10e4. In any case, decompositions with more than 30 negative eigenvalues are trimmed to the positive
+               components plus 15. Up to version 1.2.0.4, eigenvector entries were counted instead of eigenvalues:
+               the expansion never ran, and any `n_components` above 30 returned `n_components` + 15 components.
+
+    eigen_solver : Which eigensolver to use for the decomposition of the diffusion operator. Defaults to 'arpack'.
+
+                - 'arpack' calls ARPACK on the (non-symmetric) diffusion operator with `scipy.sparse.linalg.eigs`,
+                for the eigenvalues of largest real part, as the other solvers. Up to version 1.2.0.4 it asked for
+                those of largest magnitude, which also selects eigenvalues close to -1.
+
+                - 'eigsh' calls ARPACK on the symmetric conjugate D^{1/2} T D^{-1/2} of the diffusion operator, which has
+                the same eigenvalues, with `scipy.sparse.linalg.eigsh`. This is usually much faster.
+
+                - 'lobpcg' uses LOBPCG on the symmetric conjugate. Can be warm-started from a block of vectors.
+
+                - 'randomized' uses randomized subspace iteration on the symmetric conjugate. Fast, but approximate:
+                relative errors of eigenvalues are typically below 1e-3, the trailing ones being the least accurate
+                (see `randomized_eigsh`).
+
+    dtype : Floating point precision of the kernel, the diffusion operator and the eigendecomposition, either
+            'float64' (default) or 'float32'. The kNN distances are single precision already, and 'float32'
+            halves the memory used by the largest matrices at a small cost in accuracy
+            (see benchmarks/bench_diffusion_dtype.py).
+
+    t : Diffusion time of the multiscaled components. Defaults to None, which scales each component by
+        lambda / (1 - lambda), summing over all diffusion times. Otherwise, components are scaled by lambda ** t.
+
+    memmap_path : Where to write the eigenvectors and the multiscaled components. Defaults to None, which keeps
+                  them in memory as pandas DataFrames. If a path prefix, they are written to the
+                  `<memmap_path>_EigenVectors.npy` and `<memmap_path>_MultiscaleComponents.npy` files and returned as
+                  read-only memory-mapped arrays, which downstream stages can stream over. If True, the files are
+                  written to a temporary directory created for the estimator (see the `filename` attribute of the
+                  returned arrays), which is removed when the estimator is garbage collected. Files are replaced
+                  (not overwritten) by new decompositions, so previously returned arrays stay valid.
+
+    random_state : Seed or numpy RandomState of the random starting blocks of the 'lobpcg' and 'randomized'
+                   eigensolvers. Defaults to None, which uses the global numpy random state.
+
     n_jobs : Number of threads to use in calculations. Defaults to all but one.
 
     verbose : controls verbosity.
@@ -104,6 +236,11 @@ class Diffusor(TransformerMixin):
                  transitions=True,
                  eigengap=True,
                  norm=False,
+                 eigen_solver='arpack',
+                 dtype='float64',
+                 t=None,
+                 memmap_path=None,
+                 random_state=None,
                  verbose=True
                  ):
         self.n_components = n_components
@@ -121,22 +258,15 @@ class Diffusor(TransformerMixin):
         self.transitions = transitions
         self.eigengap = eigengap
         self.norm = norm
+        self.eigen_solver = eigen_solver
+        self.dtype = dtype
+        self.t = t
+        self.memmap_path = memmap_path
+        self.random_state = random_state
         self.verbose = verbose
 
-    def fit(self, data):
-        """Fits an adaptive anisotropic kernel to the data.
-        :param data: input data. Takes in numpy arrays and scipy csr sparse matrices.
-        Use with sparse data for top performance. You can adjust a series of
-        parameters that can make the process faster and more informational depending
-        on your dataset. Read more at https://github.com/davisidarta/dbmap
-        """
-        self.start_time = time.time()
-        self.N = data.shape[0]
-        if self.kernel_use == 'orig' and self.transitions == 'False':
-            print('The original kernel implementation used transitions computation. Set `transitions` to `True`'
-                  'for similar results.')
-        if self.kernel_use not in ['simple', 'simple_adaptive', 'decay', 'decay_adaptive']:
-            raise Exception('Kernel must be either \'simple\', \'simple_adaptive\', \'decay\' or \'decay_adaptive\'.') 
+    def _fit_neighbors(self, data):
+        # Fits the nearest-neighbors estimator to the data and returns its kNN distance graph
         if self.ann:
             # Construct an approximate k-nearest-neighbors graph
             anbrs = ann.NMSlibTransformer(n_neighbors=self.n_neighbors,
@@ -148,59 +278,129 @@ class Diffusor(TransformerMixin):
                                           efC=self.efC,
                                           efS=self.efS,
                                           verbose=self.verbose).fit(data)
-            knn = anbrs.transform(data)
-            # X, y specific stds: Normalize by the distance of median nearest neighbor to account for neighborhood size.
-            median_k = np.floor(self.n_neighbors / 2).astype(np.int)
-            adap_sd = np.zeros(self.N)
-            for i in np.arange(len(adap_sd)):
-                adap_sd[i] = np.sort(knn.data[knn.indptr[i]: knn.indptr[i + 1]])[
-                    median_k - 1
-                    ]
+            self.anbrs = anbrs
+            return anbrs.transform(data)
         else:
-            if self.ann_dist == 'lp':
-                raise Exception('Generalized Lp distances are available only with `ann` set to True.')
-
             # Construct a k-nearest-neighbors graph
             nbrs = NearestNeighbors(n_neighbors=int(self.n_neighbors), metric=self.knn_dist, n_jobs=self.n_jobs).fit(
                 data)
-            knn = nbrs.kneighbors_graph(data, mode='distance')
-            x, y, dist = find(knn)
-            # X, y specific stds: Normalize by the distance of median nearest neighbor to account for neighborhood size.
-            median_k = np.floor(self.n_neighbors / 2).astype(np.int)
-            adap_sd = np.zeros(self.N)
-            for i in np.arange(len(adap_sd)):
-                adap_sd[i] = np.sort(knn.data[knn.indptr[i]: knn.indptr[i + 1]])[
-                    median_k - 1
-                    ]
+            self.nbrs = nbrs
+            return nbrs.kneighbors_graph(data, mode='distance')
+
+    def fit(self, data, knn=None, nbrs=None):
+        """Fits an adaptive anisotropic kernel to the data.
+        :param data: input data. Takes in numpy arrays and scipy csr sparse matrices.
+        Use with sparse data for top performance. You can adjust a series of
+        parameters that can make the process faster and more informational depending
+        on your dataset. Read more at https://github.com/davisidarta/dbmap
+        :param knn: optional precomputed kNN distance graph of `data` (a csr matrix with `n_neighbors` entries
+        per row, including each sample itself, as returned by `ann.NMSlibTransformer.transform`). Skips the
+        neighbor search.
+        :param nbrs: the fitted neighbors estimator that produced `knn` (an `ann.NMSlibTransformer` if `ann` is True,
+        else a `sklearn.neighbors.NearestNeighbors`). Used to expand neighborhoods and to project new samples;
+        fitted again from `data` only if needed and not given.
+        """
+        self.start_time = time.time()
+        self.N = data.shape[0]
+        self.fingerprint = ann.data_fingerprint(data)
+        self.res = None
+        self.anbrs, self.nbrs = None, None
+        if self.kernel_use == 'orig' and self.transitions == 'False':
+            print('The original kernel implementation used transitions computation. Set `transitions` to `True`'
+                  'for similar results.')
+        if self.kernel_use not in ['simple', 'simple_adaptive', 'decay', 'decay_adaptive']:
+            raise Exception('Kernel must be either \'simple\', \'simple_adaptive\', \'decay\' or \'decay_adaptive\'.') 
+        if not self.ann and self.ann_dist == 'lp':
+            raise Exception('Generalized Lp distances are available only with `ann` set to True.')
+        if np.dtype(self.dtype) not in [np.float32, np.float64]:
+            raise Exception('dtype must be either \'float32\' or \'float64\'.')
+        if knn is None:
+            knn = self._fit_neighbors(data)
+        else:
+            knn = csr_matrix(knn)
+            if self.ann:
+                self.anbrs = nbrs
+            else:
+                self.nbrs = nbrs
+        self.knn_graph = knn
+        return self._fit_kernel(knn, data)
+
+    def partial_fit(self, data):
+        """Adds new samples to the fitted diffusion process. The new samples are added to the fitted kNN
+        index (see `ann.NMSlibTransformer.partial_fit`), and only the kNN rows of the fitted samples that gain
+        a new neighbor are updated before the kernel and the diffusion operator are rebuilt from the kNN graph.
+        The diffusion components are computed again in the next call to `transform`.
+        :param data: new samples, of the same type and features as the data used in `fit`.
+        """
+        if self.anbrs is None:
+            raise Exception('Adding samples requires a fitted approximate nearest-neighbors index (`ann` set to True).')
+        self.start_time = time.time()
+        knn = self.knn_graph
+        n_neighbors = knn.indptr[1] - knn.indptr[0]
+        if np.any(np.diff(knn.indptr) != n_neighbors):
+            raise Exception('Adding samples requires a kNN graph with the same number of neighbors per sample.')
+        indices = knn.indices.reshape(knn.shape[0], n_neighbors)
+        distances = knn.data.reshape(knn.shape[0], n_neighbors)
+        self.anbrs.partial_fit(data)
+        indices, distances, self.updated_samples = self.anbrs.update_kneighbors(indices, distances, data)
+        if self.verbose:
+            print('Updated the neighborhoods of %d fitted samples.' % self.updated_samples.shape[0])
+        knn = ann.knn_to_csr(indices, distances, self.anbrs.n_samples_fit_)
+        # The fitted data is no longer available as a whole: new calls to `transform` only check its size
+        self.fingerprint = None
+        self.res = None
+        self.knn_graph = knn
+        return self._fit_kernel(knn)
+
+    def _fit_kernel(self, knn, data=None):
+        # Builds the adaptive kernel and the diffusion operator from the kNN graph of the data. Without `data`,
+        # neighborhoods are not expanded beyond the kNN graph.
+        self.N = knn.shape[0]
+        dtype = np.dtype(self.dtype)
+        # X, y specific stds: Normalize by the distance of median nearest neighbor to account for neighborhood size.
+        median_k = int(np.floor(self.n_neighbors / 2))
+        adap_sd = kth_neighbor_distance(knn, median_k - 1).astype(dtype)
 
         # Distance metrics
         x, y, dists = find(knn)  # k-nearest-neighbor distances
+        dists = dists.astype(dtype, copy=False)
 
         # define decay as sample's pseudomedian k-nearest-neighbor
-        pm = np.interp(adap_sd, (adap_sd.min(), adap_sd.max()), (2, self.n_neighbors))
+        pm = np.interp(adap_sd, (adap_sd.min(), adap_sd.max()), (2, self.n_neighbors)).astype(dtype)
 
         # adaptive neighborhood size
         if self.kernel_use == 'simple_adaptive' or self.kernel_use == 'decay_adaptive':
-            # increase neighbor search:
-            anbrs_new = ann.NMSlibTransformer(n_neighbors=int(self.n_neighbors + (self.n_neighbors - pm.max())),
-                                              metric=self.ann_dist,
-                                              method='hnsw',
-                                              n_jobs=self.n_jobs,
-                                              p=self.p,
-                                              M=self.M,
-                                              efC=self.efC,
-                                              efS=self.efS).fit(data)
-            knn_new = anbrs_new.transform(data)
+            # The expanded neighborhood is never smaller than the base one (pm.max() <= n_neighbors), and
+            # matches it whenever distances vary across samples. The base kNN query is then reused as is,
+            # and the fitted index is only queried again (never rebuilt) when extra neighbors are needed.
+            k_adaptive = int(self.n_neighbors + (self.n_neighbors - pm.max()))
+            extra = k_adaptive - self.n_neighbors
+            if extra == 0:
+                knn_new = knn
+            elif data is None:
+                knn_new = knn
+            else:
+                if self.anbrs is None and self.nbrs is None:
+                    self._fit_neighbors(data)
+                if self.ann:
+                    self.anbrs.update_search(k_adaptive)
+                    knn_new = self.anbrs.transform(data)
+                else:
+                    knn_new = self.nbrs.kneighbors_graph(data, n_neighbors=k_adaptive, mode='distance')
 
             x_new, y_new, dists_new = find(knn_new)
+            dists_new = dists_new.astype(dtype, copy=False)
 
             # adaptive neighborhood size
-            adap_nbr = np.zeros(self.N)
-            for i in np.arange(len(adap_nbr)):
-                adap_k = int(np.floor(pm[i]))
-                adap_nbr[i] = np.sort(knn_new.data[knn_new.indptr[i]: knn_new.indptr[i + 1]])[
-                    adap_k - 1
-                ]
+            adap_nbr = kth_neighbor_distance(knn_new, np.floor(pm).astype(int) - 1).astype(dtype)
+            self.adap_nbr, self.k_adaptive = adap_nbr, k_adaptive
+            knn = knn_new
+
+        # Keep the bandwidths and neighborhood radii to build kernel rows of new samples
+        self.adap_sd, self.pm = adap_sd, pm
+        self.knn_radius = kth_neighbor_distance(knn, -1)
+        self.knn_width = int(np.diff(knn.indptr).max())
+        self.kernel_graph = knn
 
         if self.kernel_use == 'simple':
             # X, y specific stds
@@ -212,33 +412,40 @@ class Diffusor(TransformerMixin):
             dists = dists_new / (adap_nbr[x_new] + 1e-10)  # Normalize by normalized contribution to neighborhood size.
             W = csr_matrix((np.exp(-dists), (x_new, y_new)), shape=[self.N, self.N])
 
-        if self.kernel_use == 'decay':
-            # X, y specific stds
-            dists = (dists / (adap_sd[x] + 1e-10)) ** np.power(2, ((self.n_neighbors - pm[x]) / pm[x]))
-            W = csr_matrix((np.exp(-dists), (x, y)), shape=[self.N, self.N])
+        # In single precision, large decay exponents overflow to an infinite distance, that is a null weight
+        with np.errstate(over='ignore'):
+            if self.kernel_use == 'decay':
+                # X, y specific stds
+                dists = (dists / (adap_sd[x] + 1e-10)) ** np.power(2, ((self.n_neighbors - pm[x]) / pm[x]))
+                W = csr_matrix((np.exp(-dists), (x, y)), shape=[self.N, self.N])
 
-        if self.kernel_use == 'decay_adaptive':
-            # X, y specific stds
-            dists = (dists_new / (adap_nbr[x_new] + 1e-10)) ** np.power(2, (((int(self.n_neighbors + (self.n_neighbors - pm.max()))) - pm[x_new]) / pm[x_new]))  # Normalize by normalized contribution to neighborhood size.
-            W = csr_matrix((np.exp(-dists), (x_new, y_new)), shape=[self.N, self.N])
+            if self.kernel_use == 'decay_adaptive':
+                # X, y specific stds
+                dists = (dists_new / (adap_nbr[x_new] + 1e-10)) ** np.power(2, ((k_adaptive - pm[x_new]) / pm[x_new]))  # Normalize by normalized contribution to neighborhood size.
+                W = csr_matrix((np.exp(-dists), (x_new, y_new)), shape=[self.N, self.N])
 
         # Kernel construction
-        kernel = (W + W.T) / 2
+        kernel = (W + W.T).tocsr()
+        kernel.data *= 0.5  # in place, keeping the kernel precision
         self.K = kernel
 
         # handle nan, zeros
         self.K.data = np.where(np.isnan(self.K.data), 1, self.K.data)
         # Diffusion through Markov chain
 
-        D = np.ravel(self.K.sum(axis=1))
+        # Row sums are accumulated in double precision, then kept in the kernel precision
+        D = np.ravel(self.K.sum(axis=1, dtype=np.float64)).astype(dtype)
+        self.kernel_sums = D.copy()
         if self.alpha > 0:
             # L_alpha
             D[D != 0] = D[D != 0] ** (-self.alpha)
             mat = csr_matrix((D, (range(self.N), range(self.N))), shape=[self.N, self.N])
             kernel = mat.dot(self.K).dot(mat)
-            D = np.ravel(kernel.sum(axis=1))
+            D = np.ravel(kernel.sum(axis=1, dtype=np.float64)).astype(dtype)
 
         D[D != 0] = 1 / D[D != 0]
+        # T = diag(D) K, with K symmetric: keep D to decompose the symmetric conjugate of T
+        self.norm_factors = D
 
         # Setting the diffusion operator
         if not self.norm:
@@ -250,75 +457,259 @@ class Diffusor(TransformerMixin):
         return self
 
 
-    def transform(self, data):
+    def _kernel_weights(self, dist, rows):
+        # Directed kernel weights of the kNN distances `dist` (one row per sample in `rows`), as built in
+        # `_fit_kernel` from the fitted bandwidths. Zero distances (the samples themselves) get no weight.
+        if self.kernel_use in ['simple', 'decay']:
+            sd, k = self.adap_sd[rows], self.n_neighbors
+        else:
+            sd, k = self.adap_nbr[rows], self.k_adaptive
+        scaled = dist / (sd[:, None] + 1e-10)
+        if self.kernel_use in ['decay', 'decay_adaptive']:
+            pm = self.pm[rows][:, None]
+            with np.errstate(over='ignore'):
+                scaled = scaled ** np.power(2, (k - pm) / pm)
+        w = np.exp(-scaled)
+        w[~(dist > 0) | ~np.isfinite(dist)] = 0
+        return w
+
+    def update(self, data):
+        """Adds new samples to the fitted diffusion process and refreshes its diffusion components, without
+        building the kernel again. New samples are added to the fitted kNN index, and only the kernel rows of the
+        new samples and of the fitted samples that gain them as neighbors are computed, with bandwidths
+        interpolated over the fitted range. The kernel, its normalization and the diffusion operator are
+        patched on these rows, and the eigenpairs are refreshed by iterating from the previous eigenvectors
+        (extended to the new samples with the Nystrom formula).
+        :param data: new samples, of the same type and features as the data used in `fit`.
+        :return: multiscaled diffusion components of all samples, fitted ones first.
+        """
+        if self.anbrs is None:
+            raise Exception('Updating requires a fitted approximate nearest-neighbors index (`ann` set to True).')
+        if self.norm:
+            raise Exception('The normalized kernel (`norm` set to True) cannot be patched. Use `partial_fit` instead.')
+        self.start_time = time.time()
+        n_old, n_new = self.N, data.shape[0]
+        graph = self.kernel_graph
+        width = graph.indptr[1] - graph.indptr[0]
+        if np.any(np.diff(graph.indptr) != width):
+            raise Exception('Updating requires a kNN graph with the same number of neighbors per sample.')
+        indices = graph.indices.reshape(n_old, width)
+        distances = graph.data.reshape(n_old, width)
+        self.anbrs.partial_fit(data)
+        new_indices, new_distances, updated = self.anbrs.update_kneighbors(indices, distances, data)
+        self.updated_samples = updated
+        rows = np.concatenate([updated, np.arange(n_old, n_old + n_new)])
+        N = n_old + n_new
+
+        # Kernel rows to remove, with the bandwidths they were built with
+        w_old = self._kernel_weights(distances[updated], updated)
+
+        # Bandwidths of the changed rows, interpolated over the fitted range
+        sd_range = (self.adap_sd.min(), self.adap_sd.max())
+        pad = np.zeros(n_new, dtype=self.norm_factors.dtype)
+        self.adap_sd = np.concatenate([self.adap_sd, pad]).astype(self.adap_sd.dtype)
+        self.pm = np.concatenate([self.pm, pad])
+        self.knn_radius = np.concatenate([self.knn_radius, pad]).astype(self.knn_radius.dtype)
+        sorted_dist = np.sort(new_distances[rows], axis=1)
+        median_k = int(np.floor(self.n_neighbors / 2))
+        self.adap_sd[rows] = sorted_dist[:, median_k - 1]
+        self.pm[rows] = np.interp(self.adap_sd[rows], sd_range, (2, self.n_neighbors))
+        if self.kernel_use in ['simple_adaptive', 'decay_adaptive']:
+            self.adap_nbr = np.concatenate([self.adap_nbr, pad]).astype(self.adap_nbr.dtype)
+            self.adap_nbr[rows] = np.take_along_axis(sorted_dist, np.floor(self.pm[rows]).astype(int)[:, None] - 1,
+                                                     axis=1).ravel()
+        self.knn_radius[rows] = np.max(np.where(np.isfinite(sorted_dist), sorted_dist, 0), axis=1)
+        w_new = self._kernel_weights(new_distances[rows], rows)
+
+        # Patch the symmetric kernel with the difference of the changed rows
+        dW = (csr_matrix((w_new.ravel(), (np.repeat(rows, width), np.maximum(new_indices[rows], 0).ravel())),
+                         shape=[N, N]) -
+              csr_matrix((w_old.ravel(), (np.repeat(updated, width), np.maximum(indices[updated], 0).ravel())),
+                         shape=[N, N]))
+        dK = (dW + dW.T).tocsr()
+        dK.data *= 0.5
+        K = self.K.tocsr(copy=True)
+        K.resize((N, N))
+        K = (K + dK).tocsr()
+        K.data = np.where(np.isnan(K.data), 1, K.data)
+        # Drop the cancellation residue of removed edges
+        K.data[np.abs(K.data) < 1e-12] = 0
+        K.eliminate_zeros()
+        self.K = K
+        self.N = N
+
+        # Patch the normalization on the rows whose sums changed
+        changed = np.flatnonzero(np.diff(dK.indptr))
+        self.kernel_sums = np.concatenate([self.kernel_sums, pad])
+        self.kernel_sums[changed] = np.ravel(K[changed].sum(axis=1, dtype=np.float64))
+        D = np.concatenate([self.norm_factors, pad])
+        if self.alpha > 0:
+            q = self.kernel_sums.copy()
+            q[q != 0] = q[q != 0] ** (-self.alpha)
+            changed = np.unique(np.concatenate([changed, K[changed].indices]))
+            sums = q[changed] * (K[changed] @ q)
+        else:
+            sums = self.kernel_sums[changed]
+        D[changed] = 0
+        D[changed[sums != 0]] = 1 / sums[sums != 0]
+        self.norm_factors = D
+        self.T = csr_matrix((D, (range(N), range(N))), shape=[N, N]).dot(K)
+
+        self.kernel_graph = ann.knn_to_csr(new_indices, new_distances, N)
+        if width > self.n_neighbors:
+            self.knn_graph = _first_k_neighbors(self.kernel_graph, self.n_neighbors)
+        else:
+            self.knn_graph = self.kernel_graph
+        self.fingerprint = None
+
+        if self.res is None:
+            D, V = self._eigengap_decompose()
+        else:
+            # Warm start from the previous eigenvectors, extended to the new samples
+            evals = np.array(self.res['EigenValues'])
+            evecs = np.array(self.res['EigenVectors'])
+            X0 = np.vstack([evecs, self.T[n_old:, :n_old].dot(evecs) / np.where(np.abs(evals) > 1e-10, evals, 1)])
+            D, V = self._decompose(len(evals), X0=X0)
+        self._store_results(D, V)
+        end = time.time()
+        if self.verbose:
+            print('Updated the diffusion process with %d new samples (%d fitted samples changed) in %f (sec)' %
+                  (n_new, updated.shape[0], end - self.start_time))
+        return self.res['MultiscaleComponents']
 
-        # Fit an optimal number of components based on the eigengap
-        # Use user's  or default initial guess
-        multiplier = self.N // 10e4
-        # initial eigen value decomposition
-        if self.transitions:
-            D, V = eigs(self.T, self.n_components, tol=1e-4, maxiter=self.N)
+    def _symmetric_operator(self):
+        # T = diag(D) K is similar to the symmetric diag(D)^{1/2} K diag(D)^{1/2}, whose eigenvectors U
+        # give those of T as diag(D)^{1/2} U. Without transitions, K is decomposed directly.
+        if not self.transitions:
+            return self.K, None
+        scale = np.sqrt(self.norm_factors)
+        S = csr_matrix((scale, (range(self.N), range(self.N))), shape=[self.N, self.N])
+        return S.dot(self.K).dot(S), scale
+
+    def _decompose(self, n_components, X0=None):
+        """Computes the `n_components` leading eigenpairs of the diffusion operator with the chosen `eigen_solver`.
+        :param n_components: number of eigenpairs to compute.
+        :param X0: optional starting block of shape (N, m) for the iterative solvers.
+        :return: eigenvalues in descending order and the corresponding unit-norm eigenvectors.
+        """
+        if self.eigen_solver not in ['arpack', 'eigsh', 'lobpcg', 'randomized']:
+            raise Exception('Eigensolver must be either \'arpack\', \'eigsh\', \'lobpcg\' or \'randomized\'.')
+        if self.eigen_solver == 'arpack':
+            v0 = None if X0 is None else X0.sum(axis=1)
+            if self.transitions:
+                D, V = eigs(self.T, n_components, which='LR', tol=1e-4, maxiter=self.N, v0=v0)
+            else:
+                D, V = eigs(self.K, n_components, which='LR', tol=1e-4, maxiter=self.N, v0=v0)
+            D = np.real(D)
+            V = np.real(V)
         else:
-            D, V = eigs(self.K, self.n_components, tol=1e-4, maxiter=self.N)
-        D = np.real(D)
-        V = np.real(V)
+            A, scale = self._symmetric_operator()
+            if X0 is not None and scale is not None:
+                X0 = X0 / scale[:, None]
+            if self.eigen_solver == 'eigsh':
+                v0 = None if X0 is None else X0.sum(axis=1)
+                D, V = eigsh(A, n_components, which='LA', tol=1e-4, maxiter=self.N, v0=v0)
+            elif self.eigen_solver == 'lobpcg':
+                # LOBPCG is unstable in single precision: solve in double precision
+                X = check_random_state(self.random_state).normal(size=(self.N, n_components))
+                if X0 is not None:
+                    X[:, :X0.shape[1]] = X0[:, :n_components]
+                D, V = lobpcg(A.astype(np.float64), X, tol=1e-4, maxiter=500, largest=True)
+                D, V = D.astype(A.dtype), V.astype(A.dtype)
+            else:
+                D, V = randomized_eigsh(A, n_components, X0=X0, random_state=self.random_state)
+            if scale is not None:
+                V = V * scale[:, None]
         inds = np.argsort(D)[::-1]
         D = D[inds]
         V = V[:, inds]
         # Normalize by the first diffusion component
         for i in range(V.shape[1]):
             V[:, i] = V[:, i] / np.linalg.norm(V[:, i])
-        vals = np.array(V)
-        pos = np.sum(vals > 0, axis=0)
-        residual = np.sum(vals < 0, axis=0)
-
-        if self.eigengap and len(residual) < 1:
-            #expand eigendecomposition
-            target = self.n_components * multiplier
-            while residual < 3:
-                print('Eigengap not found for determined number of components. Expanding eigendecomposition to '
-                      + str(target) + 'components.')
-                if self.transitions:
-                    D, V = eigs(self.T, target, tol=1e-4, maxiter=self.N)
-                else:
-                    D, V = eigs(self.K, target, tol=1e-4, maxiter=self.N)
-                D = np.real(D)
-                V = np.real(V)
-                inds = np.argsort(D)[::-1]
-                D = D[inds]
-                V = V[:, inds]
-                # Normalize by the first diffusion component
-                for i in range(V.shape[1]):
-                    V[:, i] = V[:, i] / np.linalg.norm(V[:, i])
-                vals = np.array(V)
-                residual = np.sum(vals < 0, axis=0)
-                target = target * 2
+        return D, V
 
-        if len(residual) > 30:
-            self.n_components = len(pos) + 15
-            # adapted eigen value decomposition
-            if self.transitions:
-               D, V = eigs(self.T, self.n_components, tol=1e-4, maxiter=self.N)
+    def _expand_decomposition(self, D, V, n_components):
+        """Extends the eigenpairs (D, V) to the `n_components` leading ones, reusing the converged subspace.
+        Only the missing eigenpairs are computed, on the symmetric conjugate of the operator deflated by the
+        already converged eigenvectors (or constrained to their orthogonal complement, with LOBPCG).
+        """
+        n_components = min(n_components, self.N - 2)
+        n_extra = n_components - len(D)
+        if n_extra <= 0:
+            return D[:n_components], V[:, :n_components]
+        A, scale = self._symmetric_operator()
+        U = V if scale is None else V / scale[:, None]
+        U, _ = np.linalg.qr(U)
+        if self.eigen_solver == 'lobpcg':
+            D_new, U_new = lobpcg(A.astype(np.float64),
+                                  check_random_state(self.random_state).normal(size=(self.N, n_extra)),
+                                  Y=U.astype(np.float64), tol=1e-4, maxiter=500, largest=True)
+            D_new, U_new = D_new.astype(A.dtype), U_new.astype(A.dtype)
+        else:
+            # Shift the converged eigenvalues below the whole spectrum, so that only new ones are found. Subspace
+            # iteration converges to the eigenvalues of largest magnitude instead: there they are only projected out.
+            shift = 0 if self.eigen_solver == 'randomized' else abs(A).sum(axis=1).max() + 1
+
+            def matvec(x):
+                # (I - UU')A(I - UU') - shift UU'
+                c = U.T @ x
+                y = A @ (x - U @ c)
+                return y - U @ (U.T @ y) - shift * (U @ c)
+
+            Ad = LinearOperator(A.shape, matvec=matvec, matmat=matvec, dtype=A.dtype)
+            if self.eigen_solver == 'randomized':
+                D_new, U_new = randomized_eigsh(Ad, n_extra, random_state=self.random_state)
             else:
-                D, V = eigs(self.K, self.n_components, tol=1e-4, maxiter=self.N)
-            D = np.real(D)
-            V = np.real(V)
-            inds = np.argsort(D)[::-1]
-            D = D[inds]
-            V = V[:, inds]
+                D_new, U_new = eigsh(Ad, n_extra, which='LA', tol=1e-4, maxiter=self.N)
+        V_new = U_new if scale is None else U_new * scale[:, None]
+        V_new = V_new / np.linalg.norm(V_new, axis=0)
+        D = np.concatenate([D, D_new])
+        V = np.hstack([V, V_new])
+        inds = np.argsort(D)[::-1]
+        return D[inds], V[:, inds]
 
-        # Normalize by the first diffusion component
-        for i in range(V.shape[1]):
-            V[:, i] = V[:, i] / np.linalg.norm(V[:, i])
+    def _eigengap_decompose(self):
+        """Decomposes the diffusion operator, expanding the decomposition while no eigengap (negative-valued
+        components) is found. Expansions double the number of components, up to `n_components` times the
+        number of samples in units of 10e4, and each only computes the eigenpairs not yet converged.
+        """
+        # initial eigen value decomposition
+        D, V = self._decompose(self.n_components)
+        residual = np.sum(D < 0)
+
+        if self.eigengap and residual < 1:
+            # expand eigendecomposition
+            max_components = self.n_components * max(1, int(self.N // 10e4))
+            target = self.n_components * 2
+            while residual < 3 and len(D) < max_components:
+                target = min(target, max_components)
+                print('Eigengap not found for determined number of components. Expanding eigendecomposition to '
+                      + str(target) + ' components.')
+                D, V = self._expand_decomposition(D, V, target)
+                residual = np.sum(D < 0)
+                target = target * 2
 
-        # Create the results dictionary
-        self.res = {'EigenVectors': V, 'EigenValues': D, 'kernel': self.K}
-        self.res['EigenVectors'] = pd.DataFrame(self.res['EigenVectors'])
-        self.res["EigenValues"] = pd.Series(self.res["EigenValues"])
+        if residual > 30:
+            # keep the positive components and a few of the negative ones
+            self.n_components = int(np.sum(D > 0)) + 15
+            D, V = self._expand_decomposition(D, V, self.n_components)
+        return D, V
+
+    def transform(self, data=None):
+        """Decomposes the diffusion operator and returns the multiscaled diffusion components of the fitted data.
+        If `data` holds new samples, these are projected onto the fitted diffusion components
+        instead (see `out_of_sample`).
+        :param data: input data. Either None, the data used in `fit` or new samples.
+        """
+        if data is not None and self.res is not None and (data.shape[0] != self.N or (
+                self.fingerprint is not None and ann.data_fingerprint(data) != self.fingerprint)):
+            return self.out_of_sample(data)
 
-        mms = multiscale.multiscale(self.res)
+        # Fit an optimal number of components based on the eigengap
+        D, V = self._eigengap_decompose()
 
-        self.res['MultiscaleComponents'] = mms
+        # Create the results dictionary
+        self._store_results(D, V)
 
         end = time.time()
         if self.verbose:
@@ -327,7 +718,105 @@ class Diffusor(TransformerMixin):
 
         return self.res['MultiscaleComponents']
 
-    def ind_dist_grad(self, data, n_components=None, dense=False):
+    def _store_results(self, D, V):
+        # Stores the eigenpairs and their multiscaled components in the results dictionary, in memory as pandas
+        # objects or in memory-mapped files (see `memmap_path`).
+        n_eigs = int(np.sum(D > 0))
+        if self.memmap_path is None:
+            # pandas objects viewing the arrays
+            mms = multiscale.multiscale_components(V, D, n_eigs=n_eigs, t=self.t)
+            self.res = {'EigenVectors': pd.DataFrame(V, copy=False), 'EigenValues': pd.Series(D, copy=False),
+                        'kernel': self.K, 'MultiscaleComponents': pd.DataFrame(mms, copy=False)}
+            return self.res
+        prefix = self.memmap_path
+        if prefix is True:
+            # One temporary directory per estimator, whose files are replaced by later decompositions. It is
+            # removed with the estimator.
+            if getattr(self, '_memmap_dir', None) is None:
+                self._memmap_dir = tempfile.mkdtemp(prefix='dbmap-')
+                weakref.finalize(self, shutil.rmtree, self._memmap_dir, ignore_errors=True)
+            prefix = os.path.join(self._memmap_dir, 'diffusion')
+
+        def fill_evecs(out, start, stop):
+            out[:] = V[start:stop]
+
+        def fill_mms(out, start, stop):
+            multiscale.multiscale_components(V[start:stop], D, n_eigs=n_eigs, t=self.t, out=out, verbose=False)
+
+        self.res = {'EigenVectors': _write_npy(prefix + '_EigenVectors.npy', V.shape, V.dtype, fill_evecs),
+                    'EigenValues': D,
+                    'kernel': self.K,
+                    'MultiscaleComponents': _write_npy(prefix + '_MultiscaleComponents.npy', (V.shape[0], n_eigs),
+                                                       V.dtype, fill_mms)}
+        if self.verbose:
+            print('Automatically selected and multiscaled ' + str(n_eigs) + ' diffusion components.')
+        return self.res
+
+    def _new_kernel_rows(self, data):
+        # Kernel rows between new samples and the fitted ones, mirroring the kernel built in `fit`.
+        if self.anbrs is not None:
+            ind, dist = self.anbrs.kneighbors(data, n_neighbors=self.knn_width - 1)
+        else:
+            dist, ind = self.nbrs.kneighbors(data, n_neighbors=self.knn_width - 1)
+        n = dist.shape[0]
+        # The first column stands for the sample itself, as in the kNN graph of the fitted data
+        full = np.hstack([np.zeros((n, 1), dtype=dist.dtype), dist])
+        median_k = int(np.floor(self.n_neighbors / 2))
+        sd = np.sort(full, axis=1)[:, median_k - 1]
+        pm = np.interp(sd, (self.adap_sd.min(), self.adap_sd.max()), (2, self.n_neighbors))
+        if self.kernel_use in ['simple_adaptive', 'decay_adaptive']:
+            k = self.k_adaptive
+            sd = np.take_along_axis(np.sort(full, axis=1), np.floor(pm).astype(int)[:, None] - 1, axis=1).ravel()
+            sd_fit, pm_fit = self.adap_nbr[ind], self.pm[ind]
+        else:
+            k = self.n_neighbors
+            sd_fit, pm_fit = self.adap_sd[ind], self.pm[ind]
+        if self.kernel_use in ['simple', 'simple_adaptive']:
+            w_new = np.exp(-dist / (sd[:, None] + 1e-10))
+            w_fit = np.exp(-dist / (sd_fit + 1e-10))
+        else:
+            w_new = np.exp(-(dist / (sd[:, None] + 1e-10)) ** np.power(2, (k - pm[:, None]) / pm[:, None]))
+            w_fit = np.exp(-(dist / (sd_fit + 1e-10)) ** np.power(2, (k - pm_fit) / pm_fit))
+        # Fitted samples only count new samples within their own neighborhood radius
+        w_fit[dist > self.knn_radius[ind]] = 0
+        w = (w_new + w_fit) / 2
+        w[dist == 0] = 0
+        w = np.where(np.isnan(w), 1, w)
+        return ind, w
+
+    def out_of_sample(self, data):
+        """Projects new samples onto the diffusion components of the fitted data, without refitting.
+        New samples are queried against the fitted kNN index, their kernel rows are built with the fitted
+        bandwidths and normalization, and the fitted eigenvectors are extended to them with the Nystrom formula
+        psi(x) = 1/lambda * sum_j T(x, j) psi(j).
+        :param data: new samples, of the same type and features as the data used in `fit`.
+        :return: multiscaled diffusion components of the new samples.
+        """
+        if self.res is None:
+            self._store_results(*self._eigengap_decompose())
+        ind, w = self._new_kernel_rows(data)
+        if self.alpha > 0:
+            q = w.sum(axis=1)
+            q[q != 0] = q[q != 0] ** (-self.alpha)
+            w_alpha = w * q[:, None] * self.kernel_sums[ind] ** (-self.alpha)
+        else:
+            w_alpha = w
+        if self.norm:
+            w = w_alpha
+        if self.transitions:
+            d = w_alpha.sum(axis=1)
+            d[d != 0] = 1 / d[d != 0]
+            w = w * d[:, None]
+        # Extended in the precision of the fitted components
+        rows = ann.knn_to_csr(ind, w.astype(self.dtype, copy=False), self.N)
+        evals = np.asarray(self.res['EigenValues'])
+        evecs = rows.dot(np.asarray(self.res['EigenVectors']))
+        evecs /= evals
+        # Scale the extended eigenvectors in place
+        mms = multiscale.multiscale_components(evecs, evals, t=self.t, out=evecs)
+        return mms if self.memmap_path is not None else pd.DataFrame(mms, copy=False)
+
+    def ind_dist_grad(self, data, n_components=None, dense=False, metric='cosine', method='hnsw'):
         """Effectively computes on data. Also returns the normalized diffusion distances,
         indexes and gradient obtained by approximating the Laplace-Beltrami operator.
         :param plot_knee: Whether to plot the scree plot of diffusion eigenvalues.
@@ -335,91 +824,46 @@ class Diffusor(TransformerMixin):
         Please use with sparse data for top performance. You can adjust a series of
         parameters that can make the process faster and more informational depending
         on your dataset. Read more at https://github.com/davisidarta/dbmap
+        :param metric: distance metric of the kNN search on the multiscaled components. Defaults to 'cosine'.
+        :param method: kNN search method on the multiscaled components. Either an NMSlib method (see
+        `ann.NMSlibTransformer`), 'exact' for a blocked brute-force search (`ann.exact_kneighbors`), which is
+        deterministic and often faster on low-dimensional components, or 'auto' to time both 'hnsw' and 'exact'
+        on a subsample and use the fastest (`ann.select_knn_method`). Defaults to 'hnsw'.
         """
         if n_components is not None:
             self.n_components = n_components
+            D, V = self._decompose(self.n_components)
         else:
             # Fit an optimal number of components based on the eigengap
-            # Use user's  or default initial guess
-            multiplier = self.N // 10e4
-            # initial eigen value decomposition
-            if self.transitions:
-                D, V = eigs(self.T, self.n_components, tol=1e-4, maxiter=self.N)
-            else:
-                D, V = eigs(self.K, self.n_components, tol=1e-4, maxiter=self.N)
-            D = np.real(D)
-            V = np.real(V)
-            inds = np.argsort(D)[::-1]
-            D = D[inds]
-            V = V[:, inds]
-            # Normalize by the first diffusion component
-            for i in range(V.shape[1]):
-                V[:, i] = V[:, i] / np.linalg.norm(V[:, i])
-            vals = np.array(V)
-            pos = np.sum(vals > 0, axis=0)
-            residual = np.sum(vals < 0, axis=0)
-
-            if self.eigengap and len(residual) < 1:
-                #expand eigendecomposition
-                target = self.n_components * multiplier
-                while residual < 3:
-                    print('Eigengap not found for determined number of components. Expanding eigendecomposition to '
-                          + str(target) + 'components.')
-                    if self.transitions:
-                        D, V = eigs(self.T, target, tol=1e-4, maxiter=self.N)
-                    else:
-                        D, V = eigs(self.K, target, tol=1e-4, maxiter=self.N)
-                    D = np.real(D)
-                    V = np.real(V)
-                    inds = np.argsort(D)[::-1]
-                    D = D[inds]
-                    V = V[:, inds]
-                    # Normalize by the first diffusion component
-                    for i in range(V.shape[1]):
-                        V[:, i] = V[:, i] / np.linalg.norm(V[:, i])
-                    vals = np.array(V)
-                    residual = np.sum(vals < 0, axis=0)
-                    target = target * 2
-
-            if len(residual) > 30:
-                self.n_components = len(pos) + 15
-                # adapted eigen value decomposition
-                if self.transitions:
-                    D, V = eigs(self.T, self.n_components, tol=1e-4, maxiter=self.N)
-                else:
-                    D, V = eigs(self.K, self.n_components, tol=1e-4, maxiter=self.N)
-                D = np.real(D)
-                V = np.real(V)
-                inds = np.argsort(D)[::-1]
-                D = D[inds]
-                V = V[:, inds]
-                # Normalize by the first diffusion component
-                for i in range(V.shape[1]):
-                    V[:, i] = V[:, i] / np.linalg.norm(V[:, i])
-
+            D, V = self._eigengap_decompose()
 
         # Create the results dictionary
-        self.res = {'EigenVectors': V, 'EigenValues': D, 'kernel': self.K}
-        self.res['EigenVectors'] = pd.DataFrame(self.res['EigenVectors'])
-        if not issparse(data):
-            self.res['EigenValues'] = pd.Series(self.res['EigenValues'])
-        self.res["EigenValues"] = pd.Series(self.res["EigenValues"])
-
-        mms = multiscale.multiscale(self.res)
-        self.res['StructureComponents'] = mms
-
-        anbrs = ann.NMSlibTransformer(n_neighbors=self.n_neighbors,
-                                  metric='cosine',
-                                  method='hnsw',
-                                  n_jobs=self.n_jobs,
-                                  M=self.M,
-                                  efC=self.efC,
-                                  efS=self.efS,
-                                  dense=True,
-                                  verbose=self.verbose
-                                      ).fit(mms)
-
-        ind, dists, grad, graph = anbrs.ind_dist_grad(mms)
+        self.res = {'EigenVectors': pd.DataFrame(V, copy=False), 'EigenValues': pd.Series(D, copy=False),
+                    'kernel': self.K}
+        mms = multiscale.multiscale_components(V, D, t=self.t)
+        self.res['StructureComponents'] = pd.DataFrame(mms, copy=False)
+
+        if method == 'auto':
+            method = ann.select_knn_method(mms, self.n_neighbors + 1, metric=metric, n_jobs=self.n_jobs, M=self.M,
+                                           efC=self.efC, efS=self.efS, verbose=self.verbose)
+        if method == 'exact':
+            # Each sample is its own first neighbor, as in `ann.NMSlibTransformer.ind_dist_grad`
+            ind, dists = ann.exact_kneighbors(mms, self.n_neighbors + 1, metric=metric)
+            graph = ann.knn_to_csr(ind, dists)
+            grad = ann.knn_gradient(graph, metric)
+        else:
+            anbrs = ann.NMSlibTransformer(n_neighbors=self.n_neighbors,
+                                      metric=metric,
+                                      method=method,
+                                      n_jobs=self.n_jobs,
+                                      M=self.M,
+                                      efC=self.efC,
+                                      efS=self.efS,
+                                      dense=True,
+                                      verbose=self.verbose
+                                          ).fit(mms)
+
+            ind, dists, grad, graph = anbrs.ind_dist_grad(mms)
 
         end = time.time()
         print('Diffusion time = %f (sec), per sample=%f (sec), per sample adjusted for thread number=%f (sec)' %
@@ -36,7 +36,6 @@
 
 import numba
 import numpy as np
-import scipy.stats
 from sklearn.metrics import pairwise_distances
 
 _mock_identity = np.eye(2, dtype=np.float64)
@@ -1054,6 +1053,7 @@ def get_discrete_params(data, metric):
     if metric == "ordinal":
         return {"support_size": float(data.max() - data.min()) / 2.0}
     elif metric == "count":
+        import scipy.stats
         min_count = scipy.stats.tmin(data)
         max_count = scipy.stats.tmax(data)
         lambda_ = scipy.stats.tmean(data)
@@ -1063,6 +1063,7 @@ def get_discrete_params(data, metric):
             "normalisation": normalisation / 2.0,  # heuristic
         }
     elif metric == "string":
+        import scipy.stats
         lengths = np.array([len(x) for x in data])
         max_length = scipy.stats.tmax(lengths)
         max_dist = max_length / 1.5  # heuristic
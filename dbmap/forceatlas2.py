@@ -0,0 +1,243 @@
+"""ForceAtlas2 force-directed graph layout [Jacomy14]_, compiled with numba.
+
+Repulsion between all nodes is approximated with the Barnes-Hut tree of `dbmap.barnes_hut`, attraction runs over the
+rows of a CSR adjacency matrix, and the forces of all nodes are computed in parallel. The adaptive speed follows the
+reference Gephi implementation (also used by the `fa2` package).
+"""
+import numpy as np
+import numba
+from scipy.sparse import coo_matrix, csr_matrix
+
+from .barnes_hut import build_tree, _morton_order
+from .umap_layouts import _compile_kernel
+
+
+def _forces(
+    pos,
+    order,
+    mass,
+    indptr,
+    indices,
+    weights,
+    children,
+    half_widths,
+    tree_mass,
+    com,
+    is_leaf,
+    theta,
+    scaling_ratio,
+    gravity,
+    strong_gravity,
+    lin_log,
+    attraction_coefficient,
+    dissuade_hubs,
+    max_stack,
+    forces,
+):
+    dim = pos.shape[1]
+    n_children = children.shape[1]
+    theta_sq = theta * theta
+
+    for i in numba.prange(order.shape[0]):
+        p = order[i]
+        current = pos[p]
+        force = np.zeros(dim, dtype=np.float64)
+
+        # Repulsion, proportional to the product of the masses over the distance
+        stack = np.empty(max_stack, dtype=np.int64)
+        stack[0] = 0
+        top = 1
+        while top > 0:
+            top -= 1
+            node = stack[top]
+            if tree_mass[node] == 0:
+                continue
+            dist_squared = 0.0
+            for d in range(dim):
+                diff = current[d] - com[node, d]
+                dist_squared += diff * diff
+            width = 2.0 * half_widths[node]
+            if is_leaf[node] or width * width < theta_sq * dist_squared:
+                if dist_squared > 0.0:
+                    factor = scaling_ratio * mass[p] * tree_mass[node] / dist_squared
+                    for d in range(dim):
+                        force[d] += factor * (current[d] - com[node, d])
+            else:
+                for c in range(n_children):
+                    if children[node, c] >= 0:
+                        stack[top] = children[node, c]
+                        top += 1
+
+        # Gravity, towards the origin
+        distance = 0.0
+        for d in range(dim):
+            distance += current[d] * current[d]
+        distance = np.sqrt(distance)
+        if strong_gravity:
+            factor = scaling_ratio * mass[p] * gravity
+        elif distance > 0.0:
+            factor = mass[p] * gravity / distance
+        else:
+            factor = 0.0
+        for d in range(dim):
+            force[d] -= factor * current[d]
+
+        # Attraction along the edges, linear in the distance (or logarithmic in LinLog mode)
+        for e in range(indptr[p], indptr[p + 1]):
+            q = indices[e]
+            factor = -attraction_coefficient * weights[e]
+            if dissuade_hubs:
+                factor /= mass[p]
+            if lin_log:
+                distance = 0.0
+                for d in range(dim):
+                    diff = current[d] - pos[q, d]
+                    distance += diff * diff
+                distance = np.sqrt(distance)
+                if distance > 0.0:
+                    factor *= np.log(1.0 + distance) / distance
+                else:
+                    factor = 0.0
+            for d in range(dim):
+                force[d] += factor * (current[d] - pos[q, d])
+
+        for d in range(dim):
+            forces[p, d] = force[d]
+
+
+_forces_serial = _compile_kernel(_forces, parallel=False)
+_forces_parallel = _compile_kernel(_forces, parallel=True)
+
+
+def _adjust_speed(swinging, traction, n_nodes, speed, speed_efficiency, jitter_tolerance):
+    # Global speed of the Gephi implementation: increase it while nodes move consistently (traction), decrease it
+    # when they oscillate (swinging)
+    estimated_jitter = 0.05 * np.sqrt(n_nodes)
+    min_jitter = np.sqrt(estimated_jitter)
+    max_jitter = 10.0
+    jitter = jitter_tolerance * max(min_jitter, min(max_jitter, estimated_jitter * traction / n_nodes ** 2))
+    min_speed_efficiency = 0.05
+    if traction > 0 and swinging / traction > 2.0:
+        if speed_efficiency > min_speed_efficiency:
+            speed_efficiency *= 0.5
+        jitter = max(jitter, jitter_tolerance)
+    if swinging == 0:
+        return speed, speed_efficiency
+    target_speed = jitter * speed_efficiency * traction / swinging
+    if swinging > jitter * traction:
+        if speed_efficiency > min_speed_efficiency:
+            speed_efficiency *= 0.7
+    elif speed < 1000:
+        speed_efficiency *= 1.3
+    max_rise = 0.5
+    speed = speed + min(target_speed - speed, max_rise * speed)
+    return speed, speed_efficiency
+
+
+def forceatlas2(
+    adjacency,
+    pos=None,
+    iterations=100,
+    outbound_attraction_distribution=False,
+    lin_log=False,
+    edge_weight_influence=1.0,
+    jitter_tolerance=1.0,
+    barnes_hut_theta=1.2,
+    scaling_ratio=2.0,
+    strong_gravity=False,
+    gravity=1.0,
+    random_state=None,
+    parallel=True,
+    verbose=False,
+):
+    """Lay out a graph with ForceAtlas2.
+    Parameters
+    ----------
+    adjacency: sparse matrix of shape (n_nodes, n_nodes)
+        The weighted adjacency matrix of the graph (e.g. `connectivities`). It is treated as undirected:
+        non-symmetric matrices are symmetrized with their elementwise maximum.
+    pos: array of shape (n_nodes, 2) or (n_nodes, 3) (optional, default None)
+        The initial positions. If None, nodes start at random in the unit square.
+    iterations: int (optional, default 100)
+        The number of iterations.
+    outbound_attraction_distribution: bool (optional, default False)
+        Whether to divide the attraction of each node by its mass, which dissuades hubs.
+    lin_log: bool (optional, default False)
+        Whether to use the LinLog mode, where attraction grows with the logarithm of the distance. It gives
+        tighter clusters.
+    edge_weight_influence: float (optional, default 1.0)
+        Exponent applied to the edge weights. 0 ignores them.
+    jitter_tolerance: float (optional, default 1.0)
+        How much swinging is tolerated. Higher values are faster and less precise.
+    barnes_hut_theta: float (optional, default 1.2)
+        Opening angle of the Barnes-Hut approximation of the repulsion.
+    scaling_ratio: float (optional, default 2.0)
+        Strength of the repulsion. Larger values give sparser layouts.
+    strong_gravity: bool (optional, default False)
+        Whether gravity grows with the distance to the center instead of being constant.
+    gravity: float (optional, default 1.0)
+        Strength of the attraction to the center, which keeps disconnected components together.
+    random_state: int or numpy RandomState (optional, default None)
+        Seed of the random initial positions.
+    parallel: bool (optional, default True)
+        Whether to compute the forces using numba parallel. The layout is deterministic either way.
+    verbose: bool (optional, default False)
+        Whether to report progress.
+    Returns
+    -------
+    positions: array of shape (n_nodes, 2) or (n_nodes, 3)
+        The layout of the graph.
+    """
+    adjacency = csr_matrix(adjacency)
+    if (adjacency != adjacency.T).nnz:
+        adjacency = adjacency.maximum(adjacency.T)
+    adjacency = adjacency.tocoo()
+    loops = adjacency.row == adjacency.col
+    if loops.any():
+        keep = ~loops
+        adjacency = coo_matrix((adjacency.data[keep], (adjacency.row[keep], adjacency.col[keep])),
+                               shape=adjacency.shape)
+    adjacency = adjacency.tocsr()
+    adjacency.eliminate_zeros()
+    n_nodes = adjacency.shape[0]
+
+    if pos is None:
+        pos = np.random.RandomState(random_state).random_sample((n_nodes, 2))
+    pos = np.array(pos, dtype=np.float64, order='C')
+    if pos.shape[1] not in (2, 3):
+        raise Exception('ForceAtlas2 only supports 2 or 3 dimensions.')
+
+    mass = 1.0 + np.diff(adjacency.indptr).astype(np.float64)
+    weights = adjacency.data.astype(np.float64)
+    if edge_weight_influence == 0:
+        weights = np.ones_like(weights)
+    elif edge_weight_influence != 1:
+        weights = weights ** edge_weight_influence
+    attraction_coefficient = mass.mean() if outbound_attraction_distribution else 1.0
+
+    forces_fn = _forces_parallel if parallel else _forces_serial
+    forces = np.zeros_like(pos)
+    old_forces = np.zeros_like(pos)
+    speed, speed_efficiency = 1.0, 1.0
+    max_depth = 32
+    max_stack = (max_depth + 1) * (1 << pos.shape[1]) + 1
+    for n in range(iterations):
+        # Nodes are inserted in, and visited in, Z-order (see `dbmap.barnes_hut.repel`)
+        order = _morton_order(pos)
+        children, half_widths, tree_mass, com, is_leaf = build_tree(pos[order], mass[order], max_depth=max_depth)
+        forces, old_forces = old_forces, forces
+        forces_fn(pos, order, mass, adjacency.indptr, adjacency.indices, weights, children, half_widths, tree_mass,
+                  com, is_leaf, barnes_hut_theta, scaling_ratio, gravity, strong_gravity, lin_log,
+                  attraction_coefficient, outbound_attraction_distribution, max_stack, forces)
+
+        swinging = mass * np.sqrt(((forces - old_forces) ** 2).sum(axis=1))
+        traction = 0.5 * mass * np.sqrt(((forces + old_forces) ** 2).sum(axis=1))
+        speed, speed_efficiency = _adjust_speed(swinging.sum(), traction.sum(), n_nodes, speed, speed_efficiency,
+                                                jitter_tolerance)
+        factor = speed / (1.0 + np.sqrt(speed * swinging))
+        pos += forces * factor[:, None]
+
+        if verbose and n % max(int(iterations / 10), 1) == 0:
+            print('\tcompleted ', n, ' / ', iterations, 'iterations')
+
+    return pos
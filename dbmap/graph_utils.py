@@ -1,10 +1,11 @@
+import os
 import numpy as np
 import scipy.sparse
 from scipy.sparse import tril as sparse_tril, triu as sparse_triu
 import scipy.sparse.csgraph
 import numba
 import numpy as np
-from scipy.sparse import coo_matrix, issparse
+from scipy.sparse import coo_matrix, csr_matrix, issparse
 from scipy.optimize import curve_fit
 
 # from .utils import (
@@ -317,27 +318,13 @@ def compute_connectivities_adapmap(
 
 
 def get_sparse_matrix_from_indices_distances_dbmap(knn_indices, knn_dists, n_obs, n_neighbors):
-    rows = np.zeros((n_obs * n_neighbors), dtype=np.int64)
-    cols = np.zeros((n_obs * n_neighbors), dtype=np.int64)
-    vals = np.zeros((n_obs * n_neighbors), dtype=np.float64)
-
-    for i in range(knn_indices.shape[0]):
-        for j in range(n_neighbors):
-            if knn_indices[i, j] == -1:
-                continue  # We didn't get the full knn for i
-            if knn_indices[i, j] == i:
-                val = 0.0
-            else:
-                val = knn_dists[i, j]
-
-            rows[i * n_neighbors + j] = i
-            cols[i * n_neighbors + j] = knn_indices[i, j]
-            vals[i * n_neighbors + j] = val
-
-    result = coo_matrix((vals, (rows, cols)),
-                        shape=(n_obs, n_obs))
-    result.eliminate_zeros()
-    return result.tocsr()
+    knn_indices = knn_indices[:, :n_neighbors]
+    knn_dists = knn_dists[:, :n_neighbors]
+    # Self-distances and zero distances are dropped like missing neighbors (indices of -1). The masked copies are
+    # wrapped by the matrix, so that the caller's arrays are never modified.
+    dropped = (knn_indices == np.arange(knn_indices.shape[0])[:, None]) | (knn_dists == 0)
+    vals = np.where(dropped, 0, knn_dists)
+    return ann.knn_to_csr(np.where(dropped, -1, knn_indices), vals, n_obs)
 
 
 def approximate_n_neighbors(data,
@@ -431,6 +418,7 @@ def approximate_n_neighbors(data,
     return knn_inds, knn_distances
 
 
+@numba.njit(parallel=True, fastmath=True)
 def compute_membership_strengths(knn_indices, knn_dists, sigmas, rhos):
     """Construct the membership strength data for the 1-skeleton of each local
     fuzzy simplicial set -- this is formed as a sparse matrix where each row is
@@ -462,7 +450,7 @@ def compute_membership_strengths(knn_indices, knn_dists, sigmas, rhos):
     cols = np.zeros(knn_indices.size, dtype=np.int32)
     vals = np.zeros(knn_indices.size, dtype=np.float32)
 
-    for i in range(n_samples):
+    for i in numba.prange(n_samples):
         for j in range(n_neighbors):
             if knn_indices[i, j] == -1:
                 continue  # We didn't get the full knn for i
@@ -480,6 +468,16 @@ def compute_membership_strengths(knn_indices, knn_dists, sigmas, rhos):
     return rows, cols, vals
 
 
+@numba.njit(
+    parallel=True,
+    fastmath=True,
+    locals={
+        "psum": numba.types.float32,
+        "lo": numba.types.float32,
+        "mid": numba.types.float32,
+        "hi": numba.types.float32,
+    },
+)
 def smooth_knn_dist(distances, k, n_iter=64, local_connectivity=1.0, bandwidth=1.0):
     """Compute a continuous version of the distance to the kth nearest
     neighbor. That is, this is similar to knn-distance but allows continuous
@@ -518,12 +516,11 @@ def smooth_knn_dist(distances, k, n_iter=64, local_connectivity=1.0, bandwidth=1
 
     mean_distances = np.mean(distances)
 
-    for i in range(distances.shape[0]):
+    for i in numba.prange(distances.shape[0]):
         lo = 0.0
         hi = NPY_INFINITY
         mid = 1.0
 
-        # TODO: This is very inefficient, but will do for now. FIXME
         ith_distances = distances[i]
         non_zero_dists = ith_distances[ith_distances > 0.0]
         if non_zero_dists.shape[0] >= local_connectivity:
@@ -565,7 +562,6 @@ def smooth_knn_dist(distances, k, n_iter=64, local_connectivity=1.0, bandwidth=1
 
         result[i] = mid
 
-        # TODO: This is very inefficient, but will do for now. FIXME
         if rho[i] > 0.0:
             mean_ith_distances = np.mean(ith_distances)
             if result[i] < MIN_K_DIST_SCALE * mean_ith_distances:
@@ -577,26 +573,41 @@ def smooth_knn_dist(distances, k, n_iter=64, local_connectivity=1.0, bandwidth=1
     return result, rho
 
 
-def get_igraph_from_adjacency(adjacency, directed=None):
-    """Get igraph graph from adjacency matrix."""
+def get_igraph_from_adjacency(adjacency, directed=None, upper=False):
+    """Get igraph graph from adjacency matrix.
+    The edge list is built from the CSR structure with numpy, and the weights are taken from its
+    data, without indexing the matrix.
+    Parameters
+    ----------
+    adjacency: sparse matrix or array of shape (n_vertices, n_vertices)
+        The weighted adjacency matrix.
+    directed: bool (optional, default None)
+        Whether the graph is directed.
+    upper: bool (optional, default False)
+        Whether to keep only the upper triangle (including the diagonal), i.e. one edge per pair
+        of vertices of a symmetric graph.
+    Returns
+    -------
+    g: igraph.Graph
+        The graph, with edge attribute 'weight'.
+    """
     import igraph as ig
 
-    sources, targets = adjacency.nonzero()
-    weights = adjacency[sources, targets]
-    if isinstance(weights, np.matrix):
-        weights = weights.A1
-    g = ig.Graph(directed=directed)
-    g.add_vertices(adjacency.shape[0])  # this adds adjacency.shape[0] vertices
-    g.add_edges(list(zip(sources, targets)))
-    try:
-        g.es['weight'] = weights
-    except:
-        pass
-    if g.vcount() != adjacency.shape[0]:
-        print(
-            f'The constructed graph has only {g.vcount()} nodes. '
-            'Your adjacency matrix contained redundant nodes.'
-        )
+    adjacency = csr_matrix(adjacency)
+    if not adjacency.has_canonical_format:
+        adjacency = adjacency.copy()
+        adjacency.sum_duplicates()
+    sources = np.repeat(np.arange(adjacency.shape[0], dtype=adjacency.indices.dtype), np.diff(adjacency.indptr))
+    targets = adjacency.indices
+    weights = adjacency.data
+    # Explicitly stored zeros are not edges
+    keep = weights != 0
+    if upper:
+        keep &= sources <= targets
+    # igraph converts pairs of Python ints faster than rows of a numpy array
+    edges = list(zip(sources[keep].tolist(), targets[keep].tolist()))
+    g = ig.Graph(n=adjacency.shape[0], edges=edges, directed=directed)
+    g.es['weight'] = weights[keep].tolist()
     return g
 
 def make_epochs_per_sample(weights, n_epochs):
@@ -640,6 +651,9 @@ def simplicial_set_embedding(
     euclidean_output=True,
     parallel=False,
     verbose=False,
+    repulsion="sampled",
+    checkpoint_path=None,
+    checkpoint_every=50,
 ):
     """Perform a fuzzy simplicial set embedding, using a specified
     initialisation method and then minimizing the fuzzy set cross entropy
@@ -706,6 +720,16 @@ def simplicial_set_embedding(
         if a random seed has been set, to ensure reproducibility.
     verbose: bool (optional, default False)
         Whether to report information on the current progress of the algorithm.
+    repulsion: string (optional, default 'sampled')
+        How the euclidean output computes repulsive forces, either by
+        negative sampling ('sampled') or with a Barnes-Hut tree
+        ('barnes_hut'). See ``optimize_layout_euclidean``.
+    checkpoint_path: string (optional, default None)
+        A ``.npz`` file the euclidean optimization snapshots its state to
+        every ``checkpoint_every`` epochs, and resumes from if it exists.
+        See ``optimize_layout_euclidean``.
+    checkpoint_every: int (optional, default 50)
+        Number of epochs between snapshots.
     Returns
     -------
     embedding: array of shape (n_samples, n_components)
@@ -733,6 +757,10 @@ def simplicial_set_embedding(
     graph.data[graph.data < (graph.data.max() / float(n_epochs))] = 0.0
     graph.eliminate_zeros()
 
+    if euclidean_output and checkpoint_path is not None and os.path.exists(checkpoint_path):
+        # The embedding is restored from the checkpoint: skip the (spectral) initialisation
+        init = "random"
+
     if isinstance(init, str) and init == "random":
         embedding = random_state.uniform(
             low=-10.0, high=10.0, size=(graph.shape[0], n_components)
@@ -835,6 +863,9 @@ def simplicial_set_embedding(
             verbose=verbose,
             densmap=densmap,
             densmap_kwds=densmap_kwds,
+            repulsion=repulsion,
+            checkpoint_path=checkpoint_path,
+            checkpoint_every=checkpoint_every,
         )
     else:
         embedding = optimize_layout_generic(
@@ -40,7 +40,6 @@ from typing import Union, Optional
 import numpy as np
 from numpy import random
 from sklearn.base import TransformerMixin
-import networkx as nx
 AnyRandom = Union[None, int, random.RandomState]  # maybe in the future random.Generator
 
 
@@ -76,8 +75,9 @@ class force_directed_layout(TransformerMixin):
         Force-directed graph drawing [Islam11]_ [Jacomy14]_ [Chippada18]_.
         An alternative to tSNE that often preserves the topology of the data
         better. This requires to run :func:`~scanpy.pp.neighbors`, first.
-        The default layout ('fa', `ForceAtlas2`) [Jacomy14]_ uses the package |fa2|_
-        [Chippada18]_, which can be installed via `pip install fa2`.
+        The default layout ('fa', `ForceAtlas2`) [Jacomy14]_ uses the built-in numba
+        engine of :mod:`dbmap.forceatlas2`, a parallel port of the package |fa2|_
+        [Chippada18]_ with Barnes-Hut repulsion.
         `Force-directed graph drawing`_ describes a class of long-established
         algorithms for visualizing graphs.
         It has been suggested for visualizing single-cell data by [Islam11]_.
@@ -111,7 +111,8 @@ class force_directed_layout(TransformerMixin):
 
         **kwds
             Parameters of chosen igraph layout. See e.g. `fruchterman-reingold`_
-            [Fruchterman91]_. One of the most important ones is `maxiter`.
+            [Fruchterman91]_. One of the most important ones is `maxiter`. For 'fa',
+            parameters of :func:`dbmap.forceatlas2.forceatlas2` (e.g. `lin_log`).
             .. _fruchterman-reingold: http://igraph.org/python/doc/igraph.Graph-class.html#layout_fruchterman_reingold
         Returns
         -------
@@ -184,53 +185,29 @@ class force_directed_layout(TransformerMixin):
         return self
 
     def transform(self, X, y=None, **fit_params):
-        # see whether fa2 is installed
+        import networkx as nx
         self.G = nx.random_geometric_graph(400, 0.2)
-        if self.layout == 'fa':
-            try:
-                from fa2 import ForceAtlas2
-            except ImportError:
-                print(
-                    "Package 'fa2' is not installed, falling back to layout 'lgl'."
-                    "To use the faster and better ForceAtlas2 layout, "
-                    "install package 'fa2' (`pip install fa2`)."
-                )
-                self.layout = 'fr'
         # actual drawing
         if self.layout == 'fa':
-            forceatlas2 = ForceAtlas2(
-                # Behavior alternatives
-                outboundAttractionDistribution=False,  # Dissuade hubs
-                linLogMode=False,  # NOT IMPLEMENTED
-                adjustSizes=False,  # Prevent overlap (NOT IMPLEMENTED)
-                edgeWeightInfluence=1.0,
-                # Performance
-                jitterTolerance=1.0,  # Tolerance
-                barnesHutOptimize=True,
-                barnesHutTheta=1.2,
-                multiThreaded=False,  # NOT IMPLEMENTED
-                # Tuning
-                scalingRatio=2.0,
-                strongGravityMode=False,
-                gravity=1.0,
-                # Log
-                verbose=False,
-            )
+            # The ForceAtlas2 kernels are compiled when imported: only import them when needed
+            from .forceatlas2 import forceatlas2
+            fa_kwds = {k: v for k, v in self.kwds.items() if k not in ('maxiter', 'iterations')}
             if 'maxiter' in self.kwds:
                 iterations = self.kwds['maxiter']
             elif 'iterations' in self.kwds:
                 iterations = self.kwds['iterations']
             else:
                 iterations = 500
-            positions = forceatlas2.forceatlas2(
-                self.connectivities, pos=self.init_coords, iterations=iterations
+            fa_kwds.setdefault('parallel', self.n_jobs != 1)
+            self.positions = forceatlas2(
+                self.connectivities, pos=self.init_coords, iterations=iterations, **fa_kwds
             )
-            positions = np.array(positions)
         else:
             # igraph doesn't use numpy seed
             random.seed(self.random_state)
 
-            self.G = graph_utils.get_igraph_from_adjacency(self.connectivities)
+            # The connectivities are symmetric: one edge per pair of cells
+            self.G = graph_utils.get_igraph_from_adjacency(self.connectivities, upper=True)
             if self.layout in {'fr', 'drl', 'kk', 'grid_fr'}:
                 ig_layout =  self.G.layout(self.layout, seed=self.init_coords.tolist(), **self.kwds)
             elif 'rt' in self.layout:
@@ -239,13 +216,15 @@ class force_directed_layout(TransformerMixin):
                 ig_layout =  self.G.layout(self.layout, root=self.root, **self.kwds)
             else:
                 ig_layout =  self.G.layout(self.layout, **self.kwds)
+            self.positions = np.array(ig_layout.coords)
 
-        self.positions = np.array(ig_layout.coords)
+        return self.positions
 
 
     def plot_graph(self, node_size=20, with_labels=False, node_color="blue", node_alpha=0.4, plot_edges=True,
                    edge_color="green", edge_alpha=0.05):
         import matplotlib.pyplot as plt
+        import networkx as nx
         nx.draw_networkx_nodes(self.G, self.positions, node_size=20, with_labels=False, node_color="blue",
                                alpha=node_alpha)
         if plot_edges:
@@ -67,21 +67,38 @@ except ImportError:
         class Literal(metaclass=LiteralMeta):
             pass
 
-from .graph_utils import simplicial_set_embedding, find_ab_params
+import os
 
-from sklearn.base import TransformerMixin
+from scipy.sparse import csr_matrix
+from sklearn.neighbors import NearestNeighbors
 
+from . import ann
+from . import diffusion
+from . import graph_utils
+from .cache import ArtifactCache, artifact_key
+from .graph_utils import fuzzy_simplicial_set_nmslib, find_ab_params
 
+from sklearn.base import BaseEstimator, TransformerMixin
 
-class MAP(TransformerMixin):
+
+
+class MAP(BaseEstimator, TransformerMixin):
     """
     Sklearn estimator for Manifold Approximation and Projection that allows one to do
     both uniform and pairwise-controlled optimizations (as in UMAP and PaCMAP). Additionally,
     we implement the diffusion-controlled optimization, which is more stable and gives generally better results.
 
+    Fitting runs five stages in order: the kNN graph of the data (`knn`), the adaptive diffusion kernel (`kernel`),
+    its eigendecomposition into multiscaled structure components (`eigen`), the fuzzy simplicial set of the structure
+    components (`graph`) and the layout optimization (`layout`). Each stage result is kept on the estimator, and fitting
+    the same data again only reruns the stages whose parameters (or upstream stages) changed. For instance, changing
+    `min_dist`, `spread` or `n_epochs` with `set_params` only reruns the layout.
+
     Parameters
     ----------
 
+    layout_method : Layout optimization. Either 'pairwise' (PaCMAP) or 'uniform' (UMAP). Defaults to 'pairwise'.
+
     n_components : Number of diffusion components to compute. Defaults to 100. We suggest larger values if
                    analyzing more than 10,000 cells.
 
@@ -97,6 +114,39 @@ class MAP(TransformerMixin):
     alpha : Alpha in the diffusion maps literature. Controls how much the results are biased by data distribution.
             Defaults to 1, which is suitable for normalized data.
 
+    eigen_solver : Which eigensolver to use for the diffusion operator. See `dbmap.diffusion.Diffusor`.
+
+    dtype : Floating point precision of the diffusion kernel and eigendecomposition, either 'float64' (default)
+            or 'float32'. See `dbmap.diffusion.Diffusor`.
+
+    n_dims : Number of dimensions of the layout. Defaults to 2.
+
+    min_dist, spread : Effective minimum distance and scale of embedded points in the 'uniform' layout.
+
+    n_epochs : Number of layout optimization epochs (iterations, for the 'pairwise' layout).
+
+    initial_alpha : Initial learning rate of the layout optimization.
+
+    gamma, negative_sample_rate : Weight and number of negative samples in the 'uniform' layout.
+
+    repulsion : How the 'uniform' layout computes repulsive forces. Either 'sampled' (negative sampling, default)
+                or 'barnes_hut' (a quadtree or octree of the layout, for 2 or 3 `n_dims`).
+
+    init : Layout initialization. 'spectral', 'random' or an array for the 'uniform' layout. The 'pairwise' layout
+           starts from an array if given, else from PCA.
+
+    random_state : Seed or numpy RandomState of the 'uniform' layout.
+
+    set_op_mix_ratio, local_connectivity : Fuzzy union parameters of the graph stage, as in UMAP.
+
+    parallel : Whether to run the 'uniform' layout with numba parallel.
+
+    cache_dir : Directory of an on-disk cache of stage results (see `dbmap.cache.ArtifactCache`), shared across
+                estimators and sessions. Defaults to None (no cache).
+
+    cache_max_bytes : Size bound of the cache, in bytes. Least recently used results are evicted beyond it.
+                      Defaults to None (unbounded).
+
     n_jobs : Number of threads to use in calculations. Defaults to all but one.
 
     verbose : controls verbosity.
@@ -104,8 +154,8 @@ class MAP(TransformerMixin):
 
     Returns
     -------------
-        Diffusion components ['EigenVectors'], associated eigenvalues ['EigenValues'] and suggested number of
-        resulting components to use during Multiscaling.
+        The layout of the data, also kept as `embedding_`. The structure components (`structure_`), the diffusion
+        graph (`graph_`), the fitted `Diffusor` (`diffusor_`) and the kNN graph of the data (`knn_`) are kept as well.
 
     Example
     -------------
@@ -117,14 +167,28 @@ class MAP(TransformerMixin):
 
     # Load the MNIST digits data, convert to sparse for speed
     digits = load_digits()
-    data = csr_matrix(digits)
+    data = csr_matrix(digits.data)
 
-    # Fit the anisotropic diffusion process
-    diff = dbmap.diffusion.Diffusor()
-    res = diff.fit_transform(data)
+    # Fit the whole pipeline, then only re-run the layout with tighter clusters
+    mapper = dbmap.map.MAP(layout_method='uniform')
+    emb = mapper.fit_transform(data)
+    emb = mapper.set_params(min_dist=0.3).fit_transform(data)
 
     """
 
+    _stage_params = (
+        ('knn', ('n_neighbors', 'ann', 'ann_dist', 'knn_dist', 'p', 'M', 'efC', 'efS')),
+        ('kernel', ('alpha', 'kernel_use', 'transitions', 'norm', 'dtype')),
+        ('eigen', ('n_components', 'eigengap', 'eigen_solver')),
+        ('graph', ('set_op_mix_ratio', 'local_connectivity')),
+        ('layout', ('layout_method', 'n_dims', 'min_dist', 'spread', 'n_epochs', 'initial_alpha', 'gamma',
+                    'negative_sample_rate', 'repulsion', 'init', 'random_state', 'parallel')),
+    )
+
+    # Diffusor attributes built in `Diffusor.fit`, stored by the kernel stage
+    _kernel_artifacts = ('N', 'K', 'T', 'norm_factors', 'kernel_sums', 'adap_sd', 'pm', 'knn_radius', 'knn_width',
+                         'adap_nbr', 'k_adaptive')
+
     def __init__(self,
                  layout_method='pairwise',
                  n_components=50,
@@ -142,7 +206,25 @@ class MAP(TransformerMixin):
                  transitions=True,
                  eigengap=True,
                  norm=False,
+                 eigen_solver='arpack',
+                 dtype='float64',
+                 n_dims=2,
+                 min_dist=0.6,
+                 spread=1.2,
+                 n_epochs=500,
+                 initial_alpha=1,
+                 gamma=1,
+                 negative_sample_rate=5,
+                 repulsion='sampled',
+                 init='spectral',
+                 random_state=None,
+                 set_op_mix_ratio=1.0,
+                 local_connectivity=1.0,
+                 parallel=True,
+                 cache_dir=None,
+                 cache_max_bytes=None,
                  verbose=True):
+        self.layout_method = layout_method
         self.n_components = n_components
         self.n_neighbors = n_neighbors
         self.alpha = alpha
@@ -158,8 +240,254 @@ class MAP(TransformerMixin):
         self.transitions = transitions
         self.eigengap = eigengap
         self.norm = norm
+        self.eigen_solver = eigen_solver
+        self.dtype = dtype
+        self.n_dims = n_dims
+        self.min_dist = min_dist
+        self.spread = spread
+        self.n_epochs = n_epochs
+        self.initial_alpha = initial_alpha
+        self.gamma = gamma
+        self.negative_sample_rate = negative_sample_rate
+        self.repulsion = repulsion
+        self.init = init
+        self.random_state = random_state
+        self.set_op_mix_ratio = set_op_mix_ratio
+        self.local_connectivity = local_connectivity
+        self.parallel = parallel
+        self.cache_dir = cache_dir
+        self.cache_max_bytes = cache_max_bytes
         self.verbose = verbose
 
+    def _stage_keys(self, data):
+        # Each stage key hashes the data fingerprint and the parameters of the stage and of all upstream stages.
+        keys = {}
+        key = ann.data_fingerprint(data)
+        for stage, params in self._stage_params:
+            values = {}
+            for name in params:
+                value = getattr(self, name)
+                values[name] = ann.data_fingerprint(value) if isinstance(value, np.ndarray) else repr(value)
+            key = artifact_key(key, stage, values)
+            keys[stage] = key
+        return keys
+
+    def _knn_estimator(self):
+        if self.ann:
+            return ann.NMSlibTransformer(n_neighbors=self.n_neighbors,
+                                         metric=self.ann_dist,
+                                         p=self.p,
+                                         method='hnsw',
+                                         n_jobs=self.n_jobs,
+                                         M=self.M,
+                                         efC=self.efC,
+                                         efS=self.efS,
+                                         verbose=self.verbose)
+        return NearestNeighbors(n_neighbors=int(self.n_neighbors), metric=self.knn_dist, n_jobs=self.n_jobs)
+
+    def _fit_knn(self, data):
+        nbrs = self._knn_estimator().fit(data)
+        if self.ann:
+            knn = nbrs.transform(data)
+        else:
+            knn = nbrs.kneighbors_graph(data, mode='distance')
+        self.knn_, self.nbrs_ = knn, nbrs
+
+    def _save_knn(self, key):
+        entry = self.cache_.save(key, {'knn': self.knn_})
+        if self.ann:
+            # Keep the index too, so that cache hits can still query it (e.g. for out-of-sample data)
+            self.nbrs_.save_index(os.path.join(entry, 'index'))
+            self.cache_.evict(keep=key)
+
+    def _load_knn(self, data, artifacts):
+        self.knn_ = artifacts['knn']
+        if self.ann:
+            index = os.path.join(self.cache_.entry_dir(self.stage_keys_['knn']), 'index')
+            self.nbrs_ = self._knn_estimator().load_index(index) if os.path.exists(index + '.json') else None
+        else:
+            # Fitting an exact estimator only builds its search structure, without querying it
+            self.nbrs_ = self._knn_estimator().fit(data)
+
+    def _diffusor(self):
+        return diffusion.Diffusor(n_components=self.n_components,
+                                  n_neighbors=self.n_neighbors,
+                                  alpha=self.alpha,
+                                  n_jobs=self.n_jobs,
+                                  ann=self.ann,
+                                  ann_dist=self.ann_dist,
+                                  p=self.p,
+                                  M=self.M,
+                                  efC=self.efC,
+                                  efS=self.efS,
+                                  knn_dist=self.knn_dist,
+                                  kernel_use=self.kernel_use,
+                                  transitions=self.transitions,
+                                  eigengap=self.eigengap,
+                                  norm=self.norm,
+                                  eigen_solver=self.eigen_solver,
+                                  dtype=self.dtype,
+                                  verbose=self.verbose)
+
+    def _fit_kernel(self, data):
+        self.diffusor_ = self._diffusor().fit(data, knn=self.knn_, nbrs=self.nbrs_)
+
+    def _save_kernel(self, key):
+        self.cache_.save(key, {name: getattr(self.diffusor_, name, None) for name in self._kernel_artifacts})
+
+    def _load_kernel(self, data, artifacts):
+        diff = self._diffusor()
+        for name in self._kernel_artifacts:
+            if name in artifacts:
+                setattr(diff, name, artifacts[name])
+        diff.fingerprint = ann.data_fingerprint(data)
+        diff.start_time = time.time()
+        diff.res = None
+        diff.anbrs, diff.nbrs = (self.nbrs_, None) if self.ann else (None, self.nbrs_)
+        self.diffusor_ = diff
+
+    def _fit_eigen(self, data):
+        self.diffusor_.n_components = self.n_components
+        self.diffusor_.eigengap = self.eigengap
+        self.diffusor_.eigen_solver = self.eigen_solver
+        self.structure_ = np.ascontiguousarray(self.diffusor_.transform(data), dtype=np.float32)
+
+    def _save_eigen(self, key):
+        res = self.diffusor_.res
+        self.cache_.save(key, {'EigenVectors': np.asarray(res['EigenVectors']),
+                               'EigenValues': np.asarray(res['EigenValues']),
+                               'MultiscaleComponents': np.asarray(res['MultiscaleComponents']),
+                               'n_components': self.diffusor_.n_components})
+
+    def _load_eigen(self, data, artifacts):
+        self.diffusor_.n_components = artifacts['n_components']
+        self.diffusor_.res = {'EigenVectors': pd.DataFrame(artifacts['EigenVectors']),
+                              'EigenValues': pd.Series(artifacts['EigenValues']),
+                              'kernel': self.diffusor_.K,
+                              'MultiscaleComponents': pd.DataFrame(artifacts['MultiscaleComponents'])}
+        self.structure_ = np.ascontiguousarray(artifacts['MultiscaleComponents'], dtype=np.float32)
+
+    def _fit_graph(self, data):
+        # kNN of the structure components, as in `Diffusor.ind_dist_grad`
+        if self.ann:
+            gnbrs = ann.NMSlibTransformer(n_neighbors=self.n_neighbors,
+                                          metric='cosine',
+                                          method='hnsw',
+                                          n_jobs=self.n_jobs,
+                                          M=self.M,
+                                          efC=self.efC,
+                                          efS=self.efS,
+                                          dense=True,
+                                          verbose=self.verbose).fit(self.structure_)
+            ind, dists = gnbrs.kneighbors(self.structure_)
+        else:
+            dists, ind = NearestNeighbors(n_neighbors=int(self.n_neighbors), metric='cosine',
+                                          n_jobs=self.n_jobs).fit(self.structure_).kneighbors(self.structure_)
+        self.graph_knn_indices_, self.graph_knn_dists_ = ind, dists
+        graph, _, _ = fuzzy_simplicial_set_nmslib(self.structure_,
+                                                  self.n_neighbors,
+                                                  knn_indices=ind,
+                                                  knn_dists=dists,
+                                                  set_op_mix_ratio=self.set_op_mix_ratio,
+                                                  local_connectivity=self.local_connectivity,
+                                                  verbose=self.verbose)
+        self.graph_ = csr_matrix(graph)
+
+    def _save_graph(self, key):
+        self.cache_.save(key, {'graph': self.graph_,
+                               'knn_indices': self.graph_knn_indices_,
+                               'knn_dists': self.graph_knn_dists_})
+
+    def _load_graph(self, data, artifacts):
+        self.graph_ = artifacts['graph']
+        self.graph_knn_indices_ = artifacts['knn_indices']
+        self.graph_knn_dists_ = artifacts['knn_dists']
+
+    def _fit_layout(self, data):
+        if self.layout_method == 'uniform':
+            # The layout prunes the graph in place, so that it is given a copy to keep `graph_` reusable
+            self.embedding_, _ = simplicial_set_embedding(self.structure_,
+                                                          self.graph_.copy(),
+                                                          n_components=self.n_dims,
+                                                          initial_alpha=self.initial_alpha,
+                                                          min_dist=self.min_dist,
+                                                          spread=self.spread,
+                                                          n_epochs=self.n_epochs,
+                                                          metric='cosine',
+                                                          gamma=self.gamma,
+                                                          negative_sample_rate=self.negative_sample_rate,
+                                                          repulsion=self.repulsion,
+                                                          init=self.init,
+                                                          random_state=self.random_state,
+                                                          parallel=self.parallel,
+                                                          njobs=self.n_jobs,
+                                                          verbose=self.verbose)
+        else:
+            # PaCMAP kernels are compiled when imported: only import them when needed
+            from .pacmapper import PaCMAP
+            # The cosine kNN of the graph stage, as the angular distances PaCMAP works with
+            pacmapper = PaCMAP(n_dims=self.n_dims,
+                               n_neighbors=self.n_neighbors - 1,
+                               distance='angular',
+                               lr=self.initial_alpha,
+                               num_iters=self.n_epochs,
+                               verbose=self.verbose,
+                               knn_indices=self.graph_knn_indices_,
+                               knn_dists=np.sqrt(2.0 * np.maximum(self.graph_knn_dists_, 0.0)))
+            init = self.init if isinstance(self.init, np.ndarray) else None
+            self.embedding_ = pacmapper.fit_transform(self.structure_.copy(), init=init)
+
+    def _save_layout(self, key):
+        self.cache_.save(key, {'embedding': self.embedding_})
+
+    def _load_layout(self, data, artifacts):
+        self.embedding_ = np.array(artifacts['embedding'])
+
+    def fit(self, data):
+        """Fits the staged MAP pipeline to the data, rerunning only the stages whose inputs changed
+        since the last fit. If `cache_dir` is set, stages are also looked up in (and stored to) the on-disk cache.
+        :param data: input data. Takes in numpy arrays and scipy csr sparse matrices.
+        """
+        if self.layout_method not in ['pairwise', 'uniform']:
+            raise Exception('Layout method must be either \'pairwise\' or \'uniform\'.')
+        keys = self._stage_keys(data)
+        if not hasattr(self, 'stage_keys_'):
+            self.stage_keys_ = {}
+        self.cache_ = None if self.cache_dir is None else ArtifactCache(self.cache_dir, self.cache_max_bytes)
+        for stage, _ in self._stage_params:
+            if self.stage_keys_.get(stage) == keys[stage]:
+                if self.verbose:
+                    print('Reusing ' + stage + ' stage.')
+                continue
+            start = time.time()
+            artifacts = None if self.cache_ is None else self.cache_.load(keys[stage])
+            # The key is recorded before loading (which looks it up), and dropped again if the stage does not
+            # complete, so that an interrupted fit never reuses a stage it left half done
+            self.stage_keys_[stage] = keys[stage]
+            try:
+                if artifacts is not None:
+                    getattr(self, '_load_' + stage)(data, artifacts)
+                else:
+                    getattr(self, '_fit_' + stage)(data)
+            except BaseException:
+                self.stage_keys_.pop(stage, None)
+                raise
+            if artifacts is not None:
+                if self.verbose:
+                    print('Loaded ' + stage + ' stage from cache in %f (sec)' % (time.time() - start))
+                continue
+            if self.cache_ is not None:
+                getattr(self, '_save_' + stage)(keys[stage])
+            if self.verbose:
+                print('Computed ' + stage + ' stage in %f (sec)' % (time.time() - start))
+        return self
+
+    def fit_transform(self, data, y=None):
+        """Fits the staged MAP pipeline to the data and returns its layout.
+        :param data: input data. Takes in numpy arrays and scipy csr sparse matrices.
+        """
+        return self.fit(data).embedding_
+
 
 def simplicial_set_embedding(data,
                     graph,
@@ -174,7 +502,7 @@ def simplicial_set_embedding(data,
                     output_metric_kwds=None,
                     gamma=1,
                     negative_sample_rate=5,
-                    init='diffuse_spectral',
+                    init='spectral',
                     random_state=None,
                     euclidean_output=True,
                     parallel=True,
@@ -184,7 +512,10 @@ def simplicial_set_embedding(data,
                     b=None,
                     densmap=False,
                     densmap_kwds=None,
-                    output_dens=False
+                    output_dens=False,
+                    repulsion='sampled',
+                    checkpoint_path=None,
+                    checkpoint_every=50
                     ):
     """\
     Perform a fuzzy simplicial set embedding, using a specified
@@ -255,6 +586,17 @@ def simplicial_set_embedding(data,
         if a random seed has been set, to ensure reproducibility.
     verbose: bool (optional, default False)
         Whether to report information on the current progress of the algorithm.
+    repulsion: string (optional, default 'sampled')
+        How the euclidean output computes repulsive forces, either by
+        negative sampling ('sampled') or with a Barnes-Hut tree
+        ('barnes_hut'), for 2 or 3 components.
+    checkpoint_path: string (optional, default None)
+        A ``.npz`` file to snapshot the optimization state to every
+        ``checkpoint_every`` epochs. If it exists, the optimization resumes
+        from it (with the same graph and parameters), and it is removed
+        once the optimization completes.
+    checkpoint_every: int (optional, default 50)
+        Number of epochs between snapshots.
     Returns
     -------
     embedding: array of shape (n_samples, n_components)
@@ -271,6 +613,11 @@ def simplicial_set_embedding(data,
         _metric_kwds = metric_kwds
     if output_metric_kwds is None:
         _output_metric_kwds = {}
+    else:
+        _output_metric_kwds = output_metric_kwds
+    if densmap_kwds is None:
+        densmap_kwds = {}
+    random_state = check_random_state(random_state)
 
     # Compat for umap 0.4 -> 0.5
     if a is None or b is None:
@@ -281,7 +628,7 @@ def simplicial_set_embedding(data,
         # the data matrix X is really only used for determining the number of connected components
         # for the init condition in the UMAP embedding (high-resolution spectral layout)
     start_time = time.time()
-    X_map = simplicial_set_embedding(data,
+    X_map = graph_utils.simplicial_set_embedding(data,
                                       graph,
                                       n_components,
                                       initial_alpha,
@@ -293,15 +640,18 @@ def simplicial_set_embedding(data,
                                       init,
                                       random_state,
                                       metric,
-                                      metric_kwds,
+                                      _metric_kwds,
                                       densmap,
                                       densmap_kwds,
                                       output_dens,
-                                      output_metric,
-                                      output_metric_kwds,
+                                      graph_utils.dist.named_distances_with_gradients[output_metric],
+                                      _output_metric_kwds,
                                       euclidean_output,
                                       parallel,
-                                      verbose)
+                                      verbose,
+                                      repulsion,
+                                      checkpoint_path,
+                                      checkpoint_every)
     end_time = time.time()
     if verbose:
         print('Layout optimization time = %f (sec), '
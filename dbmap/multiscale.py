@@ -1,21 +1,47 @@
 import numpy as np
 import pandas as pd
 
-def multiscale(res, n_eigs=None):
-    """Determine multi scale space of the data
+
+def multiscale_components(evecs, evals, n_eigs=None, t=None, out=None, dtype=None, verbose=True):
+    """Scales diffusion eigenvectors into the multiscale space of the data, without pandas round-trips.
+          :param evecs: eigenvectors, array of shape (n_samples, n_components), in descending order of eigenvalue.
+          :param evals: eigenvalues, array of shape (n_components,).
           :param n_eigs: Number of eigen vectors to use. If None specified, the number
                  of eigen vectors will be determined using eigen gap identification.
-          :return: Multi scaled data matrix
+          :param t: diffusion time. If None, components are scaled by lambda / (1 - lambda), i.e. summed over
+                 all diffusion times. Otherwise, components are scaled by lambda ** t.
+          :param out: optional array of shape (n_samples, >= n_eigs) to write the components to. Pass `evecs` itself
+                 to scale the eigenvectors in place.
+          :param dtype: data type of the components, if `out` is not given. Defaults to the type of `evecs`.
+          :return: Multi scaled data matrix, of shape (n_samples, n_eigs) (a view of `out` if given).
     """
+    evals = np.asarray(evals)
     if n_eigs is None:
-        vals = np.array(res["EigenValues"])
-        n_eigs = np.sum( vals > 0, axis=0)
-    # Multiscale diffusion
-    use_eigs = list(range(n_eigs))
-    ev = res['EigenValues']
-    eig_vals = np.ravel(ev.reindex(use_eigs))
-    ms_data = res["EigenVectors"].values[:, use_eigs] * (eig_vals / (1 - eig_vals))
-    ms_data = pd.DataFrame(ms_data, index=res["EigenVectors"].index)
-    print('Automatically selected and multiscaled ' + str(round(n_eigs)) +
-          ' diffusion components.')
-    return ms_data
+        n_eigs = int(np.sum(evals > 0, axis=0))
+    eig_vals = evals[:n_eigs]
+    if t is None:
+        scale = eig_vals / (1 - eig_vals)
+    else:
+        scale = eig_vals ** t
+    if out is None:
+        out = np.empty((evecs.shape[0], n_eigs), dtype=evecs.dtype if dtype is None else dtype)
+    out = out[:, :n_eigs]
+    np.multiply(evecs[:, :n_eigs], scale.astype(out.dtype), out=out)
+    if verbose:
+        print('Automatically selected and multiscaled ' + str(round(n_eigs)) +
+              ' diffusion components.')
+    return out
+
+
+def multiscale(res, n_eigs=None, t=None):
+    """Determine multi scale space of the data
+          :param res: dictionary with 'EigenVectors' (DataFrame or array) and 'EigenValues' (Series or array).
+          :param n_eigs: Number of eigen vectors to use. If None specified, the number
+                 of eigen vectors will be determined using eigen gap identification.
+          :param t: diffusion time (see `multiscale_components`).
+          :return: Multi scaled data matrix, as a DataFrame viewing the components (not copying them).
+    """
+    evecs = res['EigenVectors']
+    index = evecs.index if isinstance(evecs, pd.DataFrame) else None
+    ms_data = multiscale_components(np.asarray(evecs), res['EigenValues'], n_eigs=n_eigs, t=t)
+    return pd.DataFrame(ms_data, index=index, copy=False)
@@ -75,15 +75,18 @@
 import numpy as np
 from sklearn.base import BaseEstimator
 import numba
-from annoy import AnnoyIndex
+from sklearn.neighbors import NearestNeighbors
+from . import ann
+from .cache import save_checkpoint, load_checkpoint
 from sklearn.decomposition import TruncatedSVD
 from sklearn.decomposition import PCA
+import os
 import time
 import math
 import datetime
 import warnings
 
-@numba.njit("f4(f4[:])")
+@numba.njit("f4(f4[:])", cache=True)
 def l2_norm(x):
     """
     L2 norm of a vector.
@@ -94,7 +97,7 @@ def l2_norm(x):
     return np.sqrt(result)
 
 
-@numba.njit("f4(f4[:],f4[:])")
+@numba.njit("f4(f4[:],f4[:])", cache=True)
 def euclid_dist(x1, x2):
     """
     Euclidean distance between two vectors.
@@ -105,7 +108,7 @@ def euclid_dist(x1, x2):
     return np.sqrt(result)
 
 
-@numba.njit("f4(f4[:],f4[:])")
+@numba.njit("f4(f4[:],f4[:])", cache=True)
 def manhattan_dist(x1, x2):
     """
     Manhattan distance between two vectors.
@@ -116,7 +119,7 @@ def manhattan_dist(x1, x2):
     return result
 
 
-@numba.njit("f4(f4[:],f4[:])")
+@numba.njit("f4(f4[:],f4[:])", cache=True)
 def angular_dist(x1, x2):
     """
     Angular (i.e. cosine) distance between two vectors.
@@ -129,7 +132,7 @@ def angular_dist(x1, x2):
     return np.sqrt(2.0 - 2.0 * result / x1_norm / x2_norm)
 
 
-@numba.njit("f4(f4[:],f4[:])")
+@numba.njit("f4(f4[:],f4[:])", cache=True)
 def hamming_dist(x1, x2):
     """
     Hamming distance between two vectors.
@@ -152,7 +155,7 @@ def calculate_dist(x1, x2, distance_index):
     elif distance_index == 3:
         return hamming_dist(x1, x2)
 
-@numba.njit("i4[:](i4,i4,i4[:])", nogil=True)
+@numba.njit("i4[:](i4,i4,i4[:])", cache=True, nogil=True)
 def sample_FP(n_samples, maximum, reject_ind):
     result = np.empty(n_samples, dtype=np.int32)
     for i in range(n_samples):
@@ -170,7 +173,7 @@ def sample_FP(n_samples, maximum, reject_ind):
         result[i] = j
     return result
 
-@numba.njit("i4[:,:](f4[:,:],f4[:,:],i4[:,:],i4)", parallel=True, nogil=True)
+@numba.njit("i4[:,:](f4[:,:],f4[:,:],i4[:,:],i4)", cache=True, parallel=True, nogil=True)
 def sample_neighbors_pair(X, scaled_dist, nbrs, n_neighbors):
     n = X.shape[0]
     pair_neighbors = np.empty((n*n_neighbors, 2), dtype=np.int32)
@@ -182,7 +185,7 @@ def sample_neighbors_pair(X, scaled_dist, nbrs, n_neighbors):
             pair_neighbors[i*n_neighbors + j][1] = nbrs[i][scaled_sort[j]]
     return pair_neighbors
 
-@numba.njit("i4[:,:](f4[:,:],i4)", nogil=True)
+@numba.njit("i4[:,:](f4[:,:],i4)", cache=True, nogil=True)
 def sample_MN_pair(X, n_MN):
     n = X.shape[0]
     pair_MN = np.empty((n*n_MN, 2), dtype=np.int32)
@@ -201,7 +204,7 @@ def sample_MN_pair(X, n_MN):
     return pair_MN
 
 
-@numba.njit("i4[:,:](f4[:,:],i4[:,:],i4,i4)", parallel=True, nogil=True)
+@numba.njit("i4[:,:](f4[:,:],i4[:,:],i4,i4)", cache=True, parallel=True, nogil=True)
 def sample_FP_pair(X, pair_neighbors, n_neighbors, n_FP):
     n = X.shape[0]
     pair_FP = np.empty((n * n_FP, 2), dtype=np.int32)
@@ -212,7 +215,7 @@ def sample_FP_pair(X, pair_neighbors, n_neighbors, n_FP):
             pair_FP[i*n_FP + k][1] = FP_index[k]
     return pair_FP
 
-@numba.njit("f4[:,:](f4[:,:],f4[:],i4[:,:])", parallel=True, nogil=True)
+@numba.njit("f4[:,:](f4[:,:],f4[:],i4[:,:])", cache=True, parallel=True, nogil=True)
 def scale_dist(knn_distance, sig, nbrs):
     n, num_neighbors = knn_distance.shape
     scaled_dist = np.zeros((n, num_neighbors), dtype=np.float32)
@@ -221,32 +224,77 @@ def scale_dist(knn_distance, sig, nbrs):
             scaled_dist[i, j] = knn_distance[i, j] ** 2 / sig[i] / sig[nbrs[i, j]]
     return scaled_dist
 
+def find_neighbors(X, n_neighbors, distance='euclidean'):
+    """
+    Batched nearest-neighbor search with NMSlib's HNSW index, excluding each point itself.
+    Distances are returned in the same units as the `distance` functions above.
+    """
+    n, dim = X.shape
+    if distance == 'hamming':
+        # NMSlib only offers Hamming distances on bit strings; use an exact search instead.
+        nbrs = NearestNeighbors(n_neighbors=n_neighbors + 1, metric='hamming').fit(X)
+        knn_distances, knn_indices = nbrs.kneighbors(X)
+        knn_distances = knn_distances * dim
+    else:
+        metric = {'euclidean': 'euclidean',
+                  'manhattan': 'l1',
+                  'angular': 'cosine'}[distance]
+        anbrs = ann.NMSlibTransformer(n_neighbors=n_neighbors + 1, metric=metric, dense=True, verbose=False)
+        anbrs.fit(X)
+        knn_indices, knn_distances = anbrs.kneighbors(X, n_neighbors=n_neighbors + 1)
+        # NMSlib's 'l2' space reports squared distances, and 'cosine' reports 1 - cos
+        if distance == 'euclidean':
+            knn_distances = np.sqrt(np.maximum(knn_distances, 0.0))
+        elif distance == 'angular':
+            knn_distances = np.sqrt(2.0 * np.maximum(knn_distances, 0.0))
+    return drop_self_neighbors(knn_indices, knn_distances)
+
+def drop_self_neighbors(knn_indices, knn_dists):
+    """
+    Removes each point from its own neighbor list. Rows in which the point was not
+    returned (approximate search, or duplicated points) drop their farthest neighbor instead.
+    """
+    n, k = knn_indices.shape
+    is_self = knn_indices == np.arange(n)[:, None]
+    missing = ~is_self.any(axis=1)
+    is_self[missing, -1] = True
+    # keep a single removed entry per row
+    is_self &= np.cumsum(is_self, axis=1) == 1
+    keep = ~is_self
+    return (knn_indices[keep].reshape(n, k - 1).astype(np.int32),
+            knn_dists[keep].reshape(n, k - 1).astype(np.float32))
+
 def generate_pair(
         X,
         n_neighbors,
         n_MN,
         n_FP,
         distance='euclidean',
-        verbose=True
+        verbose=True,
+        knn_indices=None,
+        knn_dists=None
 ):
     n, dim = X.shape
-    n_neighbors_extra = min(n_neighbors + 50, n)
-    tree = AnnoyIndex(dim, metric=distance)
-    for i in range(n):
-        tree.add_item(i, X[i, :])
-    tree.build(20)
-
-    nbrs = np.zeros((n, n_neighbors_extra), dtype=np.int32)
-    knn_distances = np.empty((n, n_neighbors_extra), dtype=np.float32)
-
-    for i in range(n):
-        nbrs_ = tree.get_nns_by_item(i, n_neighbors_extra+1)
-        nbrs[i, :] = nbrs_[1:]
-        for j in range(n_neighbors_extra):
-            knn_distances[i, j] = tree.get_distance(i, nbrs[i, j])
+    if knn_indices is None or knn_dists is None:
+        n_neighbors_extra = min(n_neighbors + 50, n - 1)
+        nbrs, knn_distances = find_neighbors(X, n_neighbors_extra, distance)
+    else:
+        knn_indices = np.asarray(knn_indices)
+        knn_dists = np.asarray(knn_dists)
+        if np.any(knn_indices == np.arange(n)[:, None]):
+            nbrs, knn_distances = drop_self_neighbors(knn_indices, knn_dists)
+        else:
+            nbrs, knn_distances = knn_indices.astype(np.int32), knn_dists.astype(np.float32)
+        if nbrs.shape[1] < n_neighbors:
+            raise ValueError("Precomputed kNN must hold at least n_neighbors neighbors per sample")
+        nbrs = np.ascontiguousarray(nbrs)
+        knn_distances = np.ascontiguousarray(knn_distances)
     if verbose:
         print("found nearest neighbor")
-    sig = np.maximum(np.mean(knn_distances[:, 3:6], axis=1), 1e-10)
+    if knn_distances.shape[1] >= 6:
+        sig = np.maximum(np.mean(knn_distances[:, 3:6], axis=1), 1e-10)
+    else:
+        sig = np.maximum(np.mean(knn_distances, axis=1), 1e-10)
     if verbose:
         print("found sig")
     scaled_dist = scale_dist(knn_distances, sig, nbrs)
@@ -257,7 +305,7 @@ def generate_pair(
     pair_FP = sample_FP_pair(X, pair_neighbors, n_neighbors, n_FP)
     return pair_neighbors, pair_MN, pair_FP
 
-@numba.njit("void(f4[:,:],f4[:,:],f4[:,:],f4[:,:],f4,f4,f4,i4)", parallel=True, nogil=True)
+@numba.njit("void(f4[:,:],f4[:,:],f4[:,:],f4[:,:],f4,f4,f4,i4)", cache=True, parallel=True, nogil=True)
 def update_embedding_adam(Y, grad, m, v, beta1, beta2, lr, itr):
     n, dim = Y.shape
     lr_t = lr * math.sqrt(1.0 - beta2**(itr+1)) / (1.0 - beta1**(itr+1))
@@ -267,7 +315,7 @@ def update_embedding_adam(Y, grad, m, v, beta1, beta2, lr, itr):
             v[i][d] += (1 - beta2) * (grad[i][d]**2 - v[i][d])
             Y[i][d] -= lr_t * m[i][d]/(math.sqrt(v[i][d]) + 1e-7)
 
-@numba.njit("f4[:,:](f4[:,:],i4[:,:],i4[:,:],i4[:,:],f4,f4,f4)", parallel=True, nogil=True)
+@numba.njit("f4[:,:](f4[:,:],i4[:,:],i4[:,:],i4[:,:],f4,f4,f4)", cache=True, parallel=True, nogil=True)
 def pacmap_grad(Y, pair_neighbors, pair_MN, pair_FP, w_neighbors, w_MN, w_FP):
     n, dim = Y.shape
     grad = np.zeros((n+1, dim), dtype=np.float32)
@@ -312,6 +360,61 @@ def pacmap_grad(Y, pair_neighbors, pair_MN, pair_FP, w_neighbors, w_MN, w_FP):
     grad[-1, 0] = loss.sum()
     return grad
 
+@numba.njit("void(f4[:,:],i4[:,:],i8,i8,f4,i4,f4[:,:],f4[:])", cache=True, nogil=True)
+def _accumulate_pair_grad(Y, pairs, start, stop, w, kind, grad, loss):
+    # kind 0: neighbor pairs, 1: mid-near pairs, 2: further pairs
+    dim = Y.shape[1]
+    y_ij = np.empty(dim, dtype=np.float32)
+    for t in range(start, stop):
+        i = pairs[t, 0]
+        j = pairs[t, 1]
+        d_ij = 1.0
+        for d in range(dim):
+            y_ij[d] = Y[i, d] - Y[j, d]
+            d_ij += y_ij[d] ** 2
+        if kind == 0:
+            loss[0] += w * (d_ij/(10. + d_ij))
+            w1 = w * (20./(10. + d_ij) ** 2)
+        elif kind == 1:
+            loss[1] += w * d_ij/(10000. + d_ij)
+            w1 = w * 20000./(10000. + d_ij) ** 2
+        else:
+            loss[2] += w * 1./(1. + d_ij)
+            w1 = -w * 2./(1. + d_ij) ** 2
+        for d in range(dim):
+            grad[i, d] += w1 * y_ij[d]
+            grad[j, d] -= w1 * y_ij[d]
+
+@numba.njit("void(f4[:,:],i4[:,:],i4[:,:],i4[:,:],f4,f4,f4,f4[:,:,:],f4[:,:],f4[:,:])", cache=True, parallel=True,
+             nogil=True)
+def pacmap_grad_parallel(Y, pair_neighbors, pair_MN, pair_FP, w_neighbors, w_MN, w_FP, thread_grad, thread_loss, grad):
+    # Same result as pacmap_grad, written to grad: every thread accumulates a contiguous chunk of each
+    # pair array into its own gradient buffer, and the buffers are then summed row-wise.
+    # The buffers, of shape (n_threads, n, dim), (n_threads, 3) and (n + 1, dim), are allocated once by the
+    # caller and reused across iterations; the number of threads is their first dimension.
+    n, dim = Y.shape
+    n_threads = thread_grad.shape[0]
+    for t in numba.prange(n_threads):
+        thread_grad[t] = 0
+        thread_loss[t] = 0
+        size = pair_neighbors.shape[0]
+        _accumulate_pair_grad(Y, pair_neighbors, t * size // n_threads, (t + 1) * size // n_threads,
+                              w_neighbors, 0, thread_grad[t], thread_loss[t])
+        size = pair_MN.shape[0]
+        _accumulate_pair_grad(Y, pair_MN, t * size // n_threads, (t + 1) * size // n_threads,
+                              w_MN, 1, thread_grad[t], thread_loss[t])
+        size = pair_FP.shape[0]
+        _accumulate_pair_grad(Y, pair_FP, t * size // n_threads, (t + 1) * size // n_threads,
+                              w_FP, 2, thread_grad[t], thread_loss[t])
+    for i in numba.prange(n):
+        for d in range(dim):
+            g = np.float32(0.0)
+            for t in range(n_threads):
+                g += thread_grad[t, i, d]
+            grad[i, d] = g
+    grad[n] = 0
+    grad[n, 0] = thread_loss.sum()
+
 def pacmap(
         X,
         n_dims,
@@ -327,11 +430,26 @@ def pacmap(
         Yinit,
         apply_pca,
         verbose,
-        intermediate
+        intermediate,
+        knn_indices=None,
+        knn_dists=None,
+        checkpoint_path=None,
+        checkpoint_every=50,
+        parallel=True
 ):
     start_time = time.time()
     n, high_dim = X.shape
 
+    # Snapshots hold the pairs, the embedding and the Adam buffers (see `dbmap.cache.save_checkpoint`), and the
+    # fingerprint of the data they were computed on
+    fingerprint = None if checkpoint_path is None else ann.data_fingerprint(X)
+    checkpoint = load_checkpoint(checkpoint_path, n=n, n_dims=n_dims, num_iters=num_iters,
+                                 intermediate=intermediate, fingerprint=fingerprint)
+    if checkpoint is not None:
+        pair_neighbors = checkpoint["pair_neighbors"]
+        pair_MN = checkpoint["pair_MN"]
+        pair_FP = checkpoint["pair_FP"]
+
     if intermediate:
         itr_dic = [0, 10, 30, 60, 100, 120, 140, 170, 200, 250, 300, 350, 450]
         intermediate_states = np.empty((13, n, 2), dtype=np.float32)
@@ -356,7 +474,7 @@ def pacmap(
                 if verbose:
                     print(X)
         pair_neighbors, pair_MN, pair_FP = generate_pair(
-            X, n_neighbors, n_MN, n_FP, distance, verbose
+            X, n_neighbors, n_MN, n_FP, distance, verbose, knn_indices, knn_dists
         )
         if verbose:
             print("sampled pairs")
@@ -364,7 +482,9 @@ def pacmap(
         if verbose:
             print("using stored pairs")
 
-    if Yinit is None or Yinit == "pca":
+    if checkpoint is not None:
+        Y = checkpoint["Y"].copy()
+    elif Yinit is None or Yinit == "pca":
         if pca_solution:
             Y = 0.01 * X[:, :n_dims]
         else:
@@ -380,11 +500,29 @@ def pacmap(
     m = np.zeros_like(Y, dtype=np.float32)
     v = np.zeros_like(Y, dtype=np.float32)
 
+    if parallel:
+        # Per-thread gradient buffers, reused across iterations
+        n_threads = numba.get_num_threads()
+        thread_grad = np.empty((n_threads, n, n_dims), dtype=np.float32)
+        thread_loss = np.empty((n_threads, 3), dtype=np.float32)
+        grad = np.empty((n + 1, n_dims), dtype=np.float32)
+
     if intermediate:
         itr_ind = 1
         intermediate_states[0, :, :] = Y
 
-    for itr in range(num_iters):
+    start_itr = 0
+    if checkpoint is not None:
+        start_itr = int(checkpoint["itr"])
+        m[:] = checkpoint["m"]
+        v[:] = checkpoint["v"]
+        if intermediate:
+            itr_ind = int(checkpoint["itr_ind"])
+            intermediate_states[:] = checkpoint["intermediate_states"]
+        if verbose:
+            print("resuming from iteration %d" % start_itr)
+
+    for itr in range(start_itr, num_iters):
         if itr < 100:
             w_MN = (1 - itr/100) * w_MN_init + itr/100 * 3.0
             w_neighbors = 2.0
@@ -398,7 +536,11 @@ def pacmap(
             w_neighbors = 1.
             w_FP = 1.
 
-        grad = pacmap_grad(Y, pair_neighbors, pair_MN, pair_FP, w_neighbors, w_MN, w_FP)
+        if parallel:
+            pacmap_grad_parallel(Y, pair_neighbors, pair_MN, pair_FP, w_neighbors, w_MN, w_FP, thread_grad,
+                                 thread_loss, grad)
+        else:
+            grad = pacmap_grad(Y, pair_neighbors, pair_MN, pair_FP, w_neighbors, w_MN, w_FP)
         C = grad[-1, 0]
         update_embedding_adam(Y, grad, m, v, beta1, beta2, lr, itr)
 
@@ -412,6 +554,17 @@ def pacmap(
             if (itr + 1) % 10 == 0:
                 print("Iteration: %4d, Loss: %f" % (itr + 1, C))
 
+        if checkpoint_path is not None and (itr + 1) % checkpoint_every == 0 and itr + 1 < num_iters:
+            state = dict(itr=itr + 1, Y=Y, m=m, v=v, pair_neighbors=pair_neighbors, pair_MN=pair_MN,
+                         pair_FP=pair_FP, n=n, n_dims=n_dims, num_iters=num_iters, intermediate=intermediate,
+                         fingerprint=fingerprint)
+            if intermediate:
+                state.update(itr_ind=itr_ind, intermediate_states=intermediate_states)
+            save_checkpoint(checkpoint_path, **state)
+
+    if checkpoint_path is not None and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
     if verbose:
         elapsed = str(datetime.timedelta(seconds=time.time() - start_time))
         print("Elapsed time: %s" % (elapsed))
@@ -431,7 +584,12 @@ class PaCMAP(BaseEstimator):
         num_iters=450,
         verbose=False,
         apply_pca=True,
-        intermediate=False
+        intermediate=False,
+        knn_indices=None,
+        knn_dists=None,
+        checkpoint_path=None,
+        checkpoint_every=50,
+        parallel=True
     ):
         self.n_dims = n_dims
         self.n_neighbors = n_neighbors
@@ -446,6 +604,11 @@ class PaCMAP(BaseEstimator):
         self.apply_pca = apply_pca
         self.verbose = verbose
         self.intermediate = intermediate
+        self.knn_indices = knn_indices
+        self.knn_dists = knn_dists
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_every = checkpoint_every
+        self.parallel = parallel
 
         if self.n_dims < 2:
             raise ValueError("The number of projection dimensions must be at least 2")
@@ -454,7 +617,7 @@ class PaCMAP(BaseEstimator):
         if self.distance == "hamming" and apply_pca:
             warnings.warn("apply_pca = True for Hamming distance.")
         if not self.apply_pca:
-            print("running ANNOY on high-dimensional data. nearest-neighbor search may be slow!")
+            print("running NMSlib on high-dimensional data. nearest-neighbor search may be slow!")
 
     def fit(self, X, init=None):
         X = X.astype(np.float32)
@@ -502,7 +665,12 @@ class PaCMAP(BaseEstimator):
             init,
             self.apply_pca,
             self.verbose,
-            self.intermediate
+            self.intermediate,
+            self.knn_indices,
+            self.knn_dists,
+            self.checkpoint_path,
+            self.checkpoint_every,
+            self.parallel
         )
         return self
 
@@ -547,7 +715,9 @@ class PaCMAP(BaseEstimator):
             self.n_MN,
             self.n_FP,
             self.distance,
-            self.verbose
+            self.verbose,
+            self.knn_indices,
+            self.knn_dists
                 )
         if self.verbose:
             print("sampled pairs")
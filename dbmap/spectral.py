@@ -8,9 +8,6 @@ import scipy.sparse.csgraph
 from sklearn.manifold import SpectralEmbedding
 from sklearn.metrics import pairwise_distances
 
-from umap.distances import pairwise_special_metric, SPECIAL_METRICS
-from umap.sparse import SPARSE_SPECIAL_METRICS, sparse_named_distances
-
 
 def component_layout(
     data,
@@ -84,6 +81,10 @@ def component_layout(
             )
             component_centroids = component_centroids.toarray()
 
+        # umap compiles its distances when imported: only import it when needed
+        from umap.distances import pairwise_special_metric, SPECIAL_METRICS
+        from umap.sparse import SPARSE_SPECIAL_METRICS, sparse_named_distances
+
         if metric in SPECIAL_METRICS:
             distance_matrix = pairwise_special_metric(
                 component_centroids, metric=metric
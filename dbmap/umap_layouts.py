@@ -3,9 +3,13 @@
 #
 # For more information on the original UMAP implementation, please see:
 # https://github.com/lmcinnes/umap, and https://umap-learn.readthedocs.io/  .
+import os
+import types
+
 import numpy as np
 import numba
 from . import distances as dist
+from .cache import save_checkpoint, load_checkpoint
 from .utils import tau_rand_int
 
 
@@ -29,6 +33,21 @@ def clip(val):
         return val
 
 
+def _compile_kernel(fn, parallel):
+    """Compile a layout kernel once at module level with numba's on-disk cache.
+    Numba keys its cache on the function name and bytecode only, not on the
+    compilation flags, so the serial and parallel builds are compiled from
+    renamed copies of ``fn`` to keep their cache entries apart.
+    """
+    name = fn.__name__ + ("_parallel" if parallel else "_serial")
+    kernel = types.FunctionType(
+        fn.__code__, fn.__globals__, name, fn.__defaults__, fn.__closure__
+    )
+    kernel.__qualname__ = name
+    kernel.__doc__ = fn.__doc__
+    return numba.njit(kernel, fastmath=True, parallel=parallel, cache=True)
+
+
 @numba.njit(
     "f4(f4[::1],f4[::1])",
     fastmath=True,
@@ -86,6 +105,7 @@ def _optimize_layout_euclidean_single_epoch(
     dens_R,
     dens_mu,
     dens_mu_tot,
+    negative_sampling,
 ):
     for i in numba.prange(epochs_per_sample.shape[0]):
         if epoch_of_next_sample[i] <= n:
@@ -149,6 +169,9 @@ def _optimize_layout_euclidean_single_epoch(
 
             epoch_of_next_sample[i] += epochs_per_sample[i]
 
+            if not negative_sampling:
+                continue
+
             n_neg_samples = int(
                 (n - epoch_of_next_negative_sample[i]) / epochs_per_negative_sample[i]
             )
@@ -182,6 +205,14 @@ def _optimize_layout_euclidean_single_epoch(
             )
 
 
+_optimize_layout_euclidean_single_epoch_serial = _compile_kernel(
+    _optimize_layout_euclidean_single_epoch, parallel=False
+)
+_optimize_layout_euclidean_single_epoch_parallel = _compile_kernel(
+    _optimize_layout_euclidean_single_epoch, parallel=True
+)
+
+
 def _optimize_layout_euclidean_densmap_epoch_init(
     head_embedding, tail_embedding, head, tail, a, b, re_sum, phi_sum,
 ):
@@ -208,6 +239,14 @@ def _optimize_layout_euclidean_densmap_epoch_init(
         re_sum[i] = np.log(epsilon + (re_sum[i] / phi_sum[i]))
 
 
+_optimize_layout_euclidean_densmap_epoch_init_serial = _compile_kernel(
+    _optimize_layout_euclidean_densmap_epoch_init, parallel=False
+)
+_optimize_layout_euclidean_densmap_epoch_init_parallel = _compile_kernel(
+    _optimize_layout_euclidean_densmap_epoch_init, parallel=True
+)
+
+
 def optimize_layout_euclidean(
     head_embedding,
     tail_embedding,
@@ -226,12 +265,17 @@ def optimize_layout_euclidean(
     verbose=False,
     densmap=False,
     densmap_kwds={},
+    repulsion="sampled",
+    theta=0.5,
+    checkpoint_path=None,
+    checkpoint_every=50,
 ):
     """Improve an embedding using stochastic gradient descent to minimize the
     fuzzy set cross entropy between the 1-skeletons of the high dimensional
     and low dimensional fuzzy simplicial sets. In practice this is done by
     sampling edges based on their membership strength (with the (1-p) terms
-    coming from negative sampling similar to word2vec).
+    coming from negative sampling similar to word2vec, or from a Barnes-Hut
+    approximation of their expected value).
     Parameters
     ----------
     head_embedding: array of shape (n_samples, n_components)
@@ -274,6 +318,23 @@ def optimize_layout_euclidean(
         Whether to use the density-augmented densMAP objective
     densmap_kwds: dict (optional, default {})
         Auxiliary data for densMAP
+    repulsion: string (optional, default 'sampled')
+        How repulsive forces are computed. Either 'sampled', which draws
+        random tail vertices as negative samples, or 'barnes_hut', which
+        repels each vertex from a quadtree (octree) of the tail embedding
+        built every epoch, with the expected strength of its negative
+        samples. 'barnes_hut' is deterministic, and only supports 2 or 3
+        components.
+    theta: float (optional, default 0.5)
+        Opening angle of the 'barnes_hut' repulsion. Smaller values are
+        more accurate and slower.
+    checkpoint_path: string (optional, default None)
+        A ``.npz`` file to snapshot the optimization state to (the
+        embedding, sampling schedules, rng state and learning rate) every
+        ``checkpoint_every`` epochs. If the file exists, the optimization
+        resumes from it. It is removed once the optimization completes.
+    checkpoint_every: int (optional, default 50)
+        Number of epochs between snapshots.
     Returns
     -------
     embedding: array of shape (n_samples, n_components)
@@ -288,16 +349,31 @@ def optimize_layout_euclidean(
     epoch_of_next_negative_sample = epochs_per_negative_sample.copy()
     epoch_of_next_sample = epochs_per_sample.copy()
 
-    optimize_fn = numba.njit(
-        _optimize_layout_euclidean_single_epoch, fastmath=True, parallel=parallel
-    )
+    if parallel:
+        optimize_fn = _optimize_layout_euclidean_single_epoch_parallel
+    else:
+        optimize_fn = _optimize_layout_euclidean_single_epoch_serial
 
-    if densmap:
-        dens_init_fn = numba.njit(
-            _optimize_layout_euclidean_densmap_epoch_init,
-            fastmath=True,
-            parallel=parallel,
+    if repulsion == "barnes_hut":
+        if dim not in (2, 3):
+            raise Exception("Barnes-Hut repulsion only supports 2 or 3 components.")
+        # The tree kernels are compiled when imported: only import them when needed
+        from . import barnes_hut
+
+        # Number of negative samples each head vertex draws per epoch
+        negative_rates = np.bincount(
+            head,
+            weights=1.0 / epochs_per_negative_sample,
+            minlength=head_embedding.shape[0],
         )
+    elif repulsion != "sampled":
+        raise Exception("Repulsion must be either 'sampled' or 'barnes_hut'.")
+
+    if densmap:
+        if parallel:
+            dens_init_fn = _optimize_layout_euclidean_densmap_epoch_init_parallel
+        else:
+            dens_init_fn = _optimize_layout_euclidean_densmap_epoch_init_serial
 
         dens_mu_tot = np.sum(densmap_kwds["mu_sum"]) / 2
         dens_lambda = densmap_kwds["lambda"]
@@ -314,7 +390,36 @@ def optimize_layout_euclidean(
         dens_phi_sum = np.zeros(1, dtype=np.float32)
         dens_re_sum = np.zeros(1, dtype=np.float32)
 
-    for n in range(n_epochs):
+    start_epoch = 0
+    fingerprint = None
+    if checkpoint_path is not None:
+        from .ann import data_fingerprint
+
+        # Snapshots only resume the optimization of the same graph
+        fingerprint = data_fingerprint(np.vstack([head, tail])) + data_fingerprint(
+            epochs_per_sample
+        )
+    checkpoint = load_checkpoint(
+        checkpoint_path,
+        n_epochs=n_epochs,
+        n_vertices=n_vertices,
+        n_edges=head.shape[0],
+        shape=head_embedding.shape,
+        fingerprint=fingerprint,
+    )
+    if checkpoint is not None:
+        start_epoch = int(checkpoint["epoch"])
+        alpha = float(checkpoint["alpha"])
+        head_embedding[:] = checkpoint["head_embedding"]
+        if "tail_embedding" in checkpoint:
+            tail_embedding[:] = checkpoint["tail_embedding"]
+        epoch_of_next_sample[:] = checkpoint["epoch_of_next_sample"]
+        epoch_of_next_negative_sample[:] = checkpoint["epoch_of_next_negative_sample"]
+        rng_state[:] = checkpoint["rng_state"]
+        if verbose:
+            print("\tresuming from epoch ", start_epoch, " / ", n_epochs, "epochs")
+
+    for n in range(start_epoch, n_epochs):
 
         densmap_flag = (
             densmap
@@ -370,13 +475,49 @@ def optimize_layout_euclidean(
             dens_R,
             dens_mu,
             dens_mu_tot,
+            repulsion == "sampled",
         )
 
+        if repulsion == "barnes_hut":
+            barnes_hut.repel(
+                head_embedding,
+                tail_embedding,
+                negative_rates,
+                a,
+                b,
+                gamma,
+                alpha,
+                n_vertices,
+                theta=theta,
+                parallel=parallel,
+            )
+
         alpha = initial_alpha * (1.0 - (float(n) / float(n_epochs)))
 
         if verbose and n % int(n_epochs / 10) == 0:
             print("\tcompleted ", n, " / ", n_epochs, "epochs")
 
+        if checkpoint_path is not None and (n + 1) % checkpoint_every == 0 and n + 1 < n_epochs:
+            state = dict(
+                epoch=n + 1,
+                alpha=alpha,
+                head_embedding=head_embedding,
+                epoch_of_next_sample=epoch_of_next_sample,
+                epoch_of_next_negative_sample=epoch_of_next_negative_sample,
+                rng_state=rng_state,
+                n_epochs=n_epochs,
+                n_vertices=n_vertices,
+                n_edges=head.shape[0],
+                shape=head_embedding.shape,
+                fingerprint=fingerprint,
+            )
+            if move_other and tail_embedding is not head_embedding:
+                state["tail_embedding"] = tail_embedding
+            save_checkpoint(checkpoint_path, **state)
+
+    if checkpoint_path is not None and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
     return head_embedding
 
 
@@ -823,6 +964,14 @@ def _optimize_layout_aligned_euclidean_single_epoch(
                 )
 
 
+_optimize_layout_aligned_euclidean_single_epoch_serial = _compile_kernel(
+    _optimize_layout_aligned_euclidean_single_epoch, parallel=False
+)
+_optimize_layout_aligned_euclidean_single_epoch_parallel = _compile_kernel(
+    _optimize_layout_aligned_euclidean_single_epoch, parallel=True
+)
+
+
 def optimize_layout_aligned_euclidean(
     head_embeddings,
     tail_embeddings,
@@ -861,11 +1010,10 @@ def optimize_layout_aligned_euclidean(
         )
         epoch_of_next_sample.append(epochs_per_sample[m].astype(np.float32))
 
-    optimize_fn = numba.njit(
-        _optimize_layout_aligned_euclidean_single_epoch,
-        fastmath=True,
-        parallel=parallel,
-    )
+    if parallel:
+        optimize_fn = _optimize_layout_aligned_euclidean_single_epoch_parallel
+    else:
+        optimize_fn = _optimize_layout_aligned_euclidean_single_epoch_serial
 
     for n in range(n_epochs):
         optimize_fn(
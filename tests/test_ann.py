@@ -0,0 +1,33 @@
+import numpy as np
+
+from dbmap import ann
+
+
+def test_fit_reuses_stored_index(tmp_path, capsys):
+    data = np.random.RandomState(0).normal(size=(300, 10)).astype(np.float32)
+    path = str(tmp_path / 'index')
+    first = ann.NMSlibTransformer(n_neighbors=5, metric='euclidean', dense=True, index_path=path, n_jobs=1)
+    ind, dist = first.fit(data).kneighbors(data)
+
+    capsys.readouterr()
+    second = ann.NMSlibTransformer(n_neighbors=5, metric='euclidean', dense=True, index_path=path, n_jobs=1,
+                                   verbose=True)
+    second.fit(data)
+    out = capsys.readouterr().out
+    assert 'Loading stored index' in out
+    assert 'Indexing time' not in out
+    ind_loaded, dist_loaded = second.kneighbors(data)
+    np.testing.assert_array_equal(ind_loaded, ind)
+    np.testing.assert_allclose(dist_loaded, dist)
+
+
+def test_fit_rebuilds_stored_index_for_other_data(tmp_path, capsys):
+    rng = np.random.RandomState(0)
+    path = str(tmp_path / 'index')
+    ann.NMSlibTransformer(n_neighbors=5, dense=True, index_path=path, n_jobs=1).fit(
+        rng.normal(size=(300, 10)).astype(np.float32))
+
+    capsys.readouterr()
+    ann.NMSlibTransformer(n_neighbors=5, dense=True, index_path=path, n_jobs=1, verbose=True).fit(
+        rng.normal(size=(300, 10)).astype(np.float32))
+    assert 'Rebuilding' in capsys.readouterr().out
@@ -0,0 +1,98 @@
+import numpy as np
+import pytest
+from sklearn.datasets import load_digits
+
+from dbmap import pacmapper, umap_layouts
+from dbmap.pacmapper import PaCMAP, pacmap
+
+
+class Interrupt(Exception):
+    pass
+
+
+def interrupt_after(module, name, n_calls, monkeypatch):
+    # Makes module.name raise once it has been called n_calls times
+    fn = getattr(module, name)
+    calls = []
+
+    def wrapper(*args):
+        if len(calls) == n_calls:
+            raise Interrupt()
+        calls.append(None)
+        return fn(*args)
+
+    monkeypatch.setattr(module, name, wrapper)
+
+
+@pytest.fixture(scope='module')
+def pairs():
+    data = load_digits().data[:500].astype(np.float32)
+    mapper = PaCMAP(n_neighbors=10).sample_pairs(data.copy())
+    return data, mapper.pair_neighbors, mapper.pair_MN, mapper.pair_FP
+
+
+def run_pacmap(data, pairs, **kwargs):
+    return pacmap(data.copy(), 2, 10, 5, 20, *pairs, 'euclidean', 1.0, 120, 'pca', True, False, False,
+                  **kwargs)[0]
+
+
+def test_pacmap_resume_matches_uninterrupted_run(pairs, tmp_path, monkeypatch):
+    data, pairs = pairs[0], pairs[1:]
+    path = str(tmp_path / 'pacmap.npz')
+    reference = run_pacmap(data, pairs)
+
+    with monkeypatch.context() as m:
+        interrupt_after(pacmapper, 'update_embedding_adam', 70, m)
+        with pytest.raises(Interrupt):
+            run_pacmap(data, pairs, checkpoint_path=path, checkpoint_every=50)
+    resumed = run_pacmap(data, pairs, checkpoint_path=path, checkpoint_every=50)
+    np.testing.assert_array_equal(resumed, reference)
+
+
+def test_pacmap_refuses_checkpoint_of_other_data(pairs, tmp_path, monkeypatch):
+    data, pairs = pairs[0], pairs[1:]
+    path = str(tmp_path / 'pacmap.npz')
+    with monkeypatch.context() as m:
+        interrupt_after(pacmapper, 'update_embedding_adam', 70, m)
+        with pytest.raises(Interrupt):
+            run_pacmap(data, pairs, checkpoint_path=path, checkpoint_every=50)
+    with pytest.raises(Exception, match='fingerprint differs'):
+        run_pacmap(data[::-1], pairs, checkpoint_path=path, checkpoint_every=50)
+
+
+def layout_problem(seed):
+    rng = np.random.RandomState(seed)
+    n = 300
+    head = np.repeat(np.arange(n, dtype=np.int32), 5)
+    tail = rng.randint(0, n, head.shape[0]).astype(np.int32)
+    epochs_per_sample = rng.uniform(1, 5, head.shape[0])
+    embedding = np.random.RandomState(0).uniform(-10, 10, (n, 2)).astype(np.float32)
+    return head, tail, epochs_per_sample, embedding
+
+
+def run_layout(problem, **kwargs):
+    head, tail, epochs_per_sample, embedding = problem
+    embedding = embedding.copy()
+    rng_state = np.array([1, 2, 3], dtype=np.int64)
+    return umap_layouts.optimize_layout_euclidean(embedding, embedding, head, tail, 120, embedding.shape[0],
+                                                  epochs_per_sample, 1.58, 0.9, rng_state, **kwargs)
+
+
+def test_layout_resume_matches_uninterrupted_run(tmp_path, monkeypatch):
+    problem = layout_problem(0)
+    path = str(tmp_path / 'layout.npz')
+    reference = run_layout(problem)
+
+    with monkeypatch.context() as m:
+        interrupt_after(umap_layouts, '_optimize_layout_euclidean_single_epoch_serial', 70, m)
+        with pytest.raises(Interrupt):
+            run_layout(problem, checkpoint_path=path, checkpoint_every=50)
+    resumed = run_layout(problem, checkpoint_path=path, checkpoint_every=50)
+    np.testing.assert_array_equal(resumed, reference)
+
+    with monkeypatch.context() as m:
+        interrupt_after(umap_layouts, '_optimize_layout_euclidean_single_epoch_serial', 70, m)
+        with pytest.raises(Interrupt):
+            run_layout(problem, checkpoint_path=path, checkpoint_every=50)
+    with pytest.raises(Exception, match='fingerprint differs'):
+        run_layout(layout_problem(1), checkpoint_path=path, checkpoint_every=50)
@@ -0,0 +1,92 @@
+import gc
+import os
+
+import numpy as np
+import pytest
+from scipy.sparse import csr_matrix
+from sklearn.datasets import load_digits
+
+from dbmap.diffusion import Diffusor
+
+
+@pytest.fixture(scope='module')
+def digits():
+    data = load_digits().data
+    return data[:1500], data[1500:]
+
+
+@pytest.mark.parametrize('use_ann', [False, True])
+def test_out_of_sample_after_fit(digits, use_ann):
+    train, test = digits
+    diff = Diffusor(n_components=10, ann=use_ann, verbose=False).fit(train)
+    projected = np.asarray(diff.out_of_sample(test))
+    assert projected.shape == (test.shape[0], diff.res['MultiscaleComponents'].shape[1])
+    assert np.isfinite(projected).all()
+
+    # The Nystrom extension of fitted samples follows their fitted components
+    fitted = np.asarray(diff.res['MultiscaleComponents'])[:200]
+    projected = np.asarray(diff.out_of_sample(train[:200]))
+    for i in range(fitted.shape[1]):
+        assert np.corrcoef(projected[:, i], fitted[:, i])[0, 1] > 0.95
+
+
+def test_float32_precision(digits):
+    train, test = digits
+    diff = Diffusor(n_components=10, ann=False, dtype=np.float32, verbose=False).fit(train)
+    assert np.asarray(diff.transform(train)).dtype == np.float32
+    assert diff.kernel_sums.dtype == np.float32
+    assert np.asarray(diff.out_of_sample(test)).dtype == np.float32
+
+
+def test_memmap_temporary_directory_is_reused_and_removed(digits):
+    train, _ = digits
+    diff = Diffusor(n_components=10, ann=False, memmap_path=True, verbose=False).fit(train)
+    first = diff.transform(train)
+    second = diff.transform(train)
+    assert first.filename == second.filename
+    directory = os.path.dirname(second.filename)
+    assert sorted(os.listdir(directory)) == ['diffusion_EigenVectors.npy', 'diffusion_MultiscaleComponents.npy']
+    del diff
+    gc.collect()
+    assert not os.path.exists(directory)
+
+
+@pytest.mark.parametrize('solver', ['arpack', 'eigsh', 'lobpcg'])
+def test_expand_decomposition_matches_direct_decomposition(digits, solver):
+    train, _ = digits
+    diff = Diffusor(n_components=10, ann=False, eigen_solver=solver, verbose=False).fit(train)
+    np.random.seed(0)
+    D, V = diff._expand_decomposition(*diff._decompose(10), 20)
+    D_direct, V_direct = diff._decompose(20)
+    np.testing.assert_allclose(D, D_direct, atol=1e-3)
+    # Same eigenvectors up to sign
+    np.testing.assert_allclose(np.abs(np.sum(V * V_direct, axis=0)), 1, atol=1e-2)
+
+
+def test_expand_decomposition_finds_negative_eigenvalues():
+    # Already converged eigenvectors must not be found again below the positive spectrum
+    rng = np.random.RandomState(0)
+    Q, _ = np.linalg.qr(rng.normal(size=(200, 200)))
+    evals = np.concatenate([[0.9, 0.7, 0.6, 0.5, 0.4, 0.35, 0.314, 0.2], -np.linspace(0.05, 0.5, 192)])
+    A = csr_matrix((Q * evals) @ Q.T)
+    diff = Diffusor(eigen_solver='eigsh')
+    diff.N = 200
+    diff._symmetric_operator = lambda: (A, None)
+    D, V = diff._expand_decomposition(evals[:6].copy(), Q[:, :6].copy(), 12)
+    np.testing.assert_allclose(D, np.sort(evals)[::-1][:12], atol=1e-3)
+    assert np.abs(Q[:, :6].T @ V[:, 6:]).max() < 1e-3
+
+
+def test_randomized_solver_is_seeded_and_close_to_eigsh(digits):
+    train, _ = digits
+    diff = Diffusor(n_components=30, ann=False, eigengap=False, verbose=False).fit(train)
+    diff.eigen_solver = 'eigsh'
+    D_ref, V_ref = diff._decompose(30)
+    diff.eigen_solver = 'randomized'
+    diff.random_state = 0
+    D, V = diff._decompose(30)
+    D_again, V_again = diff._decompose(30)
+    np.testing.assert_array_equal(D, D_again)
+    np.testing.assert_array_equal(V, V_again)
+    np.testing.assert_allclose(D, D_ref, rtol=1e-3)
+    np.testing.assert_allclose(np.abs(np.sum(V[:, :10] * V_ref[:, :10], axis=0)), 1, atol=1e-3)
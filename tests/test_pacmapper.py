@@ -0,0 +1,21 @@
+import numpy as np
+
+from dbmap.pacmapper import pacmap_grad, pacmap_grad_parallel
+
+
+def test_pacmap_grad_parallel_matches_serial():
+    rng = np.random.RandomState(0)
+    n, dim = 2000, 2
+    Y = rng.normal(size=(n, dim)).astype(np.float32)
+    pair_neighbors, pair_MN, pair_FP = (rng.randint(0, n, size=(n * k, 2)).astype(np.int32) for k in (10, 5, 20))
+    weights = (np.float32(2.0), np.float32(3.0), np.float32(1.0))
+    reference = pacmap_grad(Y, pair_neighbors, pair_MN, pair_FP, *weights)
+
+    for n_threads in (1, 3):
+        # Buffers are reused across calls, so they start dirty
+        thread_grad = np.full((n_threads, n, dim), np.nan, dtype=np.float32)
+        thread_loss = np.full((n_threads, 3), np.nan, dtype=np.float32)
+        grad = np.full((n + 1, dim), np.nan, dtype=np.float32)
+        for _ in range(2):
+            pacmap_grad_parallel(Y, pair_neighbors, pair_MN, pair_FP, *weights, thread_grad, thread_loss, grad)
+            np.testing.assert_allclose(grad, reference, rtol=1e-4, atol=1e-4)